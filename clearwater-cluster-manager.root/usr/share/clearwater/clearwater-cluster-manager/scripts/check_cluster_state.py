@@ -7,6 +7,7 @@
 
 import sys
 import etcd
+from metaswitch.clearwater.etcd_shared.etcd_backend import create_client
 import json
 import os
 
@@ -14,18 +15,19 @@ mgmt_node = sys.argv[1]
 local_node_ip = sys.argv[2]
 local_site = sys.argv[3]
 sites = sys.argv[4]
+etcd_key = sys.argv[5] if len(sys.argv) > 5 else "clearwater"
 
-client = etcd.Client(mgmt_node, 4000)
+client = create_client(mgmt_node, 4000)
 
 
 def describe_clusters():
     """This function returns the the number of unstable clusters it is
      checking """
     # Pull out all the clearwater keys.
-    key = "/?recursive=True"
+    key = "/" + etcd_key
 
     try:
-        result = client.get(key)
+        result = client.read(key, recursive=True)
     except etcd.EtcdKeyNotFound:
         # There's no clearwater keys yet
         return
@@ -10,6 +10,7 @@
 from metaswitch.clearwater.etcd_shared.plugin_loader import load_plugins_in_dir
 from metaswitch.clearwater.config_manager.plugin_base import FileStatus
 import etcd
+from metaswitch.clearwater.etcd_shared.etcd_backend import create_client
 import os
 import sys
 
@@ -17,7 +18,7 @@ etcd_ip = sys.argv[1]
 site = sys.argv[2]
 etcd_key = sys.argv[3]
 
-client = etcd.Client(etcd_ip, 4000)
+client = create_client(etcd_ip, 4000)
 
 plugins_dir = "/usr/share/clearwater/clearwater-config-manager/plugins/"
 plugins = load_plugins_in_dir(plugins_dir)
@@ -7,13 +7,14 @@
 
 import sys
 import etcd
+from metaswitch.clearwater.etcd_shared.etcd_backend import create_client
 import json
 
 mgmt_node = sys.argv[1]
 local_site = sys.argv[2]
 queue_key = sys.argv[3]
 
-client = etcd.Client(mgmt_node, 4000)
+client = create_client(mgmt_node, 4000)
 
 def describe_queue_state():
     print "Describing the current queue state for {}".format(queue_key)
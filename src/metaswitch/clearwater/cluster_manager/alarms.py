@@ -17,6 +17,7 @@ import logging
 from threading import Thread, Condition
 from .alarm_constants import TOO_LONG_CLUSTERING
 from metaswitch.common.alarms import alarm_manager
+from metaswitch.clearwater.etcd_shared.event_loop import installed_loop
 
 _log = logging.getLogger("cluster_manager.alarms")
 
@@ -27,31 +28,61 @@ class TooLongAlarm(object):
     def __init__(self, delay=(15*60)):
         self._condition = Condition()
         self._timer_thread = None
+        self._timer_handle = None
         self._should_alarm = False
+        self._quitting = False
         self._alarm = alarm_manager.get_alarm(ALARM_ISSUER_NAME,
                                               TOO_LONG_CLUSTERING)
         self._delay = delay
 
     def alarm(self):
         with self._condition:
-            self._condition.wait(self._delay)
-            if self._should_alarm:
+            # quit() may have been called before this thread got here, in
+            # which case its notify() is lost, so check before waiting.
+            if not self._quitting:
+                self._condition.wait(self._delay)
+            if self._should_alarm and not self._quitting:
                 _log.info("Raising TOO_LONG_CLUSTERING alarm")
                 self._alarm.set()
 
+    def alarm_on_loop(self):
+        self._timer_handle = None
+        if self._should_alarm:
+            _log.info("Raising TOO_LONG_CLUSTERING alarm")
+            # Raising the alarm talks to the SNMP agent, so don't block the
+            # loop on it.
+            installed_loop().run_in_worker(self._alarm.set)
+
     def trigger(self, thread_name="Alarm thread"):
         self._should_alarm = True
+        loop = installed_loop()
+        if loop is not None:
+            if self._timer_handle is None:
+                _log.debug("TOO_LONG_CLUSTERING alarm triggered, will fire in {} seconds".format(self._delay))
+                self._timer_handle = loop.call_later(self._delay,
+                                                     self.alarm_on_loop)
+            return
+
         if self._timer_thread is None:
             _log.debug("TOO_LONG_CLUSTERING alarm triggered, will fire in {} seconds".format(self._delay))
             self._timer_thread = Thread(target=self.alarm, name=thread_name)
             self._timer_thread.start()
 
     def quit(self):
-        if self._timer_thread is not None:
+        if self._timer_handle is not None:
             self._should_alarm = False
             _log.info("TOO_LONG_CLUSTERING alarm cancelled when quitting")
-            with self._condition:
-                self._condition.notify()
+            self._timer_handle.cancel()
+            self._timer_handle = None
+
+        with self._condition:
+            # Also wakes any thread left waiting by cancel().
+            self._quitting = True
+            self._should_alarm = False
+            self._condition.notify_all()
+
+        if self._timer_thread is not None:
+            _log.info("TOO_LONG_CLUSTERING alarm cancelled when quitting")
             self._timer_thread.join()
 
     def cancel(self):
@@ -62,6 +93,9 @@ class TooLongAlarm(object):
             # cancel the thread
             self._condition.notify()
             self._timer_thread = None
+            if self._timer_handle is not None:
+                self._timer_handle.cancel()
+                self._timer_handle = None
 
             # clear the alarm
             self._alarm.clear()
@@ -10,8 +10,12 @@
 import json
 
 import constants
-from .synchronization_fsm import SyncFSM
+from .synchronization_fsm import SyncFSM, safe_plugin
+from .hook_runner import HookRunner
 from metaswitch.clearwater.etcd_shared.common_etcd_synchronizer import CommonEtcdSynchronizer
+from metaswitch.clearwater.etcd_shared.plugin_loader import plugin_name
+from metaswitch.clearwater.etcd_shared.retry_policy import RetryPolicy
+from metaswitch.clearwater.etcd_shared import metrics
 from .cluster_state import ClusterInfo
 import logging
 from etcd import EtcdAlreadyExist
@@ -20,12 +24,27 @@ _log = logging.getLogger(__name__)
 
 
 class EtcdSynchronizer(CommonEtcdSynchronizer):
+    # How many times to retry a write of this node's state that loses a race
+    # with another node's write, and the longest to back off between retries
+    # (in seconds). See RetryPolicy.
+    MAX_CAS_RETRIES = 10
+    MAX_CAS_RETRY_DELAY = 2
+
     def __init__(self, plugin, ip, etcd_ip=None, force_leave=False):
         super(EtcdSynchronizer, self).__init__(plugin, ip, etcd_ip)
-        self._fsm = SyncFSM(self._plugin, self._ip)
+        # The plugin's slow hooks run in the background, and we look at the
+        # cluster again as soon as one finishes.
+        hooks = HookRunner(safe_plugin, lambda: self.recheck_after(0))
+        self._fsm = SyncFSM(self._plugin,
+                            self._ip,
+                            recheck_after=self.recheck_after,
+                            hooks=hooks)
         self._leaving_requested = False
         self.force_leave = force_leave
 
+        # Records every node's state changes (see scale_timing.py)
+        self._scale_timing = None
+
     def key(self):
         return self._plugin.key()
 
@@ -43,36 +62,66 @@ class EtcdSynchronizer(CommonEtcdSynchronizer):
             etcd_value = self.update_from_etcd()
             if self._terminate_flag:
                 break
-            if etcd_value is not None:
-                _log.info("Got new state %s from etcd" % etcd_value)
-                cluster_info = ClusterInfo(etcd_value)
-
-                # This node can only leave the cluster if the cluster is in a
-                # stable state. Also check that we've both requested to leave
-                # and we're not already leaving (there's a race condition where
-                # the requested flag can only be cleared after updating etcd, but
-                # updating etcd triggers this function to be called).
-                # If necessary, set this node to WAITING_TO_LEAVE. Otherwise, kick
-                # the FSM.
-                if (self._leaving_requested and
-                    cluster_info.local_state(self._ip) != constants.WAITING_TO_LEAVE and
-                    cluster_info.can_leave(self.force_leave)):
-                    _log.info("Cluster is in a stable state, so leaving the cluster now")
-                    new_state = constants.WAITING_TO_LEAVE
-                else:
-                    new_state = self._fsm.next(cluster_info.local_state(self._ip),
+            self.process(etcd_value, None)
+
+        self.finish()
+
+    def set_scale_timing(self, recorder):
+        self._scale_timing = recorder
+
+    def process(self, etcd_value, old_value):
+        if etcd_value is not None and self._scale_timing is not None:
+            # Including our own writes, which change our node's state.
+            self._scale_timing.observe(self.key(), ClusterInfo(etcd_value).view)
+
+        if etcd_value is not None and self.is_echo() and not self._leaving_requested:
+            # This is our own write, and it didn't change the cluster
+            # state, so the FSM has nothing more to do.
+            _log.debug("Ignoring our own write of state %s" % etcd_value)
+        elif etcd_value is not None:
+            _log.info("Got new state %s from etcd" % etcd_value)
+            cluster_info = ClusterInfo(etcd_value)
+
+            # This node can only leave the cluster if the cluster is in a
+            # stable state. Also check that we've both requested to leave
+            # and we're not already leaving (there's a race condition where
+            # the requested flag can only be cleared after updating etcd, but
+            # updating etcd triggers this function to be called).
+            # If necessary, set this node to WAITING_TO_LEAVE. Otherwise, kick
+            # the FSM.
+            if (self._leaving_requested and
+                cluster_info.local_state(self._ip) != constants.WAITING_TO_LEAVE and
+                cluster_info.can_leave(self.force_leave)):
+                _log.info("Cluster is in a stable state, so leaving the cluster now")
+                new_state = constants.WAITING_TO_LEAVE
+                ignore_echo = False
+            else:
+                local_state = cluster_info.local_state(self._ip)
+                with metrics.fsm_step_seconds.time(fsm="cluster",
+                                                   plugin=self.thread_name()):
+                    new_state = self._fsm.next(local_state,
                                                cluster_info.cluster_state,
                                                cluster_info.view)
+                ignore_echo = True
 
-                # If we have a new state, try and write it to etcd.
-                if new_state is not None:
-                    self.write_to_etcd(cluster_info, new_state)
-                else:
-                    _log.debug("No state change")
+                if isinstance(new_state, str):
+                    metrics.fsm_transitions.inc(fsm="cluster",
+                                                plugin=self.thread_name(),
+                                                from_state=local_state,
+                                                to_state=new_state)
+
+            # If we have a new state, try and write it to etcd.
+            if new_state is not None:
+                self.write_to_etcd(cluster_info,
+                                   new_state,
+                                   ignore_echo=ignore_echo)
             else:
-                _log.warning("read_from_etcd returned None, " +
-                             "indicating a failure to get data from etcd")
+                _log.debug("No state change")
+        else:
+            _log.warning("read_from_etcd returned None, " +
+                         "indicating a failure to get data from etcd")
 
+    def finish(self):
         _log.info("Quitting FSM")
         self._fsm.quit()
 
@@ -81,7 +130,7 @@ class EtcdSynchronizer(CommonEtcdSynchronizer):
     # leave at the next available opportunity.
     def leave_cluster(self):
         _log.info("Trying to leave the cluster - plugin %s" %
-                  self._plugin.__class__.__name__)
+                  plugin_name(self._plugin))
 
         if not self._plugin.should_be_in_cluster():
             _log.info("No need to leave remote cluster - just exit")
@@ -115,66 +164,116 @@ class EtcdSynchronizer(CommonEtcdSynchronizer):
 
     # Write the new cluster view to etcd. We may be expecting to create the key
     # for the first time.
-    def write_to_etcd(self, cluster_info, new_state, with_index=None):
+    def write_to_etcd(self, cluster_info, new_state, with_index=None,
+                      ignore_echo=False):
         index = with_index or self._index
-        cluster_view = cluster_info.view.copy()
-
-        # Update the cluster view based on new state information. If new_state
-        # is a string then it refers to the new state of the local node.
-        # Otherwise, it is an overall picture of the new cluster.
-        if new_state == constants.DELETE_ME:
-            del cluster_view[self._ip]
-        elif isinstance(new_state, str):
-            cluster_view[self._ip] = new_state
-        elif isinstance(new_state, dict):
-            cluster_view = new_state
-
-        _log.debug("Writing state %s into etcd" % cluster_view)
-        json_data = json.dumps(cluster_view)
-
-        try:
-            if index:
-                self._client.write(self.key(), json_data, prevIndex=index)
-            else:
-                self._client.write(self.key(), json_data, prevExist=False)
-
-            # We may have just successfully set the local node to
-            # WAITING_TO_LEAVE, in which case we no longer need the leaving
-            # flag.
-            if new_state == constants.WAITING_TO_LEAVE:
-                self._leaving_requested = False
-        except (EtcdAlreadyExist, ValueError):
-            _log.debug("Contention on etcd write - new_state is {}".format(new_state))
-            # Our etcd write failed because someone got there before us.
-
-            if isinstance(new_state, str):
+        contention = RetryPolicy(None, self.MAX_CAS_RETRY_DELAY)
+
+        while True:
+            cluster_view = cluster_info.view.copy()
+
+            # Update the cluster view based on new state information. If
+            # new_state is a string then it refers to the new state of the
+            # local node. Otherwise, it is an overall picture of the new
+            # cluster.
+            if new_state == constants.DELETE_ME:
+                del cluster_view[self._ip]
+            elif isinstance(new_state, str):
+                cluster_view[self._ip] = new_state
+            elif isinstance(new_state, dict):
+                cluster_view = new_state
+
+            _log.debug("Writing state %s into etcd" % cluster_view)
+            json_data = json.dumps(cluster_view)
+
+            try:
+                self.use_endpoint(for_write=True)
+                if index:
+                    result = self._client.write(self.key(), json_data, prevIndex=index)
+                else:
+                    result = self._client.write(self.key(), json_data, prevExist=False)
+                self._retry.succeeded()
+
+                # If the FSM chose this new state, it has already acted on the
+                # cluster state. As long as our write hasn't changed the
+                # cluster state, the FSM has nothing more to do until another
+                # node changes it.
+                if (ignore_echo and
+                    ClusterInfo(json_data).cluster_state == cluster_info.cluster_state):
+                    self.expect_echo(result)
+
+                # We may have just successfully set the local node to
+                # WAITING_TO_LEAVE, in which case we no longer need the leaving
+                # flag.
+                if new_state == constants.WAITING_TO_LEAVE:
+                    self._leaving_requested = False
+                return
+            except (EtcdAlreadyExist, ValueError):
+                _log.debug("Contention on etcd write - new_state is {}".format(new_state))
+                metrics.cas_conflicts.inc(plugin=self.thread_name())
+                # Our etcd write failed because someone got there before us.
+
+                if not isinstance(new_state, str):
+                    # We were changing the whole cluster, based on a view that
+                    # is now out of date.
+                    self._reevaluate()
+                    return
+
+                if contention.attempts >= self.MAX_CAS_RETRIES:
+                    _log.warning("Giving up writing state {} to {} after {} "
+                                 "contended writes".format(new_state,
+                                                           self.key(),
+                                                           contention.attempts + 1))
+                    metrics.cluster_write_contention.inc(key=self.key(),
+                                                         outcome="abandoned")
+                    self._reevaluate()
+                    return
+
                 # We're just trying to update our own state, so it may be safe
                 # to take the new state, update our own state in it, and retry.
-                (etcd_result, idx) = self.read_from_etcd(wait=False)
+                # Back off first, so that the nodes racing us spread out.
+                # The reread mustn't share a read that started before the
+                # write we lost to.
+                contention.pause()
+                (etcd_result, idx) = self.read_from_etcd(wait=False,
+                                                         fresh=True)
                 updated_cluster_info = ClusterInfo(etcd_result)
 
                 # This isn't safe if someone else has changed our state for us,
                 # or the overall deployment state has changed (in which case we
-                # may want to change our state to something else, so check for
-                # that.
+                # may want to change our state to something else).
                 if ((new_state in [constants.ERROR, constants.DELETE_ME]) or
                     ((updated_cluster_info.local_state(self._ip) ==
                      cluster_info.local_state(self._ip)) and
                     (updated_cluster_info.cluster_state ==
                      cluster_info.cluster_state))):
                     _log.debug("Retrying contended write with updated value")
-                    self.write_to_etcd(updated_cluster_info,
-                                       new_state,
-                                       with_index=idx)
-        except Exception as e:
-            # Catch-all error handler (for invalid requests, timeouts, etc -
-            # unset our state and start over.
-            _log.error("{} caught {!r} when trying to write {} with index {}"
-                       " - pause before retrying"
-                       .format(self._ip, e, json_data, self._index))
-            # Setting last_cluster_view to None means that the next successful
-            # read from etcd will trigger the state machine, which will mean
-            # that any necessary work/state changes get retried.
-            self._last_value, self._last_index = None, None
-            # Sleep briefly to avoid hammering a failed server
-            self.pause()
+                    metrics.cluster_write_contention.inc(key=self.key(),
+                                                         outcome="retried")
+                    cluster_info, index = updated_cluster_info, idx
+                    ignore_echo = False
+                else:
+                    self._reevaluate()
+                    return
+            except Exception as e:
+                # Catch-all error handler (for invalid requests, timeouts, etc -
+                # unset our state and start over.
+                _log.error("{} caught {!r} when trying to write {} with index {}"
+                           " - pause before retrying"
+                           .format(self._ip, e, json_data, self._index))
+                # Setting last_cluster_view to None means that the next successful
+                # read from etcd will trigger the state machine, which will mean
+                # that any necessary work/state changes get retried.
+                self._last_value, self._index = None, None
+                # Back off to avoid hammering a failed server
+                self.pause()
+                return
+
+    def _reevaluate(self):
+        # The cluster has moved on since the FSM chose the state we failed to
+        # write. Forget the value we last saw, so that the next read of the
+        # cluster runs the FSM again against its current state.
+        _log.debug("Cluster has changed under us - rerunning the FSM")
+        metrics.cluster_write_contention.inc(key=self.key(),
+                                             outcome="reevaluated")
+        self._last_value = None
@@ -0,0 +1,152 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# Runs a cluster manager plugin's slow hooks (the ones that reconfigure or
+# resync a datastore) on a worker pool, rather than on the synchronizer's
+# thread, so that the synchronizer keeps watching etcd while they run.
+#
+# The FSM asks a HookRunner for a hook's result each time it's in a state that
+# needs the hook. The first time, the hook is started in the background and
+# the FSM is told that it's still running (so it leaves this node's state
+# alone). Once the hook finishes, the runner asks for the FSM to be run again,
+# and this time hands over the hook's result. If the hook raised an
+# AssertionError (which UT plugins use to halt their FSM - see safe_plugin),
+# it's raised again on the FSM's thread at this point instead.
+#
+# While a hook runs, the runner logs a heartbeat every HEARTBEAT_INTERVAL
+# seconds, and publishes how long it's been running as a metric.
+
+import logging
+from threading import Event, Lock, Thread
+from time import time
+
+from concurrent import futures
+
+from metaswitch.clearwater.etcd_shared import metrics
+
+_log = logging.getLogger(__name__)
+
+# Returned by HookRunner.run() while the hook is still running
+PENDING = object()
+
+# The pool shared by every plugin's hooks. Each plugin runs at most one hook
+# at a time.
+MAX_WORKERS = 8
+_pool = None
+_pool_lock = Lock()
+
+
+def hook_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        return _pool
+
+
+class HookRunner(object):
+    HEARTBEAT_INTERVAL = 30
+
+    def __init__(self, call, on_complete):
+        # call(f, cluster_view, new_state) calls the hook (see safe_plugin),
+        # and on_complete() is called once it's finished.
+        self._call = call
+        self._on_complete = on_complete
+        self._lock = Lock()
+
+        # The hook call we're running or have the result of, its result (once
+        # it's finished), any AssertionError it raised, and an Event set when
+        # it's finished.
+        self._key = None
+        self._result = PENDING
+        self._error = None
+        self._done = None
+
+    @staticmethod
+    def _key_for(f, cluster_view, new_state):
+        # The plugins act on which nodes are in the cluster, not on the state
+        # of each, so a hook already running for the same nodes doesn't need
+        # to be run again just because another node's state has changed.
+        return (f.__name__, new_state, frozenset(cluster_view))
+
+    def is_running(self):
+        with self._lock:
+            return self._done is not None and not self._done.is_set()
+
+    def run(self, f, cluster_view, new_state=None):
+        """Returns the result of calling the hook, or PENDING if it's still
+        running (having started it if need be). Raises any AssertionError
+        the hook raised."""
+        key = self._key_for(f, cluster_view, new_state)
+        with self._lock:
+            if key == self._key:
+                if self._result is PENDING:
+                    return PENDING
+                result, error = self._result, self._error
+                self._key, self._result, self._error, self._done = \
+                    None, PENDING, None, None
+                if error is not None:
+                    raise error
+                return result
+
+            if self._done is not None and not self._done.is_set():
+                # A hook for a different cluster is still running. Wait for
+                # it to finish before starting another one.
+                _log.info("Waiting for {} to finish before calling {}".format(
+                              self._key[0], f.__name__))
+                return PENDING
+
+            # Start the hook, forgetting any result that the FSM no longer
+            # wants.
+            self._key, self._result, self._error, self._done = \
+                key, PENDING, None, Event()
+            done = self._done
+
+        _log.info("Starting plugin method {}.{} in the background".format(
+                      f.__self__.__class__.__name__, f.__name__))
+        heartbeat = Thread(target=self._heartbeat,
+                           args=(f, done, time()),
+                           name="HookHeartbeat")
+        heartbeat.daemon = True
+        heartbeat.start()
+        hook_pool().submit(self._run, f, cluster_view, new_state, key, done)
+        return PENDING
+
+    def _run(self, f, cluster_view, new_state, key, done):
+        result = None
+        error = None
+        try:
+            result = self._call(f, cluster_view, new_state)
+        except AssertionError as e:
+            # Passed back to be raised on the FSM's thread, as it would be if
+            # the hook had been called there.
+            _log.exception("Plugin method {} failed an assertion".format(
+                               f.__name__))
+            error = e
+        except Exception:
+            # The FSM carries on without the new state.
+            _log.exception("Plugin method {} failed".format(f.__name__))
+        finally:
+            with self._lock:
+                if self._key == key:
+                    self._result = result
+                    self._error = error
+                done.set()
+        self._on_complete()
+
+    def _heartbeat(self, f, done, start):
+        plugin = f.__self__.__class__.__name__
+        while not done.wait(self.HEARTBEAT_INTERVAL):
+            running = time() - start
+            _log.info("Plugin method {}.{} still running after {:.0f}s".format(
+                          plugin, f.__name__, running))
+            metrics.plugin_hook_running_seconds.set(running,
+                                                    plugin=plugin,
+                                                    hook=f.__name__)
+        metrics.plugin_hook_running_seconds.set(0,
+                                                plugin=plugin,
+                                                hook=f.__name__)
@@ -13,6 +13,10 @@ Usage:
   main.py --mgmt-local-ip=IP --sig-local-ip=IP --local-site=NAME --remote-site=NAME --remote-cassandra-seeds=IPs --uuid=UUID --etcd-key=KEY --etcd-cluster-key=CLUSTER_KEY
           [--signaling-namespace=NAME] [--foreground] [--log-level=LVL]
           [--log-directory=DIR] [--pidfile=FILE] [--cluster-manager-enabled=Y/N]
+          [--etcd-api-version=VER] [--event-loop=Y/N]
+          [--metrics-port=PORT] [--metrics-file=FILE]
+          [--record-events=FILE] [--cluster-layout=LAYOUT]
+          [--scaling-quiet-period=SECS] [--scale-timing-file=FILE]
 
 Options:
   -h --help                      Show this screen.
@@ -30,6 +34,21 @@ Options:
   --log-directory=DIR            Directory to log to [default: ./]
   --pidfile=FILE                 Pidfile to write [default: ./cluster-manager.pid]
   --cluster-manager-enabled=Y/N  Whether the cluster manager should start any threads [default: Yes]
+  --etcd-api-version=VER         Version of the etcd API to use, 2 or 3 [default: 2]
+  --event-loop=Y/N               Whether to run all the plugins from one event loop,
+                                 rather than a thread each [default: N]
+  --metrics-port=PORT            Localhost port to serve metrics on, or 0 for none
+                                 [default: 0]
+  --metrics-file=FILE            File to write metrics to every few seconds
+  --record-events=FILE           File to record the values of the plugins' keys to,
+                                 for replaying offline
+  --cluster-layout=LAYOUT        How each cluster's state is stored in etcd - "view"
+                                 (one key) or "per-node" (a key per node). Every
+                                 node must use the same layout [default: view]
+  --scaling-quiet-period=SECS    Start scaling a cluster once no more nodes have asked
+                                 to join or leave it for this long [default: 5]
+  --scale-timing-file=FILE       File to record each node's state changes to, for
+                                 timing scale operations
 
 """
 
@@ -37,8 +56,18 @@ from docopt import docopt, DocoptExit
 
 from metaswitch.common import logging_config, utils
 from metaswitch.clearwater.etcd_shared.plugin_loader import load_plugins_in_dir
+from metaswitch.clearwater.etcd_shared import etcd_backend, metrics
+from metaswitch.clearwater.etcd_shared.connection_pool import shared_pool_manager
+from metaswitch.clearwater.etcd_shared.sampling_profiler import \
+    install_sigusr2_handler
+from metaswitch.clearwater.etcd_shared.synchronizer_host import SynchronizerHost
 from metaswitch.clearwater.cluster_manager.etcd_synchronizer import EtcdSynchronizer
+from metaswitch.clearwater.cluster_manager.per_node_synchronizer import \
+    PerNodeEtcdSynchronizer, LAYOUTS
 from metaswitch.clearwater.cluster_manager.plugin_base import PluginParams
+from metaswitch.clearwater.cluster_manager.synchronization_fsm import SyncFSM
+from metaswitch.clearwater.cluster_manager.scale_timing import \
+    ScaleTimingRecorder
 from metaswitch.clearwater.cluster_manager import pdlogs
 import logging
 import os
@@ -71,6 +100,55 @@ def install_sigquit_handler(plugins):
         should_quit = True
     signal.signal(signal.SIGQUIT, sigquit_handler)
 
+def add_synchronizers(host, params, cluster_manager_enabled="Y",
+                      layout="view", scale_timing_file=None):
+    """Loads the cluster manager's plugins, and adds a synchronizer for each
+    to the SynchronizerHost. Returns the synchronizers added."""
+    if layout == "per-node":
+        synchronizer_class = PerNodeEtcdSynchronizer
+    else:
+        synchronizer_class = EtcdSynchronizer
+
+    plugins_dir = "/usr/share/clearwater/clearwater-cluster-manager/plugins/"
+    plugins = load_plugins_in_dir(plugins_dir, params, lazy=True)
+    plugins.sort(key=lambda x: x.key())
+    plugins_to_use = []
+    files = []
+    skip = False
+    for plugin in plugins:
+        for plugin_file in plugin.files():
+            if plugin_file in files:
+                _log.info("Skipping plugin {} because {} "
+                          "is already managed by another plugin"
+                          .format(plugin, plugin_file))
+                skip = True
+
+        if not skip:
+            plugins_to_use.append(plugin)
+            files.extend(plugin.files())
+
+    scale_timing = None
+    if scale_timing_file:
+        scale_timing = ScaleTimingRecorder(scale_timing_file)
+        host.add_service(scale_timing)
+
+    synchronizers = []
+    if cluster_manager_enabled == "N":
+        # Don't start any threads as we don't want the cluster manager to run
+        pdlogs.DO_NOT_START.log()
+    elif params.etcd_cluster_key == "DO_NOT_CLUSTER":
+        # Don't start any threads as we don't want this box to cluster
+        pdlogs.DO_NOT_CLUSTER.log()
+    else:
+        for plugin in plugins_to_use:
+            syncer = synchronizer_class(plugin, params.ip, etcd_ip=params.mgmt_ip)
+            syncer.set_scale_timing(scale_timing)
+            host.add(syncer)
+            synchronizers.append(syncer)
+            _log.info("Loaded plugin %s" % plugin)
+
+    return synchronizers
+
 def main(args):
     syslog.openlog("cluster-manager", syslog.LOG_PID)
     pdlogs.STARTUP.log()
@@ -94,11 +172,17 @@ def main(args):
     etcd_key = arguments.get('--etcd-key')
     etcd_cluster_key = arguments.get('--etcd-cluster-key')
     cluster_manager_enabled = arguments['--cluster-manager-enabled']
+    cluster_layout = arguments['--cluster-layout']
+    SyncFSM.QUIET_PERIOD = float(arguments['--scaling-quiet-period'])
     log_dir = arguments['--log-directory']
     log_level = LOG_LEVELS.get(arguments['--log-level'], logging.DEBUG)
 
     stdout_err_log = os.path.join(log_dir, "cluster-manager.output.log")
 
+    if cluster_layout not in LAYOUTS:
+        pdlogs.EXITING_BAD_CONFIG.log()
+        exit(1)
+
     # Check that there's an etcd_cluster_key value passed to the cluster
     # manager
     if etcd_cluster_key == "":
@@ -114,6 +198,7 @@ def main(args):
     prctl.prctl(prctl.NAME, "cw-cluster-mgr")
 
     logging_config.configure_logging(log_level, log_dir, "cluster-manager", show_thread=True)
+    etcd_backend.set_api_version(arguments['--etcd-api-version'])
 
     # urllib3 logs a WARNING log whenever it recreates a connection, but our
     # etcd usage does this frequently (to allow watch timeouts), so deliberately
@@ -122,6 +207,7 @@ def main(args):
     urllib_logger.setLevel(logging.ERROR)
 
     utils.install_sigusr1_handler("cluster-manager")
+    install_sigusr2_handler(log_dir, "cluster-manager")
 
     # Drop a pidfile. We must keep a reference to the file object here, as this keeps
     # the file locked and provides extra protection against two processes running at
@@ -133,70 +219,43 @@ def main(args):
         # We failed to take the lock - another process is already running
         exit(1)
 
-    plugins_dir = "/usr/share/clearwater/clearwater-cluster-manager/plugins/"
-    plugins = load_plugins_in_dir(plugins_dir,
-                                  PluginParams(ip=sig_ip,
-                                               mgmt_ip=mgmt_ip,
-                                               local_site=local_site_name,
-                                               remote_site=remote_site_name,
-                                               remote_cassandra_seeds=remote_cassandra_seeds,
-                                               signaling_namespace=signaling_namespace,
-                                               uuid=local_uuid,
-                                               etcd_key=etcd_key,
-                                               etcd_cluster_key=etcd_cluster_key))
-    plugins.sort(key=lambda x: x.key())
-    plugins_to_use = []
-    files = []
-    skip = False
-    for plugin in plugins:
-        for plugin_file in plugin.files():
-            if plugin_file in files:
-                _log.info("Skipping plugin {} because {} "
-                          "is already managed by another plugin"
-                          .format(plugin, plugin_file))
-                skip = True
-
-        if not skip:
-            plugins_to_use.append(plugin)
-            files.extend(plugin.files())
-
-    synchronizers = []
-    threads = []
-
-    if cluster_manager_enabled == "N":
-        # Don't start any threads as we don't want the cluster manager to run
-        pdlogs.DO_NOT_START.log()
-    elif etcd_cluster_key == "DO_NOT_CLUSTER":
-        # Don't start any threads as we don't want this box to cluster
-        pdlogs.DO_NOT_CLUSTER.log()
-    else:
-        # Load the plugins, but don't start them until we've installed the
-        # SIGTERM handler, as that handler will gracefully shut down any
-        # remaining synchronizers on receiving a SIGTERM
-        for plugin in plugins_to_use:
-            syncer = EtcdSynchronizer(plugin, sig_ip, etcd_ip=mgmt_ip)
-            synchronizers.append(syncer)
-            threads.append(syncer.thread)
-            _log.info("Loaded plugin %s" % plugin)
-
+    host = SynchronizerHost(etcd_key,
+                            mgmt_ip,
+                            event_loop=(arguments['--event-loop'] == "Y"))
+    if arguments['--record-events']:
+        host.record_events(arguments['--record-events'])
 
+    synchronizers = add_synchronizers(
+                        host,
+                        PluginParams(ip=sig_ip,
+                                     mgmt_ip=mgmt_ip,
+                                     local_site=local_site_name,
+                                     remote_site=remote_site_name,
+                                     remote_cassandra_seeds=remote_cassandra_seeds,
+                                     signaling_namespace=signaling_namespace,
+                                     uuid=local_uuid,
+                                     etcd_key=etcd_key,
+                                     etcd_cluster_key=etcd_cluster_key),
+                        cluster_manager_enabled,
+                        cluster_layout,
+                        arguments['--scale-timing-file'])
     install_sigquit_handler(synchronizers)
-    utils.install_sigterm_handler(synchronizers)
 
-    # If we have any plugins, start their threads now
-    for syncer in synchronizers:
-        syncer.start_thread()
-        _log.info("Started thread for plugin %s" % syncer._plugin)
+    for service in metrics.metrics_services(arguments['--metrics-port'],
+                                            arguments['--metrics-file']):
+        host.add_service(service)
 
-    while any([thread.isAlive() for thread in threads]):
-        for thread in threads:
-            if thread.isAlive():
-                thread.join(1)
+    # Start the plugins (having installed the SIGTERM handler, which
+    # gracefully shuts down any remaining synchronizers on receiving a
+    # SIGTERM), and wait for them to finish
+    host.start()
+    host.wait()
 
     _log.info("No plugin threads running, waiting for a SIGTERM or SIGQUIT")
     while not utils.should_quit and not should_quit:
         sleep(1)
     _log.info("Quitting")
+    shared_pool_manager().log_stats()
     _log.debug("%d threads outstanding at exit" % activeCount())
     pdlogs.EXITING.log()
     syslog.closelog()
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# An alternative layout for a cluster's state in etcd. Rather than one JSON
+# blob (written by every node with prevIndex, so that nodes acknowledging the
+# same phase of a scale operation collide and retry), each node's state is in
+# its own key under a directory:
+#
+#   <plugin key>_nodes/<node IP> = <node state>
+#
+# Each node writes only its own key, so nodes never contend with each other
+# for their own state changes. The cluster view is built from a recursive
+# read of the directory, serialised as the same JSON as the blob layout, so
+# ClusterInfo and SyncFSM are unchanged.
+#
+# Every node in a deployment must use the same layout.
+
+import json
+import logging
+
+from etcd import EtcdResult, EtcdAlreadyExist, EtcdKeyNotFound
+
+import constants
+from .cluster_state import ClusterInfo
+from .etcd_synchronizer import EtcdSynchronizer
+from metaswitch.clearwater.etcd_shared import metrics
+
+_log = logging.getLogger(__name__)
+
+LAYOUTS = ("view", "per-node")
+
+
+def node_directory(key):
+    return key.rstrip("/") + "_nodes"
+
+
+def view_from_result(result):
+    """Returns the cluster view ({node IP: state}) in a recursive read of a
+    cluster's directory, and the modifiedIndex of each node's key."""
+    view = {}
+    indexes = {}
+    for leaf in result.leaves:
+        if leaf.dir:
+            # An empty directory's only "leaf" is the directory itself.
+            continue
+        ip = leaf.key.rstrip("/").rsplit("/", 1)[1]
+        view[ip] = leaf.value
+        indexes[ip] = leaf.modifiedIndex
+    return view, indexes
+
+
+class PerNodeEtcdSynchronizer(EtcdSynchronizer):
+    SUBTREE = True
+
+    # The most views to remember the node keys' indexes for. See
+    # write_to_etcd().
+    MAX_VIEWS = 8
+
+    def __init__(self, *args, **kwargs):
+        super(PerNodeEtcdSynchronizer, self).__init__(*args, **kwargs)
+
+        # The modifiedIndex of each node's key, for each cluster view we've
+        # recently read, so that we only change a node's state if it's still
+        # the state we read.
+        self._node_indexes = {}
+
+    def key(self):
+        return node_directory(self._plugin.key())
+
+    def node_key(self, ip):
+        return self.key() + "/" + ip
+
+    def quorum_read(self, timeout=None, fresh=False):
+        # Read every node's key, and return the cluster view as if it had been
+        # read from a single key. Its index is the etcd index of the read,
+        # which covers every change to any node's key (including deletions).
+        try:
+            result = super(PerNodeEtcdSynchronizer, self).quorum_read(timeout,
+                                                                      fresh)
+            view, indexes = view_from_result(result)
+            etcd_index = result.etcd_index
+        except EtcdKeyNotFound as e:
+            # No node has joined the cluster yet.
+            view, indexes = {}, {}
+            etcd_index = e.payload["index"]
+
+        value = json.dumps(view, sort_keys=True)
+        if len(self._node_indexes) >= self.MAX_VIEWS:
+            self._node_indexes.clear()
+        self._node_indexes[value] = indexes
+
+        view_result = EtcdResult(None, {})
+        view_result.key = self.key()
+        view_result.value = value
+        view_result.modifiedIndex = etcd_index
+        view_result.etcd_index = etcd_index
+        return view_result
+
+    def process(self, etcd_value, old_value):
+        if etcd_value is not None:
+            cluster_info = ClusterInfo(etcd_value)
+            new_state = self.reconcile(cluster_info)
+            if new_state is not None:
+                self.write_to_etcd(cluster_info, new_state)
+                return
+        super(PerNodeEtcdSynchronizer, self).process(etcd_value, old_value)
+
+    def reconcile(self, cluster_info):
+        """Nodes no longer switch the whole cluster into JOINING or LEAVING
+        state in one write, so the cluster can be caught part way through
+        the switch, or with a node that asked to join or leave just after the
+        switch. Either way the cluster state is invalid, and no node's FSM
+        will act. Returns the state this node should move to to fix that, if
+        it's one of the nodes waiting to join or leave."""
+        if cluster_info.cluster_state != constants.INVALID_CLUSTER_STATE:
+            return None
+
+        local_state = cluster_info.local_state(self._ip)
+        view = cluster_info.view
+        if local_state == constants.WAITING_TO_JOIN:
+            switch = self._fsm._switch_all_to_joining
+            switched_state = constants.JOINING
+            withdrawn_state = constants.DELETE_ME
+        elif local_state == constants.WAITING_TO_LEAVE:
+            switch = self._fsm._switch_all_to_leaving
+            switched_state = constants.LEAVING
+            withdrawn_state = constants.NORMAL
+        else:
+            return None
+
+        others = dict((ip, state) for ip, state in view.iteritems()
+                      if ip != self._ip)
+        if (cluster_info.calculate_cluster_state(switch(view)) !=
+            constants.INVALID_CLUSTER_STATE):
+            # Another node has started switching the cluster, so finish the
+            # switch for this node.
+            _log.info("Cluster is part way through switching to {}".format(
+                          switched_state))
+            return switched_state
+        elif (cluster_info.calculate_cluster_state(others) !=
+              constants.INVALID_CLUSTER_STATE):
+            # The cluster switched without this node, so back out, and try
+            # again when the cluster is next stable.
+            _log.info("Cluster has moved on without this node - "
+                      "withdrawing from {}".format(local_state))
+            if local_state == constants.WAITING_TO_LEAVE:
+                self._leaving_requested = True
+            return withdrawn_state
+        return None
+
+    def write_to_etcd(self, cluster_info, new_state, with_index=None,
+                      ignore_echo=False):
+        view = cluster_info.view
+        indexes = self._node_indexes.get(json.dumps(view, sort_keys=True))
+        if indexes is None:
+            # We don't know which version of each node's key this view came
+            # from, so we can't safely change it. Read it again.
+            _log.debug("Cluster view {} is out of date".format(view))
+            self._last_value = None
+            return
+
+        # Work out which nodes' keys to change, and the index each key must
+        # still have - or 0 if it mustn't exist yet, or None to change it
+        # regardless.
+        changes = []
+        if new_state == constants.DELETE_ME:
+            changes.append((self._ip, None, None))
+        elif new_state == constants.ERROR:
+            changes.append((self._ip, new_state, None))
+        elif isinstance(new_state, str):
+            changes.append((self._ip, new_state, indexes.get(self._ip, 0)))
+        elif isinstance(new_state, dict):
+            for ip, state in new_state.iteritems():
+                if view.get(ip) != state:
+                    changes.append((ip, state, indexes.get(ip, 0)))
+            for ip in view:
+                if ip not in new_state:
+                    changes.append((ip, None, indexes[ip]))
+
+        result = None
+        try:
+            self.use_endpoint(for_write=True)
+            for ip, state, prev_index in changes:
+                result = self._write_node(ip, state, prev_index) or result
+            self._retry.succeeded()
+        except Exception as e:
+            # Catch-all error handler (for invalid requests, timeouts, etc -
+            # unset our state and start over.
+            _log.error("{} caught {!r} when trying to write {} - pause before "
+                       "retrying".format(self._ip, e, new_state))
+            self._last_value = None
+            self.pause()
+            return
+
+        if isinstance(new_state, str):
+            new_view = view.copy()
+            if new_state == constants.DELETE_ME:
+                new_view.pop(self._ip, None)
+            else:
+                new_view[self._ip] = new_state
+
+            # As for EtcdSynchronizer.write_to_etcd().
+            if (ignore_echo and
+                result is not None and
+                cluster_info.calculate_cluster_state(new_view) ==
+                cluster_info.cluster_state):
+                self.expect_echo(result)
+
+            if (new_state == constants.WAITING_TO_LEAVE and
+                result is not None):
+                self._leaving_requested = False
+
+    def _write_node(self, ip, state, prev_index):
+        # Writes a node's state (or deletes its key, if state is None). Returns
+        # the EtcdResult, or None if the key had changed (or, for a delete,
+        # didn't exist) - in which case we'll see the change, and act on it,
+        # when we next read the cluster.
+        key = self.node_key(ip)
+        _log.debug("Writing state {} for {} into etcd".format(state, ip))
+        try:
+            if state is None:
+                if prev_index:
+                    return self._client.delete(key, prevIndex=prev_index)
+                return self._client.delete(key)
+            elif prev_index:
+                return self._client.write(key, state, prevIndex=prev_index)
+            elif prev_index == 0:
+                return self._client.write(key, state, prevExist=False)
+            else:
+                return self._client.write(key, state)
+        except (EtcdAlreadyExist, EtcdKeyNotFound, ValueError):
+            _log.debug("Contention on etcd write of {} for {}".format(state,
+                                                                       ip))
+            metrics.cas_conflicts.inc(plugin=self.thread_name())
+            metrics.cluster_write_contention.inc(key=self.key(),
+                                                 outcome="reevaluated")
+            return None
@@ -39,6 +39,14 @@ class SynchroniserPluginBase(object): # pragma: no cover
         """Allows a plugin to monitor, but not join, a remote cluster"""
         return True
 
+    def expected_cluster_size(self):
+
+        """The number of nodes the cluster is being scaled to, if known. Once
+        enough nodes are waiting to join (or few enough would be left once the
+        nodes waiting to leave have gone), the scaling operation starts
+        straight away, rather than waiting to see if more nodes arrive"""
+        return None
+
     def on_startup(self, cluster_view):
         # Most of our plugins don't want to do anything on startup, so this
         # isn't marked as an @abstractmethod which they must implement.
@@ -0,0 +1,260 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""Records how long each node spends in each state during scale operations.
+
+Each synchronizer passes every cluster view it sees to a ScaleTimingRecorder,
+which writes a line of JSON to its file whenever a node's state changes:
+
+  {"t": <time>, "key": <cluster key>, "nodes": {<node IP>: <new state>}}
+
+where the state is null if the node has left the cluster. The first line for
+each key after the cluster manager starts has "snapshot": true, and lists
+every node. A node's state only changes a handful of times per scale
+operation, so the file stays small.
+
+Every node sees the whole cluster, so one node's file has the timings of
+every node. This module's main() reads it back (from this node's file, if no
+file is given) and shows, for each scale operation, how long the cluster
+spent in each phase and which node held up each phase.
+
+Usage:
+  scale_timing.py [--key=KEY] [--nodes] [--json] [<file>]
+
+Options:
+  -h --help                      Show this screen.
+  --key=KEY                      Only show the cluster with this key
+  --nodes                        Also show when each node entered each state
+  --json                         Print the phases of each operation as JSON
+
+"""
+
+from docopt import docopt
+import json
+import logging
+from datetime import datetime
+from threading import Lock
+from time import time
+
+from metaswitch.clearwater.cluster_manager import constants
+from metaswitch.clearwater.cluster_manager.cluster_state import ClusterInfo
+
+_log = logging.getLogger(__name__)
+
+DEFAULT_FILE = \
+    "/var/log/clearwater-cluster-manager/cluster-manager-scale-timing.log"
+
+# Cluster states in which no scale operation is in progress
+SETTLED_STATES = [constants.EMPTY,
+                  constants.STABLE,
+                  constants.STABLE_WITH_ERRORS]
+
+
+class ScaleTimingRecorder(object):
+    def __init__(self, path):
+        self._path = path
+        self._lock = Lock()
+        self._file = None
+
+        # The last view recorded for each key
+        self._views = {}
+
+    def start_thread(self):
+        # There's no thread - we write on the synchronizers' threads - but
+        # this lets a SynchronizerHost open and close the file.
+        with self._lock:
+            try:
+                self._file = open(self._path, "a")
+                _log.info("Recording scale timings to {}".format(self._path))
+            except IOError as e:
+                _log.warning("Failed to open {} to record scale timings: {!r}".
+                             format(self._path, e))
+
+    def terminate(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def observe(self, key, view):
+        with self._lock:
+            old_view = self._views.get(key)
+            if old_view is None:
+                record = {"nodes": view, "snapshot": True}
+            else:
+                changes = dict((ip, state) for ip, state in view.iteritems()
+                               if old_view.get(ip) != state)
+                changes.update((ip, None) for ip in old_view
+                               if ip not in view)
+                if not changes:
+                    return
+                record = {"nodes": changes}
+            self._views[key] = dict(view)
+
+            if self._file is not None:
+                record.update({"t": round(time(), 3), "key": key})
+                self._file.write(json.dumps(record, sort_keys=True) + "\n")
+                self._file.flush()
+
+
+def load_records(f):
+    """Returns the records in a scale timing file, skipping any line that
+    was only partly written."""
+    records = []
+    for line in f:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            pass
+    return records
+
+
+def _replay(records, key):
+    # Yields the time and cluster view after each record for the key, and
+    # the nodes whose state it changed.
+    view = {}
+    for record in records:
+        if record["key"] != key:
+            continue
+        nodes = record["nodes"]
+        if record.get("snapshot"):
+            changed = set(ip for ip in set(view) | set(nodes)
+                          if view.get(ip) != nodes.get(ip))
+            view = dict(nodes)
+        else:
+            changed = set(nodes)
+            for ip, state in nodes.iteritems():
+                if state is None:
+                    view.pop(ip, None)
+                else:
+                    view[ip] = state
+        yield record["t"], dict(view), changed
+
+
+def node_timings(records, key):
+    """Returns when each node entered and left each state, as a list of
+    (node IP, state, entered, left) - where left is None if the node is
+    still in that state."""
+    entered = {}
+    timings = []
+    for t, view, changed in _replay(records, key):
+        for ip in sorted(changed):
+            if ip in entered:
+                state, since = entered.pop(ip)
+                timings.append((ip, state, since, t))
+            if ip in view:
+                entered[ip] = (view[ip], t)
+    for ip, (state, since) in sorted(entered.iteritems()):
+        timings.append((ip, state, since, None))
+    return sorted(timings, key=lambda timing: timing[2])
+
+
+def scale_operations(records, key):
+    """Splits the history of a cluster into scale operations - each time
+    the cluster left a stable state until it got back to one. Returns a
+    list of operations, each a list of phases (one per cluster state) as
+    dictionaries giving the cluster state, when the phase started and ended
+    (None if it hasn't), how long each node took to change state during the
+    phase, and which node took longest."""
+    calculator = ClusterInfo("{}")
+    operations = []
+    phase = None
+    for t, view, changed in _replay(records, key):
+        if phase is not None:
+            for ip in changed:
+                phase["nodes"].setdefault(ip, round(t - phase["start"], 3))
+
+        cluster_state = calculator.calculate_cluster_state(view)
+        if phase is not None and cluster_state == phase["state"]:
+            continue
+
+        if phase is not None:
+            phase["end"] = t
+            if phase["nodes"]:
+                phase["slowest"] = max(phase["nodes"].iteritems(),
+                                       key=lambda node: node[1])[0]
+
+        if cluster_state in SETTLED_STATES:
+            phase = None
+        else:
+            if phase is None:
+                operations.append([])
+            phase = {"state": cluster_state,
+                     "start": t,
+                     "end": None,
+                     "nodes": {},
+                     "slowest": None}
+            operations[-1].append(phase)
+    return operations
+
+
+def format_operations(key, operations, timings=None):
+    output = []
+    for phases in operations:
+        start = phases[0]["start"]
+        end = phases[-1]["end"]
+        output.append("{} - scale operation at {}, {}".format(
+            key,
+            datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S"),
+            "took {:.1f}s".format(end - start) if end else "still running"))
+        for phase in phases:
+            if phase["end"] is None or phase["slowest"] is None:
+                output.append("  {:<28} {}".format(
+                    phase["state"],
+                    "(in progress)" if phase["end"] is None else
+                    "{:>8.1f}s".format(phase["end"] - phase["start"])))
+                continue
+            output.append("  {:<28} {:>8.1f}s  slowest {} ({:.1f}s)".format(
+                phase["state"],
+                phase["end"] - phase["start"],
+                phase["slowest"],
+                phase["nodes"][phase["slowest"]]))
+
+        if timings is not None:
+            for ip, state, entered, left in timings:
+                if entered < start or (end is not None and entered >= end):
+                    continue
+                output.append("    {:>9.1f}s  {:<16} {:<30} {}".format(
+                    entered - start,
+                    ip,
+                    state,
+                    "{:.1f}s".format(left - entered) if left else "").rstrip())
+    return "\n".join(output)
+
+
+def main(args=None):
+    arguments = docopt(__doc__, argv=args)
+
+    with open(arguments["<file>"] or DEFAULT_FILE) as f:
+        records = load_records(f)
+    keys = sorted(set(record["key"] for record in records))
+    if arguments["--key"]:
+        keys = [key for key in keys if key == arguments["--key"]]
+
+    if arguments["--json"]:
+        print json.dumps(dict((key, scale_operations(records, key))
+                              for key in keys),
+                         indent=2,
+                         sort_keys=True)
+        return
+
+    output = []
+    for key in keys:
+        operations = scale_operations(records, key)
+        if operations:
+            timings = (node_timings(records, key)
+                       if arguments["--nodes"] else None)
+            output.append(format_operations(key, operations, timings))
+
+    if output:
+        print "\n".join(output)
+    else:
+        print "No scale operations found"
+
+
+if __name__ == '__main__': # pragma: no cover
+    main()
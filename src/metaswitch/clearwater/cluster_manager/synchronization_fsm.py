@@ -6,10 +6,12 @@
 # Metaswitch Networks in a separate written agreement.
 
 
-from time import sleep
+from time import sleep, time
 import constants
 from .alarms import TooLongAlarm
+from .hook_runner import PENDING
 from . import pdlogs
+from metaswitch.clearwater.etcd_shared import metrics
 import logging
 
 _log = logging.getLogger("cluster_manager.synchronization_fsm")
@@ -24,13 +26,17 @@ def safe_plugin(f, cluster_view, new_state=None):
                          f.__name__))
         # Call into the plugin, and if it doesn't throw an exception,
         # return the state we should move into.
-        f(cluster_view)
+        with metrics.plugin_hook_seconds.time(
+                 plugin=f.__self__.__class__.__name__, hook=f.__name__):
+            f(cluster_view)
         return new_state
     except AssertionError: # pragma: no cover
         # Allow UT plugins to assert things, halt their FSM, and be noticed more
         # easily.
         raise
     except Exception as e:
+        metrics.plugin_hook_errors.inc(plugin=f.__self__.__class__.__name__,
+                                       hook=f.__name__)
         # If the plugin fails (which is unexpected), log the error and then
         # return None. This will keep this node in the same state, pausing the
         # scale-up (which will raise an alarm) until someone looks into it and
@@ -47,18 +53,36 @@ def safe_plugin(f, cluster_view, new_state=None):
 
 class SyncFSM(object):
 
-    # The number of seconds to wait in WAITING_TO_JOIN/WAITING_TO_LEAVE state
-    # before switching into JOINING/LEAVING state. Defined as a class constant
-    # for easy overriding in UT.
+    # The longest number of seconds to wait in WAITING_TO_JOIN/WAITING_TO_LEAVE
+    # state before switching into JOINING/LEAVING state. Defined as a class
+    # constant for easy overriding in UT.
     DELAY = 30
 
-    def __init__(self, plugin, local_ip):
+    # Switch sooner than DELAY once no more nodes have started waiting to join
+    # or leave for this many seconds.
+    QUIET_PERIOD = 5
+
+    def __init__(self, plugin, local_ip, recheck_after=None, hooks=None):
         self._plugin = plugin
         self._id = local_ip
         self._running = True
         self._startup = True
         self._alarm = TooLongAlarm()
 
+        # Called with a number of seconds, after which next() should be called
+        # again with the current cluster state even if it hasn't changed. If
+        # there isn't one, we sleep instead.
+        self._recheck_after = recheck_after
+
+        # While the cluster is in JOIN_PENDING or LEAVE_PENDING state, the
+        # nodes waiting to join or leave, when we started waiting, and when
+        # the last of them started waiting. See _quiescent().
+        self._window = None
+
+        # Runs the plugin's slow hooks in the background (see HookRunner). If
+        # there isn't one, they're called synchronously.
+        self._hooks = hooks
+
     def quit(self):
         self._alarm.quit()
 
@@ -73,6 +97,57 @@ class SyncFSM(object):
         return {k: (constants.LEAVING if v == constants.WAITING_TO_LEAVE else v)
                 for k, v in cluster_view.iteritems()}
 
+    def _quiescent(self, cluster_view, waiting_state, staying_states):
+        """Returns whether it's time to switch the nodes in waiting_state into
+        JOINING/LEAVING state - either no more nodes have started waiting
+        for QUIET_PERIOD, or the cluster will be the size the plugin expects
+        once they've joined or left, or we've waited for DELAY."""
+        now = time()
+        waiting = frozenset(ip for ip, state in cluster_view.iteritems()
+                            if state == waiting_state)
+        if self._window is None or self._window[0] != waiting_state:
+            self._window = (waiting_state, waiting, now, now)
+        elif waiting != self._window[1]:
+            self._window = (waiting_state, waiting, self._window[2], now)
+        _, _, started, last_change = self._window
+
+        expected_size = getattr(self._plugin,
+                                "expected_cluster_size",
+                                lambda: None)()
+        size = len([state for state in cluster_view.itervalues()
+                    if state in staying_states])
+
+        if (size == expected_size or
+            now >= last_change + SyncFSM.QUIET_PERIOD or
+            now >= started + SyncFSM.DELAY):
+            _log.info("Waited {:.1f}s for nodes to finish arriving in {} "
+                      "state".format(now - started, waiting_state))
+            self._window = None
+            return True
+
+        wait = min(last_change + SyncFSM.QUIET_PERIOD,
+                   started + SyncFSM.DELAY) - now
+        _log.info("Waiting up to {:.1f}s in case more nodes enter {} "
+                  "state".format(wait, waiting_state))
+        if self._recheck_after is None:
+            sleep(wait)
+            return self._quiescent(cluster_view, waiting_state, staying_states)
+        self._recheck_after(wait)
+        return False
+
+    def _call_hook(self, f, cluster_view, new_state):
+        """Calls a plugin hook that may take a long time (e.g. to resync a
+        datastore). Returns the state to move to once it's finished, or
+        PENDING if it's still running in the background."""
+        if self._hooks is None:
+            return safe_plugin(f, cluster_view, new_state=new_state)
+        return self._hooks.run(f, cluster_view, new_state)
+
+    def _call_plugin(self, f, cluster_view, new_state):
+        # Leave this node's state alone while the hook is running.
+        result = self._call_hook(f, cluster_view, new_state)
+        return None if result is PENDING else result
+
     def _log_joining_nodes(self, cluster_view):
         for node, state in cluster_view.iteritems():
             if state in [constants.JOINING, constants.JOINING_ACKNOWLEDGED_CHANGE]:
@@ -112,6 +187,12 @@ class SyncFSM(object):
                         cluster_view)
             self._startup = False
 
+        # Any wait for more nodes to join or leave ends once the cluster has
+        # moved on.
+        if cluster_state not in [constants.JOIN_PENDING,
+                                 constants.LEAVE_PENDING]:
+            self._window = None
+
         # If we're mid-scale-up, ensure that the "scaling operation taking too
         # long" alarm is running, and cancel it if we're not
         if local_state == constants.NORMAL:
@@ -163,17 +244,20 @@ class SyncFSM(object):
 
         # States for joining a cluster
 
-        # If we're waiting to join, pause for SyncFSM.DELAY seconds (to allow
-        # other new nodes to come online, and avoid repeating scale-up sveral
-        # times), then move all WAITING_TO_JOIN nodes into JOINING state in
-        # order to kick off scale-up.
+        # If we're waiting to join, wait until other new nodes have stopped
+        # coming online (to avoid repeating scale-up several times), then move
+        # all WAITING_TO_JOIN nodes into JOINING state in order to kick off
+        # scale-up. See _quiescent().
 
         # Existing nodes (in NORMAL state) should do nothing.
 
         elif (cluster_state == constants.JOIN_PENDING and
                 local_state == constants.WAITING_TO_JOIN):
-            _log.info("Pausing for %d seconds in case more nodes are joining the cluster" % SyncFSM.DELAY)
-            sleep(SyncFSM.DELAY)
+            if not self._quiescent(cluster_view,
+                                   constants.WAITING_TO_JOIN,
+                                   [constants.NORMAL,
+                                    constants.WAITING_TO_JOIN]):
+                return None
             return self._switch_all_to_joining(cluster_view)
         elif (cluster_state == constants.JOIN_PENDING and
                 local_state == constants.NORMAL):
@@ -217,14 +301,14 @@ class SyncFSM(object):
             return None
         elif (cluster_state == constants.JOINING_CONFIG_CHANGING and
                 local_state == constants.NORMAL_ACKNOWLEDGED_CHANGE):
-            return safe_plugin(self._plugin.on_cluster_changing,
-                               cluster_view,
-                               new_state=constants.NORMAL_CONFIG_CHANGED)
+            return self._call_plugin(self._plugin.on_cluster_changing,
+                                     cluster_view,
+                                     new_state=constants.NORMAL_CONFIG_CHANGED)
         elif (cluster_state == constants.JOINING_CONFIG_CHANGING and
                 local_state == constants.JOINING_ACKNOWLEDGED_CHANGE):
-            return safe_plugin(self._plugin.on_joining_cluster,
-                               cluster_view,
-                               new_state=constants.JOINING_CONFIG_CHANGED)
+            return self._call_plugin(self._plugin.on_joining_cluster,
+                                     cluster_view,
+                                     new_state=constants.JOINING_CONFIG_CHANGED)
 
         # JOINING_RESYNCING state starts when everyone has updated their
         # config, and ends when everyone has resynchronised their data around
@@ -239,27 +323,28 @@ class SyncFSM(object):
             return None
         elif (cluster_state == constants.JOINING_RESYNCING and
                 local_state == constants.NORMAL_CONFIG_CHANGED):
-            return safe_plugin(self._plugin.on_new_cluster_config_ready,
-                               cluster_view,
-                               new_state=constants.NORMAL)
+            return self._call_plugin(self._plugin.on_new_cluster_config_ready,
+                                     cluster_view,
+                                     new_state=constants.NORMAL)
         elif (cluster_state == constants.JOINING_RESYNCING and
                 local_state == constants.JOINING_CONFIG_CHANGED):
-            return safe_plugin(self._plugin.on_new_cluster_config_ready,
-                               cluster_view,
-                               new_state=constants.NORMAL)
+            return self._call_plugin(self._plugin.on_new_cluster_config_ready,
+                                     cluster_view,
+                                     new_state=constants.NORMAL)
 
         # States for leaving a cluster
 
-        # If we're waiting to leave, pause for SyncFSM.DELAY seconds (to allow
-        # other leaving nodes to enter this state), then move all
-        # WAITING_TO_LEAVE nodes into LEAVING state in order to kick off
-        # scale-down.
+        # If we're waiting to leave, wait until other leaving nodes have
+        # stopped entering this state, then move all WAITING_TO_LEAVE nodes
+        # into LEAVING state in order to kick off scale-down.
 
         # Remaining nodes (in NORMAL state) should do nothing.
         elif (cluster_state == constants.LEAVE_PENDING and
                 local_state == constants.WAITING_TO_LEAVE):
-            _log.info("Pausing for %d seconds in case more nodes are leaving the cluster" % SyncFSM.DELAY)
-            sleep(SyncFSM.DELAY)
+            if not self._quiescent(cluster_view,
+                                   constants.WAITING_TO_LEAVE,
+                                   [constants.NORMAL]):
+                return None
             return self._switch_all_to_leaving(cluster_view)
         elif (cluster_state == constants.LEAVE_PENDING and
                 local_state == constants.NORMAL):
@@ -303,14 +388,14 @@ class SyncFSM(object):
                 return None
         elif (cluster_state == constants.LEAVING_CONFIG_CHANGING and
                 local_state == constants.NORMAL_ACKNOWLEDGED_CHANGE):
-            return safe_plugin(self._plugin.on_cluster_changing,
-                               cluster_view,
-                               new_state=constants.NORMAL_CONFIG_CHANGED)
+            return self._call_plugin(self._plugin.on_cluster_changing,
+                                     cluster_view,
+                                     new_state=constants.NORMAL_CONFIG_CHANGED)
         elif (cluster_state == constants.LEAVING_CONFIG_CHANGING and
                 local_state == constants.LEAVING_ACKNOWLEDGED_CHANGE):
-            return safe_plugin(self._plugin.on_cluster_changing,
-                               cluster_view,
-                               new_state=constants.LEAVING_CONFIG_CHANGED)
+            return self._call_plugin(self._plugin.on_cluster_changing,
+                                     cluster_view,
+                                     new_state=constants.LEAVING_CONFIG_CHANGED)
 
         # LEAVING_RESYNCING state starts when everyone has updated their
         # config, and ends when everyone has resynchronised their data around
@@ -328,14 +413,14 @@ class SyncFSM(object):
             return None
         elif (cluster_state == constants.LEAVING_RESYNCING and
                 local_state == constants.LEAVING_CONFIG_CHANGED):
-            return safe_plugin(self._plugin.on_new_cluster_config_ready,
-                               cluster_view,
-                               new_state=constants.FINISHED)
+            return self._call_plugin(self._plugin.on_new_cluster_config_ready,
+                                     cluster_view,
+                                     new_state=constants.FINISHED)
         elif (cluster_state == constants.LEAVING_RESYNCING and
                 local_state == constants.NORMAL_CONFIG_CHANGED):
-            return safe_plugin(self._plugin.on_new_cluster_config_ready,
-                               cluster_view,
-                               new_state=constants.NORMAL)
+            return self._call_plugin(self._plugin.on_new_cluster_config_ready,
+                                     cluster_view,
+                                     new_state=constants.NORMAL)
 
         # In FINISHED_LEAVING state, everyone is in NORMAL state (if they're
         # remaining, in which case they should do nothing) or FINISHED state (if
@@ -349,12 +434,15 @@ class SyncFSM(object):
             return None # pragma: no cover
         elif (cluster_state == constants.FINISHED_LEAVING and
                 local_state == constants.FINISHED):
-            # This node is finished, so this state machine (and this thread)
-            # should stop.
+            # This node is finished, so once the plugin has been told, this
+            # state machine (and this thread) should stop.
+            result = self._call_hook(self._plugin.on_leaving_cluster,
+                                     cluster_view,
+                                     constants.DELETE_ME)
+            if result is PENDING:
+                return None
             self._running = False
-            return safe_plugin(self._plugin.on_leaving_cluster,
-                               cluster_view,
-                               new_state=constants.DELETE_ME)
+            return result
 
         # Any valid state should have caused me to return by now
         _log.error("Invalid state in state machine for {} - local state {}, "
@@ -0,0 +1,47 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# Helpers for the tests that drive a synchronizer (or anything else that
+# talks to etcd) against a mock etcd client.
+
+from mock import patch
+from etcd import EtcdResult
+from metaswitch.clearwater.etcd_shared.common_etcd_synchronizer import \
+    CommonEtcdSynchronizer
+from metaswitch.clearwater.cluster_manager.etcd_synchronizer import \
+    EtcdSynchronizer
+from .dummy_plugin import DummyPlugin
+
+DNS_KEY = "/clearwater/site1/configuration/dns"
+
+
+def make_result(value, index, etcd_index=None, key=None, action=None):
+    """Returns the result of reading, writing or watching a key, which was
+    last modified (or created) at index. etcd_index defaults to index."""
+    r = EtcdResult(action, {"key": key,
+                            "value": value,
+                            "modifiedIndex": index,
+                            "createdIndex": index})
+    r.etcd_index = etcd_index or index
+    return r
+
+
+class KeySynchronizer(CommonEtcdSynchronizer):
+    # Synchronizes a single key, with no FSM behind it.
+    def __init__(self, plugin, ip, etcd_ip=None, key=DNS_KEY):
+        self._key = key
+        super(KeySynchronizer, self).__init__(plugin, ip, etcd_ip)
+
+    def key(self):
+        return self._key
+
+
+def make_synchronizer(cls=EtcdSynchronizer, **kwargs):
+    """Returns a synchronizer for 10.0.0.1 running a DummyPlugin, whose etcd
+    client is a mock."""
+    with patch("etcd.Client"):
+        return cls(DummyPlugin(None), "10.0.0.1", **kwargs)
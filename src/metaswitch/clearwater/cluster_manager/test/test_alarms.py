@@ -12,6 +12,7 @@ from mock import patch
 from metaswitch.clearwater.cluster_manager.alarms import TooLongAlarm
 from metaswitch.clearwater.cluster_manager.alarm_constants import \
     TOO_LONG_CLUSTERING
+from threading import Thread
 from time import sleep
 
 
@@ -70,3 +71,17 @@ class TestTooLongAlarm(unittest.TestCase):
         mock_alarm.set.assert_called_once_with()
         mock_alarm.clear.assert_called_once_with()
         alarm.quit()
+
+    @patch("metaswitch.clearwater.cluster_manager.alarms.alarm_manager")
+    def test_quit_straight_after_trigger(self, mock_alarm_manager):
+        # quit() can run before the alarm thread starts waiting, and mustn't
+        # wait out the whole delay
+        alarm = TooLongAlarm(60)
+        alarm.trigger("e")
+        quitter = Thread(target=alarm.quit)
+        quitter.start()
+        quitter.join(1)
+        self.assertFalse(quitter.isAlive())
+
+        mock_alarm = mock_alarm_manager.get_alarm.return_value
+        self.assertFalse(mock_alarm.set.called)
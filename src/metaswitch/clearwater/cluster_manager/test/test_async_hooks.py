@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+from threading import Event
+from time import sleep
+from mock import patch
+from metaswitch.clearwater.cluster_manager.synchronization_fsm import \
+    SyncFSM, safe_plugin
+from metaswitch.clearwater.cluster_manager.hook_runner import HookRunner
+from metaswitch.clearwater.cluster_manager.cluster_state import ClusterInfo
+from metaswitch.clearwater.cluster_manager import constants
+from metaswitch.clearwater.etcd_shared import metrics
+from .dummy_plugin import DummyPlugin
+import json
+
+
+class SlowPlugin(DummyPlugin):
+    def __init__(self, params):
+        super(SlowPlugin, self).__init__(params)
+        self.release = Event()
+        self.calls = []
+
+    def on_cluster_changing(self, cluster_view):
+        self.calls.append("on_cluster_changing")
+        self.release.wait(5)
+
+    def on_leaving_cluster(self, cluster_view):
+        self.calls.append("on_leaving_cluster")
+        self.release.wait(5)
+
+
+class FailingPlugin(SlowPlugin):
+    def on_cluster_changing(self, cluster_view):
+        self.calls.append("on_cluster_changing")
+        raise Exception
+
+
+class AssertingPlugin(SlowPlugin):
+    def on_cluster_changing(self, cluster_view):
+        self.calls.append("on_cluster_changing")
+        assert False, "UT plugin assertion"
+
+
+@patch("metaswitch.clearwater.cluster_manager.alarms.alarm_manager")
+class TestAsyncHooks(unittest.TestCase):
+
+    def setUp(self):
+        self.make_fsm(SlowPlugin(None))
+
+    def make_fsm(self, plugin):
+        self.plugin = plugin
+        self.finished = Event()
+        self.hooks = HookRunner(safe_plugin, self.finished.set)
+        self.fsm = SyncFSM(self.plugin, "10.0.0.1", hooks=self.hooks)
+
+    def tearDown(self):
+        self.plugin.release.set()
+        self.fsm.quit()
+
+    def next(self, view):
+        info = ClusterInfo(json.dumps(view))
+        return self.fsm.next(info.local_state("10.0.0.1"),
+                             info.cluster_state,
+                             info.view)
+
+    def test_hook_runs_in_background(self, alarm_manager):
+        view = {"10.0.0.1": constants.NORMAL_ACKNOWLEDGED_CHANGE,
+                "10.0.0.2": constants.JOINING_CONFIG_CHANGED}
+
+        # The FSM doesn't wait for the hook, and doesn't start it again while
+        # it's running (e.g. when another node's state changes)
+        self.assertIsNone(self.next(view))
+        self.assertIsNone(self.next(view))
+        self.assertFalse(self.finished.wait(0.1))
+
+        # Once it finishes, the FSM is told to look again, and moves on
+        self.plugin.release.set()
+        self.assertTrue(self.finished.wait(1))
+        self.assertEqual(constants.NORMAL_CONFIG_CHANGED, self.next(view))
+        self.assertEqual(["on_cluster_changing"], self.plugin.calls)
+
+    def test_failed_hook(self, alarm_manager):
+        view = {"10.0.0.1": constants.NORMAL_ACKNOWLEDGED_CHANGE,
+                "10.0.0.2": constants.JOINING_CONFIG_CHANGED}
+        self.fsm.quit()
+        self.make_fsm(FailingPlugin(None))
+
+        self.assertIsNone(self.next(view))
+        self.assertTrue(self.finished.wait(1))
+        self.finished.clear()
+
+        # The node stays where it is, and the hook is tried again next time
+        self.assertIsNone(self.next(view))
+        self.assertIsNone(self.next(view))
+        self.assertTrue(self.finished.wait(1))
+        self.assertEqual(2, len(self.plugin.calls))
+
+    def test_assertion_raised_on_fsm_thread(self, alarm_manager):
+        # A UT plugin's assertion halts the FSM, as it does when the hook is
+        # called on the FSM's thread
+        view = {"10.0.0.1": constants.NORMAL_ACKNOWLEDGED_CHANGE,
+                "10.0.0.2": constants.JOINING_CONFIG_CHANGED}
+        self.fsm.quit()
+        self.make_fsm(AssertingPlugin(None))
+
+        self.assertIsNone(self.next(view))
+        self.assertTrue(self.finished.wait(1))
+        self.assertRaises(AssertionError, self.next, view)
+
+    def test_still_running_while_leaving(self, alarm_manager):
+        view = {"10.0.0.1": constants.FINISHED,
+                "10.0.0.2": constants.NORMAL}
+
+        self.assertIsNone(self.next(view))
+        self.assertTrue(self.fsm.is_running())
+
+        self.plugin.release.set()
+        self.assertTrue(self.finished.wait(1))
+        self.assertEqual(constants.DELETE_ME, self.next(view))
+        self.assertFalse(self.fsm.is_running())
+
+    def test_heartbeat(self, alarm_manager):
+        self.hooks.HEARTBEAT_INTERVAL = 0.05
+        view = {"10.0.0.1": constants.NORMAL_ACKNOWLEDGED_CHANGE,
+                "10.0.0.2": constants.JOINING_CONFIG_CHANGED}
+        self.next(view)
+        sleep(0.2)
+
+        running = metrics.plugin_hook_running_seconds
+        self.assertGreater(running.value(plugin="SlowPlugin",
+                                         hook="on_cluster_changing"), 0)
+
+        self.plugin.release.set()
+        self.assertTrue(self.finished.wait(1))
+        sleep(0.1)
+        self.assertEqual(0, running.value(plugin="SlowPlugin",
+                                          hook="on_cluster_changing"))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+import socket
+from mock import MagicMock
+from metaswitch.clearwater.etcd_shared.cancellable_watch import \
+    WatchCanceller, watch_cancelled
+
+
+class TestWatchCanceller(unittest.TestCase):
+
+    def test_cancel_shuts_down_connections(self):
+        canceller = WatchCanceller()
+        conn = MagicMock()
+
+        with canceller.armed():
+            canceller.register(conn)
+            self.assertFalse(watch_cancelled())
+            canceller.cancel()
+            self.assertTrue(watch_cancelled())
+
+        conn.sock.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+        self.assertFalse(watch_cancelled())
+
+    def test_register_after_cancel(self):
+        # A request made after the watch has been cancelled fails immediately
+        canceller = WatchCanceller()
+
+        with canceller.armed():
+            canceller.cancel()
+            self.assertRaises(socket.error, canceller.register, MagicMock())
+
+    def test_rearming_clears_cancel(self):
+        canceller = WatchCanceller()
+
+        with canceller.armed():
+            canceller.cancel()
+
+        with canceller.armed():
+            conn = MagicMock()
+            canceller.register(conn)
+            conn.sock.shutdown.assert_not_called()
+
+    def test_cancel_outside_watch(self):
+        # Cancelling when there's no watch in progress doesn't shut down any
+        # connections that are used later
+        canceller = WatchCanceller()
+        conn = MagicMock()
+
+        with canceller.armed():
+            canceller.register(conn)
+
+        canceller.cancel()
+        conn.sock.shutdown.assert_not_called()
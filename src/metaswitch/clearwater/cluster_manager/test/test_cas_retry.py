@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+import json
+from mock import patch
+from metaswitch.clearwater.cluster_manager.etcd_synchronizer import \
+    EtcdSynchronizer
+from metaswitch.clearwater.cluster_manager.cluster_state import ClusterInfo
+from metaswitch.clearwater.cluster_manager import constants
+from metaswitch.clearwater.etcd_shared import metrics
+from .synchronizer_helpers import make_result, make_synchronizer
+
+
+@patch("metaswitch.clearwater.etcd_shared.retry_policy.sleep")
+@patch("metaswitch.clearwater.cluster_manager.alarms.alarm_manager")
+class TestCasRetry(unittest.TestCase):
+
+    def make_synchronizer(self):
+        metrics.registry.clear()
+        syncer = make_synchronizer()
+        syncer._index = 5
+        syncer._last_value = "last value"
+        return syncer
+
+    def contention(self, outcome):
+        return metrics.cluster_write_contention.value(key="/test",
+                                                      outcome=outcome)
+
+    def test_retry_with_new_index(self, alarm_manager, sleep):
+        # Another node acknowledges the scale-up just before us, so we retry
+        # our acknowledgement on top of theirs
+        syncer = self.make_synchronizer()
+        before = {"10.0.0.1": constants.NORMAL,
+                  "10.0.0.2": constants.NORMAL,
+                  "10.0.0.3": constants.JOINING}
+        after = dict(before)
+        after["10.0.0.2"] = constants.NORMAL_ACKNOWLEDGED_CHANGE
+        syncer._client.read.return_value = make_result(json.dumps(after), 6)
+        syncer._client.write.side_effect = [ValueError(), make_result("", 7)]
+
+        syncer.write_to_etcd(ClusterInfo(json.dumps(before)),
+                             constants.NORMAL_ACKNOWLEDGED_CHANGE)
+
+        # We backed off before retrying with the new index
+        self.assertEqual(1, sleep.call_count)
+        self.assertEqual(6, syncer._client.write.call_args[1]["prevIndex"])
+        written = json.loads(syncer._client.write.call_args[0][1])
+        self.assertEqual(constants.NORMAL_ACKNOWLEDGED_CHANGE,
+                         written["10.0.0.1"])
+        self.assertEqual(constants.NORMAL_ACKNOWLEDGED_CHANGE,
+                         written["10.0.0.2"])
+        self.assertEqual(1, self.contention("retried"))
+        self.assertEqual("last value", syncer._last_value)
+
+    def test_retry_budget(self, alarm_manager, sleep):
+        syncer = self.make_synchronizer()
+        view = json.dumps({"10.0.0.1": constants.NORMAL,
+                           "10.0.0.2": constants.JOINING})
+        syncer._client.read.return_value = make_result(view, 6)
+        syncer._client.write.side_effect = ValueError()
+
+        syncer.write_to_etcd(ClusterInfo(view),
+                             constants.NORMAL_ACKNOWLEDGED_CHANGE)
+
+        # We give up once the budget runs out, and rerun the FSM when we next
+        # read the cluster
+        self.assertEqual(EtcdSynchronizer.MAX_CAS_RETRIES + 1,
+                         syncer._client.write.call_count)
+        self.assertEqual(EtcdSynchronizer.MAX_CAS_RETRIES, sleep.call_count)
+        self.assertEqual(1, self.contention("abandoned"))
+        self.assertIsNone(syncer._last_value)
+
+    def test_cluster_moved_on(self, alarm_manager, sleep):
+        # The cluster state has changed since the FSM chose our new state, so
+        # rerun the FSM rather than retrying
+        syncer = self.make_synchronizer()
+        before = {"10.0.0.1": constants.NORMAL,
+                  "10.0.0.2": constants.WAITING_TO_JOIN}
+        after = {"10.0.0.1": constants.NORMAL,
+                 "10.0.0.2": constants.JOINING}
+        syncer._client.read.return_value = make_result(json.dumps(after), 6)
+        syncer._client.write.side_effect = ValueError()
+
+        syncer.write_to_etcd(ClusterInfo(json.dumps(before)),
+                             constants.WAITING_TO_LEAVE)
+
+        self.assertEqual(1, syncer._client.write.call_count)
+        self.assertEqual(1, self.contention("reevaluated"))
+        self.assertIsNone(syncer._last_value)
+
+    def test_whole_cluster_write_not_retried(self, alarm_manager, sleep):
+        syncer = self.make_synchronizer()
+        view = {"10.0.0.1": constants.WAITING_TO_JOIN,
+                "10.0.0.2": constants.WAITING_TO_JOIN}
+        syncer._client.write.side_effect = ValueError()
+
+        syncer.write_to_etcd(ClusterInfo(json.dumps(view)),
+                             syncer._fsm._switch_all_to_joining(view))
+
+        self.assertEqual(1, syncer._client.write.call_count)
+        self.assertFalse(sleep.called)
+        self.assertIsNone(syncer._last_value)
+
+    def test_failed_write_forgets_cluster(self, alarm_manager, sleep):
+        # Any other error forgets what we last read, so that we start over
+        # from the next read of the cluster
+        syncer = self.make_synchronizer()
+        view = {"10.0.0.1": constants.NORMAL,
+                "10.0.0.2": constants.JOINING}
+        syncer._client.write.side_effect = RuntimeError()
+
+        with patch.object(syncer, "pause") as pause:
+            syncer.write_to_etcd(ClusterInfo(json.dumps(view)),
+                                 constants.NORMAL_ACKNOWLEDGED_CHANGE)
+
+        self.assertTrue(pause.called)
+        self.assertIsNone(syncer._last_value)
+        self.assertIsNone(syncer._index)
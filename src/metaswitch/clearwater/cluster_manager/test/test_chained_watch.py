@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+from mock import MagicMock
+from .synchronizer_helpers import KeySynchronizer, make_result, \
+    make_synchronizer
+
+
+class TestChainedWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.syncer = make_synchronizer(KeySynchronizer)
+        self.read = self.syncer._client.read
+
+    def test_watch_follows_previous_change(self):
+        # The first read is a quorum read, but after that we watch from just
+        # after each change we see
+        self.read.side_effect = [make_result("value 1", 5, 10),
+                                 make_result("value 2", 12),
+                                 make_result("value 3", 15)]
+
+        self.assertEqual("value 1", self.syncer.update_from_etcd())
+        self.assertEqual("value 2", self.syncer.update_from_etcd())
+        self.assertEqual("value 3", self.syncer.update_from_etcd())
+
+        calls = self.read.call_args_list
+        self.assertTrue(calls[0][1]["quorum"])
+        self.assertEqual(11, calls[1][1]["waitIndex"])
+        self.assertEqual(13, calls[2][1]["waitIndex"])
+
+    def test_quorum_read_after_last_value_reset(self):
+        # After a failed write, the synchronizer forgets its last value, and
+        # must read the key again rather than watching
+        self.read.side_effect = [make_result("value 1", 5),
+                                 make_result("value 1", 5)]
+
+        self.syncer.update_from_etcd()
+        self.syncer._last_value = None
+        self.assertEqual("value 1", self.syncer.update_from_etcd())
+        self.assertTrue(self.read.call_args[1]["quorum"])
+
+    def test_quorum_read_after_error(self):
+        self.syncer.pause = MagicMock()
+        self.read.side_effect = [make_result("value 1", 5),
+                                 ValueError(),
+                                 make_result("value 2", 8)]
+
+        self.syncer.update_from_etcd()
+        self.syncer.update_from_etcd()
+        self.assertEqual("value 2", self.syncer.update_from_etcd())
+        self.assertTrue(self.read.call_args[1]["quorum"])
+
+    def test_disabled(self):
+        self.syncer.CHAINED_WATCHES = False
+        self.read.side_effect = [make_result("value 1", 5),
+                                 make_result("value 2", 8)]
+
+        self.syncer.update_from_etcd()
+        self.assertEqual("value 2", self.syncer.update_from_etcd())
+        self.assertTrue(self.read.call_args[1]["quorum"])
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import etcd
+from mock import MagicMock, patch
+from metaswitch.clearwater.etcd_shared import config_trace
+
+
+class TestConfigTrace(unittest.TestCase):
+
+    def test_trace_key(self):
+        self.assertEqual(
+            "/clearwater/site1/trace/shared_config",
+            config_trace.trace_key(
+                "/clearwater/site1/configuration/shared_config"))
+
+    def test_write_and_read(self):
+        client = MagicMock()
+        record = config_trace.write_trace(
+                     client,
+                     "/clearwater/site1/configuration/shared_config",
+                     "abc123",
+                     "new config")
+        key, value = client.write.call_args[0]
+        self.assertEqual("/clearwater/site1/trace/shared_config", key)
+        self.assertEqual(record, json.loads(value))
+
+        # The trace only applies to the value that was uploaded.
+        client.read.return_value = MagicMock(value=value)
+        self.assertEqual(
+            "abc123",
+            config_trace.read_trace(
+                client,
+                "/clearwater/site1/configuration/shared_config",
+                "new config")["id"])
+        self.assertIsNone(
+            config_trace.read_trace(
+                client,
+                "/clearwater/site1/configuration/shared_config",
+                "other config"))
+
+    def test_read_missing(self):
+        client = MagicMock()
+        client.read.side_effect = etcd.EtcdKeyNotFound
+        self.assertIsNone(config_trace.read_trace(
+            client, "/clearwater/site1/configuration/shared_config"))
+
+    def test_write_failure(self):
+        # Tracing is best effort, so it doesn't stop the upload.
+        client = MagicMock()
+        client.write.side_effect = etcd.EtcdConnectionFailed
+        record = config_trace.write_trace(
+                     client,
+                     "/clearwater/site1/configuration/apply_config",
+                     "abc123")
+        self.assertEqual("abc123", record["id"])
+
+    def test_write_with_ttl(self):
+        client = MagicMock()
+        config_trace.write_trace(client,
+                                 "/clearwater/site1/configuration/apply_config",
+                                 "abc123",
+                                 ttl=60)
+        self.assertEqual({"ttl": 60}, client.write.call_args[1])
+
+    @patch("metaswitch.clearwater.etcd_shared.config_trace.time",
+           return_value=105.5)
+    def test_log_span(self, mock_time):
+        with patch.object(config_trace._log, "info") as mock_info:
+            config_trace.log_span({"id": "abc123", "time": 100},
+                                  "received",
+                                  "10.0.0.1",
+                                  "/clearwater/site1/configuration/dns_json")
+            config_trace.log_span(None, "received", "10.0.0.1", "/a/b/c")
+
+        mock_info.assert_called_once_with(
+            "Config trace abc123 span received node 10.0.0.1 key dns_json "
+            "at 105.500 (5.500s after upload)")
+
+    def test_timelines(self):
+        lines = [
+            "cw-config: Config trace abc span uploaded node 10.0.0.1 key "
+            "dns_json at 100.000 (0.000s after upload)",
+            "Something else",
+            "Config trace abc span applied node 10.0.0.2 key dns_json "
+            "at 100.500 (0.500s after upload)",
+            "Config trace abc span received node 10.0.0.2 key dns_json "
+            "at 100.200 (0.200s after upload)",
+            "Config trace abc span PROCESSING node 10.0.0.2-sprout key "
+            "apply_config at 130.000 (30.000s after upload)"]
+
+        traces = config_trace.parse_spans(lines)
+        self.assertEqual(["abc"], traces.keys())
+        self.assertEqual([(100.2, "received", "dns_json"),
+                          (100.5, "applied", "dns_json")],
+                         sorted(traces["abc"]["10.0.0.2"]))
+
+        self.assertEqual(
+            "Trace abc\n"
+            "  10.0.0.1\n"
+            "        0.000s  uploaded         dns_json\n"
+            "  10.0.0.2\n"
+            "        0.200s  received         dns_json\n"
+            "        0.500s  applied          dns_json\n"
+            "  10.0.0.2-sprout\n"
+            "       30.000s  PROCESSING       apply_config",
+            config_trace.format_timelines(traces))
+
+    def test_main(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        log = os.path.join(tmp_dir, "log")
+        with open(log, "w") as f:
+            f.write("Config trace abc span applied node 10.0.0.1 key "
+                    "dns_json at 100.000 (0.000s after upload)\n"
+                    "Config trace def span applied node 10.0.0.1 key "
+                    "dns_json at 200.000 (0.000s after upload)\n")
+
+        with patch("sys.stdout") as stdout:
+            config_trace.main(["--trace=def", log])
+        output = "".join(call[0][0] for call in stdout.write.call_args_list)
+        self.assertIn("Trace def", output)
+        self.assertNotIn("Trace abc", output)
+
+
+class TestTraceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.read.side_effect = etcd.EtcdKeyNotFound
+        self.multiplexer = MagicMock()
+        self.cache = config_trace.TraceCache(
+                         self.client,
+                         "/clearwater/site1/configuration/apply_config")
+
+    def test_not_watching(self):
+        self.assertIsNone(self.cache.get())
+        self.client.read.assert_not_called()
+
+    def test_no_record(self):
+        # The record is read once, and then its absence is remembered
+        self.cache.subscribe(self.multiplexer)
+        self.multiplexer.subscribe.assert_called_once_with(
+            "/clearwater/site1/trace/apply_config", self.cache._on_change)
+        self.assertIsNone(self.cache.get())
+        self.assertIsNone(self.cache.get())
+        self.assertEqual(1, self.client.read.call_count)
+
+    def test_changes(self):
+        self.cache.subscribe(self.multiplexer)
+        self.cache.get()
+
+        self.cache._on_change(MagicMock(value='{"id": "abc123", "time": 1}'))
+        self.assertEqual("abc123", self.cache.get()["id"])
+
+        # The record has expired
+        self.cache._on_change(MagicMock(value=None))
+        self.assertIsNone(self.cache.get())
+        self.assertEqual(1, self.client.read.call_count)
+
+        # The multiplexer may have missed changes, so read it again
+        self.cache._on_change(None)
+        self.assertIsNone(self.cache.get())
+        self.assertEqual(2, self.client.read.call_count)
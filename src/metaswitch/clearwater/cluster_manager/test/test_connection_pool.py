@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+from mock import MagicMock, patch
+from metaswitch.clearwater.etcd_shared import etcd_backend
+from metaswitch.clearwater.etcd_shared.connection_pool import \
+    LanedPoolManager, LaneStats, shared_pool_manager
+
+
+class TestLanedPoolManager(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = LanedPoolManager()
+        self.manager._watches = MagicMock()
+        self.manager._requests = MagicMock()
+
+    def test_python_etcd_watch(self):
+        self.manager.request("GET", "http://10.0.0.1:4000/v2/keys/test",
+                             fields={"wait": "true", "waitIndex": 10})
+        self.manager._watches.request.assert_called_once()
+        self.manager._requests.request.assert_not_called()
+
+    def test_python_etcd_read(self):
+        self.manager.request("GET", "http://10.0.0.1:4000/v2/keys/test",
+                             fields={"quorum": "true"})
+        self.manager.request_encode_body("PUT",
+                                         "http://10.0.0.1:4000/v2/keys/test",
+                                         fields={"value": "new"})
+        self.manager._requests.request.assert_called_once()
+        self.manager._requests.request_encode_body.assert_called_once()
+        self.manager._watches.request.assert_not_called()
+
+    def test_urlopen(self):
+        self.manager.urlopen("POST", "http://10.0.0.1:4000/v3alpha/watch",
+                             watch=True, body="{}")
+        self.manager.urlopen("POST", "http://10.0.0.1:4000/v3alpha/kv/range",
+                             body="{}")
+        self.manager._watches.urlopen.assert_called_once_with(
+            "POST", "http://10.0.0.1:4000/v3alpha/watch", body="{}")
+        self.manager._requests.urlopen.assert_called_once_with(
+            "POST", "http://10.0.0.1:4000/v3alpha/kv/range", body="{}")
+
+
+class TestLaneStats(unittest.TestCase):
+
+    def test_reuse(self):
+        stats = LaneStats()
+        stats.connection_opened()
+        for _ in range(5):
+            stats.request_made()
+        self.assertEqual(4, stats.reused())
+
+
+class TestSharedPool(unittest.TestCase):
+
+    @patch("etcd.Client")
+    def test_clients_share_pool(self, v2_client):
+        v2_client.side_effect = lambda *args: MagicMock()
+        client1 = etcd_backend.create_client("10.0.0.1", 4000, "2")
+        client2 = etcd_backend.create_client("10.0.0.2", 4000, "2")
+        client3 = etcd_backend.create_client("10.0.0.1", 4000, "3")
+        self.assertIs(shared_pool_manager(), client1.http)
+        self.assertIs(shared_pool_manager(), client2.http)
+        self.assertIs(shared_pool_manager(), client3.http)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+import json
+from mock import patch
+from metaswitch.clearwater.cluster_manager.cluster_state import ClusterInfo
+from metaswitch.clearwater.cluster_manager import constants
+from .synchronizer_helpers import make_result, make_synchronizer
+
+
+@patch("metaswitch.clearwater.cluster_manager.alarms.alarm_manager")
+class TestEchoSuppression(unittest.TestCase):
+
+    def make_synchronizer(self):
+        syncer = make_synchronizer()
+        syncer._index = 5
+        syncer._client.write.return_value = make_result(None, 6)
+        return syncer
+
+    def test_unchanged_cluster_state(self, alarm_manager):
+        # Acknowledging the scale-up doesn't change the cluster state while
+        # another node is still JOINING, so our own write can be ignored
+        syncer = self.make_synchronizer()
+        info = ClusterInfo(json.dumps({"10.0.0.1": constants.NORMAL,
+                                       "10.0.0.2": constants.JOINING}))
+        syncer.write_to_etcd(info,
+                             constants.NORMAL_ACKNOWLEDGED_CHANGE,
+                             ignore_echo=True)
+
+        syncer._index = 6
+        self.assertTrue(syncer.is_echo())
+
+        # Only the first read after the write can be an echo
+        self.assertFalse(syncer.is_echo())
+
+    def test_changed_cluster_state(self, alarm_manager):
+        # Our write moves the cluster on, so the FSM must see it
+        syncer = self.make_synchronizer()
+        info = ClusterInfo(json.dumps({"10.0.0.1": constants.JOINING,
+                                       "10.0.0.2": constants.NORMAL_ACKNOWLEDGED_CHANGE}))
+        syncer.write_to_etcd(info,
+                             constants.JOINING_ACKNOWLEDGED_CHANGE,
+                             ignore_echo=True)
+
+        syncer._index = 6
+        self.assertFalse(syncer.is_echo())
+
+    def test_write_not_from_fsm(self, alarm_manager):
+        syncer = self.make_synchronizer()
+        info = ClusterInfo(json.dumps({"10.0.0.1": constants.NORMAL,
+                                       "10.0.0.2": constants.WAITING_TO_LEAVE}))
+        syncer.write_to_etcd(info, constants.WAITING_TO_LEAVE)
+
+        syncer._index = 6
+        self.assertFalse(syncer.is_echo())
+
+    def test_someone_elses_write(self, alarm_manager):
+        syncer = self.make_synchronizer()
+        info = ClusterInfo(json.dumps({"10.0.0.1": constants.NORMAL,
+                                       "10.0.0.2": constants.JOINING}))
+        syncer.write_to_etcd(info,
+                             constants.NORMAL_ACKNOWLEDGED_CHANGE,
+                             ignore_echo=True)
+
+        syncer._index = 7
+        self.assertFalse(syncer.is_echo())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+from mock import MagicMock
+from metaswitch.clearwater.etcd_shared import endpoint_selector, etcd_backend
+from metaswitch.clearwater.etcd_shared.endpoint_selector import \
+    EndpointSelector, record_request
+
+
+def record(host, latency, ok=True, times=5):
+    for _ in range(times):
+        record_request("http://{}:4000/v2/keys/test".format(host), latency, ok)
+
+
+class TestEndpointSelector(unittest.TestCase):
+
+    def setUp(self):
+        endpoint_selector._stats.clear()
+        self.selector = EndpointSelector("10.0.0.1")
+        self.selector._probe = MagicMock()
+        client = MagicMock()
+        client.machines = ["http://10.0.0.1:4000",
+                           "http://10.0.0.2:4000",
+                           "http://10.0.0.3:4000"]
+        client.leader = {"clientURLs": ["http://10.0.0.3:4000"]}
+        self.selector.discover(client)
+
+    def test_discovery(self):
+        self.assertEqual(["10.0.0.1", "10.0.0.2", "10.0.0.3"],
+                         self.selector.members())
+        self.assertEqual("10.0.0.3", self.selector.leader())
+        self.assertEqual(2, self.selector._probe.call_count)
+
+    def test_prefer_home(self):
+        # Other members are faster, but not by enough to matter
+        record("10.0.0.1", 0.02)
+        record("10.0.0.2", 0.001)
+        self.assertEqual("10.0.0.1", self.selector.read_endpoint())
+
+    def test_slow_home_demoted(self):
+        record("10.0.0.1", 0.5)
+        record("10.0.0.2", 0.01)
+        record("10.0.0.3", 0.02)
+        self.assertEqual("10.0.0.2", self.selector.read_endpoint())
+
+        # Once the home endpoint recovers, reads go back to it
+        record("10.0.0.1", 0.01, times=20)
+        self.assertEqual("10.0.0.1", self.selector.read_endpoint())
+
+    def test_failing_home_demoted(self):
+        record("10.0.0.1", 0.01)
+        record("10.0.0.1", 1, ok=False)
+        record("10.0.0.2", 0.05)
+        self.assertEqual("10.0.0.2", self.selector.read_endpoint())
+
+    def test_writes_to_leader(self):
+        record("10.0.0.1", 0.01)
+        self.assertEqual("10.0.0.3", self.selector.write_endpoint())
+
+        # Unless the leader is failing
+        record("10.0.0.3", 1, ok=False)
+        self.assertEqual("10.0.0.1", self.selector.write_endpoint())
+
+
+class TestSetEndpoint(unittest.TestCase):
+
+    def test_v2_client(self):
+        client = MagicMock(spec=["_base_uri", "_protocol"])
+        client._protocol = "http"
+        etcd_backend.set_endpoint(client, "10.0.0.2")
+        self.assertEqual("http://10.0.0.2:4000", client._base_uri)
+
+    def test_v3_client(self):
+        client = etcd_backend.create_client("10.0.0.1", 4000, "3")
+        etcd_backend.set_endpoint(client, "10.0.0.2")
+        self.assertEqual("http://10.0.0.2:4000/v3alpha", client._base_uri)
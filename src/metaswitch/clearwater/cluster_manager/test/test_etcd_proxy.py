@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+from etcd import EtcdResult, EtcdKeyNotFound
+from mock import MagicMock, patch
+from metaswitch.clearwater.etcd_shared.etcd_proxy import SubtreeCache, \
+    CachingProxy
+from metaswitch.clearwater.etcd_shared.etcd_proxy_client import \
+    EtcdProxyClient
+from metaswitch.clearwater.etcd_shared.watch_multiplexer import \
+    WatchMultiplexer
+from .synchronizer_helpers import DNS_KEY, make_result
+
+PREFIX = "/clearwater"
+MEMCACHED_KEY = "/clearwater/site1/node/clustering/memcached"
+
+
+class TestSubtreeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = SubtreeCache(PREFIX)
+        self.cache.finish_load(
+            [make_result("dns", 5, key=DNS_KEY),
+             make_result("{}", 7, key=MEMCACHED_KEY)],
+            10)
+
+    def test_read_key(self):
+        node, index = self.cache.lookup("/clearwater/site1/configuration/dns")
+        self.assertEqual("dns", node["value"])
+        self.assertEqual(10, index)
+
+    def test_read_directory(self):
+        node, _ = self.cache.lookup("/clearwater/site1")
+        self.assertEqual(["/clearwater/site1/configuration",
+                          "/clearwater/site1/node"],
+                         [child["key"] for child in node["nodes"]])
+        self.assertNotIn("nodes", node["nodes"][0])
+
+        node, _ = self.cache.lookup("/clearwater", recursive=True)
+        leaves = [leaf.key for leaf in EtcdResult("get", node).leaves]
+        self.assertEqual(["/clearwater/site1/configuration/dns",
+                          "/clearwater/site1/node/clustering/memcached"],
+                         leaves)
+
+    def test_missing_key(self):
+        self.assertRaises(KeyError,
+                          self.cache.lookup,
+                          "/clearwater/site2")
+
+    def test_changes(self):
+        self.cache.apply(make_result("new dns", 11, key=DNS_KEY))
+        self.cache.apply(make_result(None,
+                                     12,
+                                     key="/clearwater/site1/node",
+                                     action="delete"))
+
+        node, index = self.cache.lookup("/clearwater/site1/configuration/dns")
+        self.assertEqual("new dns", node["value"])
+        self.assertEqual(12, index)
+        self.assertRaises(KeyError,
+                          self.cache.lookup,
+                          "/clearwater/site1/node/clustering/memcached")
+
+    def test_changes_while_loading(self):
+        # Changes seen during a reload are applied after it, unless the
+        # reload already included them
+        self.cache.begin_load()
+        self.cache.apply(make_result("old dns", 15, key=DNS_KEY))
+        self.cache.apply(make_result("new dns", 25, key=DNS_KEY))
+        self.assertFalse(self.cache.is_loaded())
+
+        self.cache.finish_load([make_result("dns", 15, key=DNS_KEY)], 20)
+        node, index = self.cache.lookup("/clearwater/site1/configuration/dns")
+        self.assertEqual("new dns", node["value"])
+        self.assertEqual(25, index)
+
+
+class TestCachingProxy(unittest.TestCase):
+
+    @patch("metaswitch.clearwater.etcd_shared.etcd_proxy.create_client")
+    def setUp(self, create_client):
+        self.client = create_client.return_value
+        multiplexer = MagicMock()
+        multiplexer.normalise = WatchMultiplexer.normalise
+        self.proxy = CachingProxy(PREFIX, multiplexer, "10.0.0.1")
+
+    def test_not_loaded(self):
+        response = self.proxy.handle({"method": "read",
+                                      "key": "/clearwater/site1"})
+        self.assertEqual("unavailable", response["error"])
+
+    def test_reads(self):
+        self.proxy.cache.finish_load(
+            [make_result("dns", 5, key=DNS_KEY)], 8)
+
+        response = self.proxy.handle(
+                       {"method": "read",
+                        "key": "/clearwater/site1/configuration/dns"})
+        self.assertEqual("dns", response["node"]["value"])
+
+        response = self.proxy.handle({"method": "read",
+                                      "key": "/clearwater/site2"})
+        self.assertEqual("EtcdKeyNotFound", response["error"])
+
+        response = self.proxy.handle({"method": "read",
+                                      "key": "/other"})
+        self.assertEqual("unavailable", response["error"])
+
+    def test_writes_not_passed_through(self):
+        response = self.proxy.handle({"method": "write",
+                                      "key": "/clearwater/site1",
+                                      "value": "value"})
+        self.assertEqual("unavailable", response["error"])
+        self.client.write.assert_not_called()
+
+    @patch("metaswitch.clearwater.etcd_shared.etcd_proxy.create_client")
+    def test_write_arguments_checked(self, create_client):
+        multiplexer = MagicMock()
+        multiplexer.normalise = WatchMultiplexer.normalise
+        proxy = CachingProxy(PREFIX, multiplexer, "10.0.0.1",
+                             allow_writes=True)
+        client = create_client.return_value
+        client.write.return_value = make_result("value",
+                                                9,
+                                                key="/clearwater/site1",
+                                                action="set")
+
+        response = proxy.handle({"method": "write",
+                                 "key": "/clearwater/site1",
+                                 "value": "value",
+                                 "args": {"prevIndex": 8}})
+        self.assertEqual("value", response["node"]["value"])
+        client.write.assert_called_once_with("/clearwater/site1",
+                                             "value",
+                                             prevIndex=8)
+
+        # Anything else is left for the client to send to etcd itself
+        response = proxy.handle({"method": "delete",
+                                 "key": "/clearwater",
+                                 "args": {"recursive": True}})
+        self.assertEqual("unavailable", response["error"])
+        client.delete.assert_not_called()
+
+    @patch("metaswitch.clearwater.etcd_shared.etcd_proxy.create_client")
+    def test_writes_outside_subtree_refused(self, create_client):
+        multiplexer = MagicMock()
+        multiplexer.normalise = WatchMultiplexer.normalise
+        proxy = CachingProxy(PREFIX, multiplexer, "10.0.0.1",
+                             allow_writes=True)
+        client = create_client.return_value
+
+        response = proxy.handle({"method": "write",
+                                 "key": "/other",
+                                 "value": "value"})
+        self.assertEqual("unavailable", response["error"])
+        response = proxy.handle({"method": "delete",
+                                 "key": "/clearwater2/site1"})
+        self.assertEqual("unavailable", response["error"])
+        client.write.assert_not_called()
+        client.delete.assert_not_called()
+
+
+class TestEtcdProxyClient(unittest.TestCase):
+
+    def setUp(self):
+        self.etcd_client = MagicMock()
+        self.client = EtcdProxyClient("/nonexistent.sock", self.etcd_client)
+
+    def test_falls_back_to_etcd(self):
+        # There's no proxy listening, so the read goes to etcd
+        self.client.read("/clearwater/site1", recursive=True)
+        self.etcd_client.read.assert_called_once_with("/clearwater/site1",
+                                                      recursive=True)
+
+    def test_quorum_reads_go_to_etcd(self):
+        self.client._request = MagicMock()
+        self.client.read("/clearwater/site1", quorum=True)
+        self.client._request.assert_not_called()
+
+    def test_proxy_errors_raised(self):
+        self.client._request = MagicMock(side_effect=EtcdKeyNotFound())
+        self.assertRaises(EtcdKeyNotFound,
+                          self.client.get,
+                          "/clearwater/site2")
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import base64
+import json
+import unittest
+import etcd
+from mock import MagicMock, patch
+from metaswitch.clearwater.etcd_shared import etcd_backend
+from metaswitch.clearwater.etcd_shared.etcd_v3_client import EtcdV3Client
+
+
+def b64(s):
+    return base64.b64encode(s)
+
+
+def kv(key, value, mod_revision):
+    return {"key": b64(key),
+            "value": b64(value),
+            "create_revision": "2",
+            "mod_revision": str(mod_revision)}
+
+
+def response(body, status=200):
+    r = MagicMock()
+    r.status = status
+    r.data = json.dumps(body)
+    return r
+
+
+def stream(*chunks):
+    r = MagicMock()
+    r.status = 200
+    r.stream.return_value = iter(chunks)
+    return r
+
+
+class TestEtcdV3Client(unittest.TestCase):
+    def setUp(self):
+        self.client = EtcdV3Client("10.0.0.1", 4000)
+        self.client.http = MagicMock()
+
+    def request(self, call=-1):
+        args, kwargs = self.client.http.urlopen.call_args_list[call]
+        return args[1], json.loads(kwargs["body"])
+
+    def test_read(self):
+        self.client.http.urlopen.return_value = response(
+            {"header": {"revision": "20"},
+             "kvs": [kv("/clearwater/node", "value", 17)]})
+
+        result = self.client.read("/clearwater/node", quorum=True)
+        self.assertEqual("value", result.value)
+        self.assertEqual(17, result.modifiedIndex)
+        self.assertEqual(20, result.etcd_index)
+
+        url, body = self.request()
+        self.assertEqual("http://10.0.0.1:4000/v3alpha/kv/range", url)
+        self.assertEqual({"key": b64("/clearwater/node"),
+                          "serializable": False}, body)
+
+    def test_read_missing_key(self):
+        self.client.http.urlopen.return_value = response(
+            {"header": {"revision": "20"}})
+
+        with self.assertRaises(etcd.EtcdKeyNotFound) as cm:
+            self.client.read("/clearwater/node")
+        self.assertEqual(20, cm.exception.payload["index"])
+
+    def test_recursive_read(self):
+        self.client.http.urlopen.return_value = response(
+            {"header": {"revision": "20"},
+             "kvs": [kv("/clearwater/a", "1", 5), kv("/clearwater/b", "2", 6)]})
+
+        result = self.client.read("/clearwater", recursive=True)
+        self.assertEqual([("/clearwater/a", "1"), ("/clearwater/b", "2")],
+                         [(r.key, r.value) for r in result.leaves])
+
+        _, body = self.request()
+        self.assertEqual(b64("/clearwater/"), body["key"])
+        self.assertEqual(b64("/clearwater0"), body["range_end"])
+
+    def test_compare_and_swap(self):
+        self.client.http.urlopen.return_value = response(
+            {"header": {"revision": "21"}, "succeeded": True})
+
+        result = self.client.write("/clearwater/node", "new", prevIndex=17)
+        self.assertEqual(21, result.modifiedIndex)
+
+        url, body = self.request()
+        self.assertTrue(url.endswith("/kv/txn"))
+        self.assertEqual([{"key": b64("/clearwater/node"),
+                           "result": "EQUAL",
+                           "target": "MOD",
+                           "mod_revision": "17"}], body["compare"])
+
+    def test_compare_and_swap_failure(self):
+        # The gateway leaves "succeeded" out when it's false.
+        self.client.http.urlopen.return_value = response(
+            {"header": {"revision": "21"}})
+
+        with self.assertRaises(etcd.EtcdCompareFailed):
+            self.client.write("/clearwater/node", "new", prevIndex=17)
+        with self.assertRaises(etcd.EtcdAlreadyExist):
+            self.client.write("/clearwater/node", "new", prevExist=False)
+
+    def test_watch_stream(self):
+        # Messages can be split across reads, or share them.
+        event1 = json.dumps({"result": {"header": {"revision": "22"},
+                                        "events": [{"kv": kv("/clearwater/a", "1", 22)}]}})
+        event2 = json.dumps({"result": {"header": {"revision": "23"},
+                                        "events": [{"type": "DELETE",
+                                                    "kv": {"key": b64("/clearwater/b"),
+                                                           "mod_revision": "23"}}]}})
+        created = json.dumps({"result": {"header": {"revision": "21"},
+                                         "created": True}})
+        self.client.http.urlopen.return_value = stream(
+            created + "\n" + event1[:10], event1[10:] + "\n" + event2 + "\n")
+
+        results = self.client.watch_stream("/clearwater",
+                                           start_index=22,
+                                           recursive=True)
+        first = next(results)
+        self.assertEqual(("set", "/clearwater/a", "1", 22),
+                         (first.action, first.key, first.value, first.modifiedIndex))
+        second = next(results)
+        self.assertEqual(("delete", "/clearwater/b", None, 23),
+                         (second.action, second.key, second.value, second.modifiedIndex))
+
+        # The stream ending is an error.
+        self.assertRaises(etcd.EtcdConnectionFailed, next, results)
+
+        _, body = self.request()
+        self.assertEqual("22", body["create_request"]["start_revision"])
+
+    def test_watch_compacted(self):
+        self.client.http.urlopen.return_value = stream(
+            json.dumps({"result": {"header": {"revision": "30"},
+                                   "compact_revision": "25",
+                                   "canceled": True}}))
+
+        with self.assertRaises(etcd.EtcdEventIndexCleared):
+            self.client.read("/clearwater/node", wait=True, waitIndex=10)
+
+
+class TestCreateClient(unittest.TestCase):
+    @patch("etcd.Client")
+    def test_api_version(self, v2_client):
+        self.assertIsInstance(etcd_backend.create_client("10.0.0.1", 4000, "3"),
+                              EtcdV3Client)
+        self.assertEqual(v2_client.return_value,
+                         etcd_backend.create_client("10.0.0.1", 4000, "2"))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+from threading import Event
+from mock import MagicMock
+from metaswitch.clearwater.etcd_shared.event_loop import EventLoop, \
+    SynchronizerEngine
+from .synchronizer_helpers import make_result
+
+
+class TestEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.loop.start_thread()
+
+    def tearDown(self):
+        self.loop.terminate()
+
+    def test_timers_run_in_order(self):
+        done = Event()
+        calls = []
+        self.loop.call_later(0.2, done.set)
+        self.loop.call_later(0.1, calls.append, 2)
+        self.loop.call_later(0.05, calls.append, 1)
+        handle = self.loop.call_later(0.01, calls.append, 0)
+        handle.cancel()
+
+        self.assertTrue(done.wait(5))
+        self.assertEqual([1, 2], calls)
+
+    def test_worker_result(self):
+        done = Event()
+        results = []
+
+        def callback(result):
+            results.append(result)
+            done.set()
+
+        self.loop.run_in_worker(lambda: 42, callback)
+        self.assertTrue(done.wait(5))
+        self.assertEqual([42], results)
+
+
+class ManualLoop(object):
+    # Runs loop callbacks straight away, but holds on to work for the worker
+    # threads until the test runs it.
+    def __init__(self):
+        self.work = []
+
+    def start_thread(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def call_soon(self, callback, *args):
+        callback(*args)
+
+    def run_in_worker(self, f, callback=None):
+        self.work.append((f, callback))
+
+    def run_work(self):
+        f, callback = self.work.pop(0)
+        result = f()
+        if callback is not None:
+            callback(result)
+
+
+class TestSynchronizerEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = ManualLoop()
+        self.multiplexer = MagicMock()
+        self.engine = SynchronizerEngine(self.loop, self.multiplexer)
+        self.syncer = MagicMock()
+        self.syncer._terminate_flag = False
+        self.syncer.is_running.return_value = True
+        self.engine.add(self.syncer)
+        self.on_change = self.multiplexer.subscribe.call_args[0][1]
+
+    def test_changes_coalesced_while_busy(self):
+        self.engine.start()
+        self.on_change(make_result(None, 10))
+        self.on_change(make_result(None, 11))
+        self.on_change(make_result(None, 12))
+
+        # The initial read is running, so nothing else runs yet. Once it
+        # finishes, only the latest change is handled.
+        self.assertEqual(1, len(self.loop.work))
+        self.loop.run_work()
+        self.syncer.refresh.assert_called_once_with()
+        self.loop.run_work()
+        self.assertEqual(12,
+                         self.syncer.handle_update.call_args[0][0].modifiedIndex)
+        self.assertEqual([], self.loop.work)
+
+    def test_missed_changes_reread(self):
+        self.on_change(None)
+        self.loop.run_work()
+        self.syncer.refresh.assert_called_once_with()
+
+    def test_stopped_synchronizer(self):
+        self.on_change(make_result(None, 10))
+        self.syncer.is_running.return_value = False
+        self.loop.run_work()
+
+        # The synchronizer is tidied up, and sees no more changes
+        self.loop.run_work()
+        self.syncer.finish.assert_called_once_with()
+        self.on_change(make_result(None, 11))
+        self.assertEqual([], self.loop.work)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from metaswitch.clearwater.etcd_shared.event_recorder import EventRecorder, \
+    load_events
+from metaswitch.clearwater.etcd_shared.test.event_replay import replay, \
+    ReplayClient
+from metaswitch.clearwater.cluster_manager.etcd_synchronizer import \
+    EtcdSynchronizer
+from metaswitch.clearwater.cluster_manager import constants
+from .dummy_plugin import DummyPlugin
+
+
+class TestEventRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_record_and_load(self):
+        path = os.path.join(self.dir, "events.jsonl.gz")
+        recorder = EventRecorder(path)
+        recorder.start_thread()
+        recorder.record("/test", "one", 5)
+        recorder.record("/test", "one", 5)
+        recorder.record("/other", "two", 6)
+        recorder.record("/test", "three", 7)
+        recorder.terminate()
+
+        # Unchanged values aren't recorded again.
+        events = load_events(path)
+        self.assertEqual([("/test", "one", 5),
+                          ("/other", "two", 6),
+                          ("/test", "three", 7)],
+                         [(e["key"], e["value"], e["index"]) for e in events])
+        self.assertEqual(["one", "three"],
+                         [e["value"] for e in load_events(path, "/test")])
+
+
+@patch("metaswitch.clearwater.cluster_manager.alarms.alarm_manager")
+class TestEventReplay(unittest.TestCase):
+
+    def test_replay_client(self, alarm_manager):
+        events = [{"t": 0, "key": "/test", "index": 10, "value": "a"},
+                  {"t": 1, "key": "/test", "index": 12, "value": "b"}]
+        client = ReplayClient(events)
+        client.replayed(0)
+        self.assertEqual("a", client.read("/test").value)
+
+        # A write that's recorded later in the trace gets its recorded index,
+        # and one that isn't gets a new index.
+        self.assertEqual(12, client.write("/test", "b").modifiedIndex)
+        self.assertEqual(11, client.write("/test", "c").modifiedIndex)
+        self.assertEqual([(1, "b"), (1, "c")], client.writes)
+
+    @patch("etcd.Client")
+    def test_replay_to_cluster_manager(self, client, alarm_manager):
+        syncer = EtcdSynchronizer(DummyPlugin(None), "10.0.0.1")
+        # Stop the FSM's alarm thread, or it keeps the test process running.
+        self.addCleanup(syncer.finish)
+        view = {"10.0.0.2": constants.NORMAL}
+        events = [{"t": 0, "key": "/test", "index": 10,
+                   "value": json.dumps(view)}]
+
+        result = replay(syncer, events)
+
+        # The FSM asks to join the cluster it's been shown.
+        self.assertEqual(1, len(result.durations))
+        self.assertEqual(1, len(result.writes))
+        self.assertEqual(constants.WAITING_TO_JOIN,
+                         json.loads(result.writes[0][1])["10.0.0.1"])
+        self.assertIn("Replayed 1 events", result.summary())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+import etcd
+from mock import MagicMock
+from metaswitch.clearwater.etcd_shared import metrics
+from .synchronizer_helpers import KeySynchronizer, make_result, \
+    make_synchronizer
+
+
+class TestIndexCleared(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.clear()
+        self.syncer = make_synchronizer(KeySynchronizer)
+        self.syncer._last_value = "old value"
+        self.syncer.pause = MagicMock()
+
+    def test_changed_value_returned_immediately(self):
+        # The watch index has been cleared, and the key has changed since we
+        # last saw it, so the reread value is returned without pausing
+        self.syncer._client.read.side_effect = [
+            make_result("old value", 10),
+            etcd.EtcdEventIndexCleared("cleared"),
+            make_result("new value", 2000)]
+
+        self.assertEqual(("new value", 2000),
+                         self.syncer.read_from_etcd(wait=True))
+        self.assertEqual(1, metrics.watch_index_cleared.value(
+                                key=self.syncer.key()))
+        self.syncer.pause.assert_not_called()
+
+    def test_unchanged_value_rewatched(self):
+        # The key hasn't changed, so we watch again from the current index
+        self.syncer._client.read.side_effect = [
+            make_result("old value", 10),
+            etcd.EtcdEventIndexCleared("cleared"),
+            make_result("old value", 2000),
+            make_result("new value", 2001)]
+
+        self.assertEqual(("new value", 2001),
+                         self.syncer.read_from_etcd(wait=True))
+        self.assertEqual(2001,
+                         self.syncer._client.read.call_args[1]["waitIndex"])
+        self.syncer.pause.assert_not_called()
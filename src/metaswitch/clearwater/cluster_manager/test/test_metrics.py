@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import os
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock, patch
+from metaswitch.clearwater.etcd_shared import metrics
+from metaswitch.clearwater.etcd_shared.plugin_utils import run_command
+from metaswitch.clearwater.cluster_manager.synchronization_fsm import \
+    safe_plugin
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter("test_total", "A counter", ["plugin"])
+        counter.inc(plugin="a")
+        counter.inc(2, plugin="a")
+        counter.inc(plugin="b")
+
+        self.assertEqual(3, counter.value(plugin="a"))
+        self.assertEqual(1, counter.value(plugin="b"))
+        self.assertEqual(0, counter.value(plugin="c"))
+
+    def test_gauge(self):
+        gauge = self.registry.gauge("test_seconds", "A gauge", ["plugin"])
+        gauge.set(5, plugin="a")
+        gauge.set(2, plugin="a")
+
+        self.assertEqual(2, gauge.value(plugin="a"))
+        self.assertEqual(0, gauge.value(plugin="b"))
+        self.assertRaises(ValueError,
+                          self.registry.counter, "test_seconds", "A counter")
+
+    def test_wrong_labels(self):
+        counter = self.registry.counter("test_total", "A counter", ["plugin"])
+        self.assertRaises(ValueError, counter.inc, hook="a")
+
+    def test_reregister(self):
+        # Registering the same metric again returns the existing one, but
+        # registering a different metric with the same name fails.
+        counter = self.registry.counter("test_total", "A counter")
+        self.assertIs(counter, self.registry.counter("test_total", "A counter"))
+        self.assertRaises(ValueError,
+                          self.registry.histogram, "test_total", "A histogram")
+
+    def test_render(self):
+        counter = self.registry.counter("test_total", "A counter", ["plugin"])
+        histogram = self.registry.histogram("test_seconds",
+                                            "A histogram",
+                                            buckets=(1, 10))
+        counter.inc(plugin='quo"te')
+        histogram.observe(0.5)
+        histogram.observe(5)
+        histogram.observe(50)
+
+        self.assertEqual(
+            "# HELP test_seconds A histogram\n"
+            "# TYPE test_seconds histogram\n"
+            'test_seconds_bucket{le="1"} 1\n'
+            'test_seconds_bucket{le="10"} 2\n'
+            'test_seconds_bucket{le="+Inf"} 3\n'
+            "test_seconds_sum 55.5\n"
+            "test_seconds_count 3\n"
+            "# HELP test_total A counter\n"
+            "# TYPE test_total counter\n"
+            'test_total{plugin="quo\\"te"} 1\n',
+            self.registry.render())
+
+    @patch("metaswitch.clearwater.etcd_shared.metrics.time")
+    def test_time(self, mock_time):
+        histogram = self.registry.histogram("test_seconds", "A histogram")
+        mock_time.side_effect = [10, 12]
+
+        with self.assertRaises(ValueError):
+            with histogram.time():
+                raise ValueError()
+
+        # The time is recorded even though the body raised.
+        self.assertEqual(1, histogram.count())
+        self.assertIn("test_seconds_sum 2", self.registry.render())
+
+
+class TestMetricsFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_write(self):
+        path = os.path.join(self.dir, "etcd_managers.prom")
+        metrics.MetricsFile(path).write()
+
+        with open(path) as f:
+            self.assertEqual(metrics.registry.render(), f.read())
+        self.assertEqual(["etcd_managers.prom"], os.listdir(self.dir))
+
+    def test_services(self):
+        self.assertEqual([], metrics.metrics_services("0", None))
+        services = metrics.metrics_services("9999", "/tmp/metrics.prom")
+        self.assertIsInstance(services[0], metrics.MetricsServer)
+        self.assertIsInstance(services[1], metrics.MetricsFile)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.clear()
+
+    def test_plugin_hooks(self):
+        class TestPlugin(object):
+            def on_cluster_changing(self, cluster_view):
+                pass
+
+            def on_joining_cluster(self, cluster_view):
+                raise ValueError()
+
+        plugin = TestPlugin()
+        safe_plugin(plugin.on_cluster_changing, {})
+        safe_plugin(plugin.on_joining_cluster, {})
+
+        self.assertEqual(1, metrics.plugin_hook_seconds.count(
+                                plugin="TestPlugin",
+                                hook="on_cluster_changing"))
+        self.assertEqual(1, metrics.plugin_hook_seconds.count(
+                                plugin="TestPlugin",
+                                hook="on_joining_cluster"))
+        self.assertEqual(1, metrics.plugin_hook_errors.value(
+                                plugin="TestPlugin",
+                                hook="on_joining_cluster"))
+
+    @patch("subprocess.Popen")
+    def test_commands(self, mock_popen):
+        process = MagicMock()
+        process.communicate.return_value = ("", "")
+        process.returncode = 1
+        mock_popen.return_value = process
+
+        run_command(["/usr/bin/nodetool", "status"], namespace="signaling")
+
+        # The command is labelled by the program it runs, not the namespace
+        # wrapper.
+        self.assertEqual(1, metrics.command_seconds.count(command="nodetool"))
+        self.assertEqual(1, metrics.command_failures.value(command="nodetool"))
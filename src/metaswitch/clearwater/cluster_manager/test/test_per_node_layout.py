@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+import json
+from mock import patch
+from etcd import EtcdResult, EtcdKeyNotFound, EtcdCompareFailed
+from metaswitch.clearwater.cluster_manager.per_node_synchronizer import \
+    PerNodeEtcdSynchronizer
+from metaswitch.clearwater.cluster_manager.cluster_state import ClusterInfo
+from metaswitch.clearwater.cluster_manager import constants
+from .synchronizer_helpers import make_result, make_synchronizer
+
+DIRECTORY = "/test_nodes"
+
+
+def make_directory(nodes, etcd_index):
+    # nodes is a list of (IP, state, modifiedIndex)
+    r = EtcdResult(None, {"key": DIRECTORY,
+                          "dir": True,
+                          "nodes": [{"key": DIRECTORY + "/" + ip,
+                                     "value": state,
+                                     "modifiedIndex": index}
+                                    for ip, state, index in nodes]})
+    r.etcd_index = etcd_index
+    return r
+
+
+@patch("metaswitch.clearwater.cluster_manager.alarms.alarm_manager")
+class TestPerNodeLayout(unittest.TestCase):
+
+    def make_synchronizer(self, nodes):
+        syncer = make_synchronizer(PerNodeEtcdSynchronizer)
+        syncer._client.read.return_value = make_directory(nodes, 20)
+        syncer._client.write.return_value = make_result(None, 21)
+        syncer._client.delete.return_value = make_result(None, 21)
+        return syncer
+
+    def read_cluster(self, syncer):
+        value, index = syncer.read_from_etcd(wait=False)
+        return ClusterInfo(value), index
+
+    def test_read_builds_view(self, alarm_manager):
+        syncer = self.make_synchronizer([("10.0.0.1", constants.NORMAL, 5),
+                                         ("10.0.0.2", constants.JOINING, 7)])
+        info, index = self.read_cluster(syncer)
+
+        self.assertEqual({"10.0.0.1": constants.NORMAL,
+                          "10.0.0.2": constants.JOINING},
+                         info.view)
+        self.assertEqual(constants.STARTED_JOINING, info.cluster_state)
+
+        # The view's index is the etcd index, so that it covers deleted keys
+        self.assertEqual(20, index)
+        syncer._client.read.assert_called_once_with(DIRECTORY,
+                                                    quorum=True,
+                                                    recursive=True,
+                                                    timeout=None)
+
+    def test_read_empty_cluster(self, alarm_manager):
+        syncer = self.make_synchronizer([])
+        syncer._client.read.side_effect = EtcdKeyNotFound(
+                                              payload={"index": 15})
+        info, index = self.read_cluster(syncer)
+
+        self.assertEqual({}, info.view)
+        self.assertEqual(15, index)
+
+    def test_write_own_state(self, alarm_manager):
+        # Only this node's key is written, checked against the index it was
+        # read at, so other nodes' writes can't conflict with it
+        syncer = self.make_synchronizer([("10.0.0.1", constants.NORMAL, 5),
+                                         ("10.0.0.2", constants.JOINING, 7)])
+        info, _ = self.read_cluster(syncer)
+        syncer.write_to_etcd(info, constants.NORMAL_ACKNOWLEDGED_CHANGE)
+
+        syncer._client.write.assert_called_once_with(
+            DIRECTORY + "/10.0.0.1",
+            constants.NORMAL_ACKNOWLEDGED_CHANGE,
+            prevIndex=5)
+
+    def test_join_new_cluster(self, alarm_manager):
+        syncer = self.make_synchronizer([("10.0.0.2", constants.NORMAL, 7)])
+        info, _ = self.read_cluster(syncer)
+        syncer.write_to_etcd(info, constants.WAITING_TO_JOIN)
+
+        syncer._client.write.assert_called_once_with(
+            DIRECTORY + "/10.0.0.1",
+            constants.WAITING_TO_JOIN,
+            prevExist=False)
+
+    def test_leave_cluster_deletes_own_key(self, alarm_manager):
+        syncer = self.make_synchronizer([("10.0.0.1", constants.FINISHED, 5),
+                                         ("10.0.0.2", constants.NORMAL, 7)])
+        info, _ = self.read_cluster(syncer)
+        syncer.write_to_etcd(info, constants.DELETE_ME)
+
+        syncer._client.delete.assert_called_once_with(DIRECTORY + "/10.0.0.1")
+        self.assertFalse(syncer._client.write.called)
+
+    def test_switch_all_to_joining(self, alarm_manager):
+        syncer = self.make_synchronizer(
+                     [("10.0.0.1", constants.WAITING_TO_JOIN, 5),
+                      ("10.0.0.2", constants.NORMAL, 7),
+                      ("10.0.0.3", constants.WAITING_TO_JOIN, 9)])
+        info, _ = self.read_cluster(syncer)
+
+        # Another node has already switched 10.0.0.3, so our write to it
+        # fails, but we still switch the other waiting nodes
+        def write(key, value, prevIndex=None, prevExist=None):
+            if key.endswith("10.0.0.3"):
+                raise EtcdCompareFailed()
+            return make_result(None, 21)
+        syncer._client.write.side_effect = write
+
+        syncer.write_to_etcd(info, syncer._fsm._switch_all_to_joining(info.view))
+
+        writes = sorted(call[0] + (call[1].get("prevIndex"),)
+                        for call in syncer._client.write.call_args_list)
+        self.assertEqual([(DIRECTORY + "/10.0.0.1", constants.JOINING, 5),
+                          (DIRECTORY + "/10.0.0.3", constants.JOINING, 9)],
+                         writes)
+
+    def test_stale_view_is_not_written(self, alarm_manager):
+        syncer = self.make_synchronizer([("10.0.0.1", constants.NORMAL, 5)])
+        info = ClusterInfo(json.dumps({"10.0.0.1": constants.NORMAL,
+                                       "10.0.0.2": constants.JOINING}))
+        syncer.write_to_etcd(info, constants.NORMAL_ACKNOWLEDGED_CHANGE)
+
+        self.assertFalse(syncer._client.write.called)
+        self.assertIsNone(syncer._last_value)
+
+    def test_finish_interrupted_switch(self, alarm_manager):
+        # Another node has started switching the waiting nodes to JOINING,
+        # but hasn't got to us yet
+        syncer = self.make_synchronizer(
+                     [("10.0.0.1", constants.WAITING_TO_JOIN, 5),
+                      ("10.0.0.2", constants.NORMAL, 7),
+                      ("10.0.0.3", constants.JOINING, 9)])
+        info, _ = self.read_cluster(syncer)
+        self.assertEqual(constants.INVALID_CLUSTER_STATE, info.cluster_state)
+        self.assertEqual(constants.JOINING, syncer.reconcile(info))
+
+    def test_withdraw_after_missed_switch(self, alarm_manager):
+        # The rest of the cluster has moved on past the point where we could
+        # join it, so back out until it's stable again
+        syncer = self.make_synchronizer(
+                     [("10.0.0.1", constants.WAITING_TO_JOIN, 5),
+                      ("10.0.0.2", constants.NORMAL_CONFIG_CHANGED, 7),
+                      ("10.0.0.3", constants.JOINING_ACKNOWLEDGED_CHANGE, 9)])
+        info, _ = self.read_cluster(syncer)
+        self.assertEqual(constants.DELETE_ME, syncer.reconcile(info))
+
+    def test_no_reconcile_in_valid_state(self, alarm_manager):
+        syncer = self.make_synchronizer(
+                     [("10.0.0.1", constants.WAITING_TO_JOIN, 5),
+                      ("10.0.0.2", constants.NORMAL, 7)])
+        info, _ = self.read_cluster(syncer)
+        self.assertIsNone(syncer.reconcile(info))
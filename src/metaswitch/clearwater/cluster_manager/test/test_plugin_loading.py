@@ -8,9 +8,16 @@
 # Metaswitch Networks in a separate written agreement.
 
 import unittest
+from mock import patch
+from metaswitch.clearwater.etcd_shared import plugin_loader
 from metaswitch.clearwater.etcd_shared.plugin_loader \
-    import load_plugins_in_dir
+    import load_plugins_in_dir, manifest_file, plugin_name
+from metaswitch.clearwater.etcd_shared.test import plugin_loading_benchmark
 import os
+import shutil
+import tempfile
+
+PLUGIN_COUNT = 5
 
 
 class TestPluginLoading(unittest.TestCase):
@@ -23,3 +30,83 @@ class TestPluginLoading(unittest.TestCase):
         # Check that the plugin loaded successfully
         self.assertEqual(plugins[0].__class__.__name__,
                          "PluginLoaderTestPlugin")
+
+
+class TestLazyPluginLoading(unittest.TestCase):
+
+    def setUp(self):
+        # Copy the test plugin into a scratch plugin directory, and keep the
+        # manifest in a scratch directory too
+        self.tmp_dir = tempfile.mkdtemp()
+        self.plugin_dir = os.path.join(self.tmp_dir, "plugins")
+        manifest_dir = patch.object(plugin_loader,
+                                    "MANIFEST_DIR",
+                                    os.path.join(self.tmp_dir, "manifests"))
+        manifest_dir.start()
+        self.addCleanup(manifest_dir.stop)
+        os.mkdir(self.plugin_dir)
+        source = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                              "plugins",
+                              "plugin_loader_test_plugin.py")
+        for i in range(PLUGIN_COUNT):
+            shutil.copy(source, os.path.join(self.plugin_dir,
+                                             "plugin_{}.py".format(i)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @patch("metaswitch.clearwater.etcd_shared.plugin_loader._load_plugin",
+           side_effect=plugin_loader._load_plugin)
+    def test_manifest(self, load_plugin):
+        # The first time, every plugin is imported, and the manifest written
+        plugins = load_plugins_in_dir(self.plugin_dir, None, lazy=True)
+        self.assertEqual(PLUGIN_COUNT, len(plugins))
+        self.assertEqual(PLUGIN_COUNT, load_plugin.call_count)
+        self.assertTrue(os.path.exists(manifest_file(self.plugin_dir)))
+
+        # The next time, nothing is imported until it's needed
+        load_plugin.reset_mock()
+        plugins = load_plugins_in_dir(self.plugin_dir, None, lazy=True)
+        self.assertEqual(PLUGIN_COUNT, len(plugins))
+        self.assertEqual(0, load_plugin.call_count)
+        self.assertEqual("/test", plugins[0].key())
+        self.assertEqual("PluginLoaderTestPlugin", plugin_name(plugins[0]))
+        self.assertEqual(0, load_plugin.call_count)
+
+        plugins[0].on_stable_cluster({})
+        plugins[0].on_leaving_cluster({})
+        self.assertEqual(1, load_plugin.call_count)
+
+    @patch("metaswitch.clearwater.etcd_shared.plugin_loader._load_plugin",
+           side_effect=plugin_loader._load_plugin)
+    def test_changed_plugin(self, load_plugin):
+        load_plugins_in_dir(self.plugin_dir, None, lazy=True)
+
+        # A plugin that's changed since is imported straight away
+        path = os.path.join(self.plugin_dir, "plugin_0.py")
+        os.utime(path, (0, 0))
+        load_plugin.reset_mock()
+        plugins = load_plugins_in_dir(self.plugin_dir, None, lazy=True)
+        self.assertEqual(1, load_plugin.call_count)
+        self.assertEqual("PluginLoaderTestPlugin",
+                         plugins[0].__class__.__name__)
+
+    @patch("metaswitch.clearwater.etcd_shared.plugin_loader._load_plugin",
+           side_effect=plugin_loader._load_plugin)
+    def test_changed_params(self, load_plugin):
+        # The manifest isn't used if the plugins' parameters have changed
+        load_plugins_in_dir(self.plugin_dir, None, lazy=True)
+        load_plugin.reset_mock()
+        load_plugins_in_dir(self.plugin_dir, {"ip": "10.0.0.1"}, lazy=True)
+        self.assertEqual(PLUGIN_COUNT, load_plugin.call_count)
+
+
+class TestPluginLoadingBenchmark(unittest.TestCase):
+
+    def test_benchmark(self):
+        times = plugin_loading_benchmark.run(count=3, runs=1, import_cost=0.05)
+
+        # A warm start doesn't import any of the modules
+        self.assertEqual(set(plugin_loading_benchmark.MODES), set(times))
+        self.assertLess(times["warm"][0], 0.05)
+        self.assertGreater(times["cold"][0], 0.05)
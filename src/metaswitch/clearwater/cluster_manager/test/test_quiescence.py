@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+from mock import MagicMock, patch
+from metaswitch.clearwater.cluster_manager.synchronization_fsm import SyncFSM
+from metaswitch.clearwater.cluster_manager.cluster_state import ClusterInfo
+from metaswitch.clearwater.cluster_manager import constants
+from .dummy_plugin import DummyPlugin
+import json
+
+
+@patch("metaswitch.clearwater.cluster_manager.synchronization_fsm.time")
+@patch("metaswitch.clearwater.cluster_manager.alarms.alarm_manager")
+class TestQuiescence(unittest.TestCase):
+
+    def setUp(self):
+        self.old_delay, self.old_quiet = SyncFSM.DELAY, SyncFSM.QUIET_PERIOD
+        SyncFSM.DELAY = 30
+        SyncFSM.QUIET_PERIOD = 5
+        self.plugin = DummyPlugin(None)
+        self.recheck_after = MagicMock()
+        self.fsm = SyncFSM(self.plugin, "10.0.0.1",
+                           recheck_after=self.recheck_after)
+
+    def tearDown(self):
+        SyncFSM.DELAY, SyncFSM.QUIET_PERIOD = self.old_delay, self.old_quiet
+        self.fsm.quit()
+
+    def next_at(self, time, now, view):
+        time.return_value = now
+        info = ClusterInfo(json.dumps(view))
+        return self.fsm.next(info.local_state("10.0.0.1"),
+                             info.cluster_state,
+                             info.view)
+
+    def test_single_joiner(self, alarm_manager, time):
+        view = {"10.0.0.1": constants.WAITING_TO_JOIN,
+                "10.0.0.2": constants.NORMAL}
+
+        # We don't block, but ask to be woken once the quiet period is over
+        self.assertIsNone(self.next_at(time, 100, view))
+        self.recheck_after.assert_called_once_with(5)
+
+        new_state = self.next_at(time, 105, view)
+        self.assertEqual(constants.JOINING, new_state["10.0.0.1"])
+
+    def test_new_joiner_extends_window(self, alarm_manager, time):
+        view = {"10.0.0.1": constants.WAITING_TO_JOIN,
+                "10.0.0.2": constants.NORMAL}
+        self.assertIsNone(self.next_at(time, 100, view))
+
+        view["10.0.0.3"] = constants.WAITING_TO_JOIN
+        self.assertIsNone(self.next_at(time, 103, view))
+        self.recheck_after.assert_called_with(5)
+        self.assertIsNone(self.next_at(time, 105, view))
+
+        new_state = self.next_at(time, 108, view)
+        self.assertEqual(constants.JOINING, new_state["10.0.0.1"])
+        self.assertEqual(constants.JOINING, new_state["10.0.0.3"])
+
+    def test_delay_is_upper_bound(self, alarm_manager, time):
+        view = {"10.0.0.1": constants.WAITING_TO_JOIN,
+                "10.0.0.2": constants.NORMAL}
+        now = 100
+        for ip in range(3, 10):
+            # A new node keeps arriving within the quiet period
+            self.assertIsNone(self.next_at(time, now, view))
+            view["10.0.0.{}".format(ip)] = constants.WAITING_TO_JOIN
+            now += 4
+
+        # We stop waiting 30s after the first node arrived
+        self.assertIsNone(self.next_at(time, now, view))
+        self.recheck_after.assert_called_with(2)
+        new_state = self.next_at(time, 130, view)
+        self.assertEqual(constants.JOINING, new_state["10.0.0.9"])
+
+    def test_expected_cluster_size(self, alarm_manager, time):
+        self.plugin.expected_cluster_size = lambda: 3
+        view = {"10.0.0.1": constants.WAITING_TO_JOIN,
+                "10.0.0.2": constants.NORMAL,
+                "10.0.0.3": constants.WAITING_TO_JOIN}
+        new_state = self.next_at(time, 100, view)
+        self.assertEqual(constants.JOINING, new_state["10.0.0.1"])
+        self.assertFalse(self.recheck_after.called)
+
+    def test_leaving(self, alarm_manager, time):
+        self.plugin.expected_cluster_size = lambda: 1
+        view = {"10.0.0.1": constants.WAITING_TO_LEAVE,
+                "10.0.0.2": constants.NORMAL,
+                "10.0.0.3": constants.NORMAL}
+
+        # Leaving would leave two nodes, not one, so wait for another leaver
+        self.assertIsNone(self.next_at(time, 100, view))
+        view["10.0.0.3"] = constants.WAITING_TO_LEAVE
+        new_state = self.next_at(time, 101, view)
+        self.assertEqual(constants.LEAVING, new_state["10.0.0.3"])
+
+    def test_window_reset_when_cluster_moves_on(self, alarm_manager, time):
+        view = {"10.0.0.1": constants.WAITING_TO_JOIN,
+                "10.0.0.2": constants.NORMAL}
+        self.assertIsNone(self.next_at(time, 100, view))
+        self.next_at(time, 101, {"10.0.0.1": constants.NORMAL,
+                                 "10.0.0.2": constants.NORMAL})
+
+        # A later scale-up waits its own quiet period
+        self.assertIsNone(self.next_at(time, 200, view))
+        self.recheck_after.assert_called_with(5)
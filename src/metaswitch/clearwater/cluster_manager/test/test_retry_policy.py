@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+from mock import patch
+from metaswitch.clearwater.etcd_shared.retry_policy import \
+    CircuitBreaker, RetryPolicy, circuit_breaker
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_backoff(self):
+        # With no jitter, the delay doubles from the first retry delay up to
+        # the maximum
+        policy = RetryPolicy("10.0.0.1", 1)
+        policy._breaker = CircuitBreaker("10.0.0.1")
+        policy._breaker.FAILURE_THRESHOLD = 100
+
+        delays = []
+        with patch("metaswitch.clearwater.etcd_shared.retry_policy.uniform",
+                   side_effect=lambda low, high: high):
+            for _ in range(5):
+                policy.failed()
+                delays.append(policy.next_delay())
+
+        self.assertEqual([0.2, 0.4, 0.8, 1, 1], delays)
+
+    def test_success_resets_backoff(self):
+        policy = RetryPolicy("10.0.0.2", 30)
+        for _ in range(10):
+            policy.failed()
+        policy.succeeded()
+        policy.failed()
+        self.assertLessEqual(policy.next_delay(), RetryPolicy.FIRST_RETRY_DELAY)
+
+    def test_no_endpoint(self):
+        # Without an endpoint there's no breaker, so however many failures
+        # there are, the delay is just the backoff
+        policy = RetryPolicy(None, 1)
+        for _ in range(CircuitBreaker.FAILURE_THRESHOLD + 1):
+            policy.failed()
+        self.assertIsNone(policy._breaker)
+        self.assertEqual(CircuitBreaker.FAILURE_THRESHOLD + 1, policy.attempts)
+        self.assertLessEqual(policy.next_delay(), 1)
+
+    def test_use_endpoint(self):
+        # Once the caller moves to another member, failures count against
+        # that member's breaker and not the one it started with
+        policy = RetryPolicy("10.0.0.5", 1)
+        policy.use_endpoint("10.0.0.6")
+        for _ in range(CircuitBreaker.FAILURE_THRESHOLD):
+            policy.failed()
+        self.assertTrue(circuit_breaker("10.0.0.6").is_open())
+        self.assertFalse(circuit_breaker("10.0.0.5").is_open())
+
+        # A policy with no endpoint still has no breaker
+        policy = RetryPolicy(None, 1)
+        policy.use_endpoint("10.0.0.6")
+        self.assertIsNone(policy._breaker)
+
+    def test_breakers_shared_by_endpoint(self):
+        self.assertIs(circuit_breaker("10.0.0.3"), circuit_breaker("10.0.0.3"))
+        self.assertIsNot(circuit_breaker("10.0.0.3"),
+                         circuit_breaker("10.0.0.4"))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    @patch("metaswitch.clearwater.etcd_shared.retry_policy.time")
+    def test_open_and_close(self, time):
+        time.return_value = 100
+        breaker = CircuitBreaker("10.0.0.1")
+
+        for _ in range(CircuitBreaker.FAILURE_THRESHOLD - 1):
+            breaker.record_failure()
+        self.assertFalse(breaker.is_open())
+        self.assertEqual(0, breaker.wait_time())
+
+        # Enough failures open the breaker, and everyone waits for it
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open())
+        self.assertEqual(CircuitBreaker.OPEN_INTERVAL, breaker.wait_time())
+
+        # Once the interval has passed, one caller is let through to try the
+        # endpoint, and the rest keep waiting
+        time.return_value = 100 + CircuitBreaker.OPEN_INTERVAL
+        self.assertEqual(0, breaker.wait_time())
+        self.assertEqual(CircuitBreaker.OPEN_INTERVAL, breaker.wait_time())
+
+        # That caller succeeds, so the breaker closes
+        breaker.record_success()
+        self.assertFalse(breaker.is_open())
+        self.assertEqual(0, breaker.wait_time())
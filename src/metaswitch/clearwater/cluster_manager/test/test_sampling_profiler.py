@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import os
+import shutil
+import tempfile
+import unittest
+from collections import defaultdict
+from threading import Event, Thread
+from metaswitch.clearwater.etcd_shared.sampling_profiler import \
+    SamplingProfiler
+
+
+def busy_plugin(entered, event):
+    entered.set()
+    event.wait()
+
+
+class TestSamplingProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.profiler = SamplingProfiler(self.dir, "cluster-manager")
+        self.profiler.INTERVAL = 0.001
+
+        self.event = Event()
+        entered = Event()
+        self.thread = Thread(target=busy_plugin,
+                             args=(entered, self.event),
+                             name="TestPlugin")
+        self.thread.start()
+
+        # Don't sample until the thread is in busy_plugin().
+        self.assertTrue(entered.wait(5))
+
+    def tearDown(self):
+        self.event.set()
+        self.thread.join()
+        shutil.rmtree(self.dir)
+
+    def test_sample(self):
+        stacks = defaultdict(int)
+        self.profiler.sample(stacks)
+
+        # The plugin thread's stack starts with its name, and includes the
+        # function it's blocked in.
+        stack = [s for s in stacks if s.startswith("TestPlugin;")][0]
+        self.assertIn("busy_plugin_(test_sampling_profiler.py:", stack)
+        self.assertEqual(1, stacks[stack])
+
+    def test_toggle(self):
+        self.profiler.toggle()
+        self.assertTrue(self.profiler.is_running())
+        self.profiler.toggle()
+        self.profiler._thread.join()
+        self.assertFalse(self.profiler.is_running())
+
+        # Stopping the profiler writes out every stack it saw, with a count.
+        files = os.listdir(self.dir)
+        self.assertEqual(1, len(files))
+        self.assertTrue(files[0].startswith("cluster-manager-profile-"))
+        with open(os.path.join(self.dir, files[0])) as f:
+            lines = f.read().splitlines()
+        plugin_lines = [l for l in lines if l.startswith("TestPlugin;")]
+        self.assertTrue(plugin_lines)
+        self.assertTrue(int(plugin_lines[0].rsplit(" ", 1)[1]) >= 1)
+
+    def test_max_duration(self):
+        self.profiler.MAX_DURATION = 0
+        self.profiler.start()
+        self.profiler._thread.join()
+        self.assertEqual(1, len(os.listdir(self.dir)))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from metaswitch.clearwater.cluster_manager.scale_timing import \
+    ScaleTimingRecorder, load_records, node_timings, scale_operations, main
+from metaswitch.clearwater.cluster_manager import constants
+
+KEY = "/test"
+
+# A node (10.0.0.3) joining a cluster of two, as a list of (time, changes)
+SCALE_UP = [(100, {"10.0.0.3": constants.WAITING_TO_JOIN}),
+            (105, {"10.0.0.3": constants.JOINING}),
+            (106, {"10.0.0.1": constants.NORMAL_ACKNOWLEDGED_CHANGE}),
+            (106.5, {"10.0.0.3": constants.JOINING_ACKNOWLEDGED_CHANGE}),
+            (107, {"10.0.0.2": constants.NORMAL_ACKNOWLEDGED_CHANGE}),
+            (110, {"10.0.0.2": constants.NORMAL_CONFIG_CHANGED}),
+            (111, {"10.0.0.3": constants.JOINING_CONFIG_CHANGED}),
+            (140, {"10.0.0.1": constants.NORMAL_CONFIG_CHANGED}),
+            (150, {"10.0.0.1": constants.NORMAL}),
+            (152, {"10.0.0.2": constants.NORMAL}),
+            (190, {"10.0.0.3": constants.NORMAL})]
+
+
+def make_records(changes):
+    records = [{"t": 0,
+                "key": KEY,
+                "snapshot": True,
+                "nodes": {"10.0.0.1": constants.NORMAL,
+                          "10.0.0.2": constants.NORMAL}}]
+    records.extend({"t": t, "key": KEY, "nodes": nodes}
+                   for t, nodes in changes)
+    return records
+
+
+class TestScaleTimingRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "scale-timing.log")
+        self.recorder = ScaleTimingRecorder(self.path)
+        self.recorder.start_thread()
+
+    def tearDown(self):
+        self.recorder.terminate()
+        shutil.rmtree(self.dir)
+
+    @patch("metaswitch.clearwater.cluster_manager.scale_timing.time")
+    def test_records_changes(self, time):
+        time.return_value = 10
+        self.recorder.observe(KEY, {"10.0.0.1": constants.NORMAL})
+        self.recorder.observe(KEY, {"10.0.0.1": constants.NORMAL})
+        time.return_value = 12
+        self.recorder.observe(KEY, {"10.0.0.2": constants.WAITING_TO_JOIN})
+        self.recorder.terminate()
+
+        with open(self.path) as f:
+            records = load_records(f)
+
+        # Only changes are recorded, after a first snapshot of the cluster
+        self.assertEqual(
+            [{"t": 10,
+              "key": KEY,
+              "snapshot": True,
+              "nodes": {"10.0.0.1": constants.NORMAL}},
+             {"t": 12,
+              "key": KEY,
+              "nodes": {"10.0.0.1": None,
+                        "10.0.0.2": constants.WAITING_TO_JOIN}}],
+            records)
+
+
+class TestScaleTimingAnalysis(unittest.TestCase):
+
+    def test_phases(self):
+        operations = scale_operations(make_records(SCALE_UP), KEY)
+        self.assertEqual(1, len(operations))
+
+        phases = [(phase["state"],
+                   phase["end"] - phase["start"],
+                   phase["slowest"])
+                  for phase in operations[0]]
+        self.assertEqual(
+            [(constants.JOIN_PENDING, 5, "10.0.0.3"),
+             (constants.STARTED_JOINING, 2, "10.0.0.2"),
+             (constants.JOINING_CONFIG_CHANGING, 33, "10.0.0.1"),
+             (constants.JOINING_RESYNCING, 50, "10.0.0.3")],
+            phases)
+
+        # Each node's time to move on in the config changing phase
+        self.assertEqual({"10.0.0.1": 33, "10.0.0.2": 3, "10.0.0.3": 4},
+                         operations[0][2]["nodes"])
+
+    def test_operation_in_progress(self):
+        operations = scale_operations(make_records(SCALE_UP[:7]), KEY)
+        self.assertEqual(constants.JOINING_CONFIG_CHANGING,
+                         operations[0][-1]["state"])
+        self.assertIsNone(operations[0][-1]["end"])
+
+    def test_node_timings(self):
+        timings = [timing for timing in node_timings(make_records(SCALE_UP),
+                                                     KEY)
+                   if timing[0] == "10.0.0.3"]
+        self.assertEqual(
+            [("10.0.0.3", constants.WAITING_TO_JOIN, 100, 105),
+             ("10.0.0.3", constants.JOINING, 105, 106.5),
+             ("10.0.0.3", constants.JOINING_ACKNOWLEDGED_CHANGE, 106.5, 111),
+             ("10.0.0.3", constants.JOINING_CONFIG_CHANGED, 111, 190),
+             ("10.0.0.3", constants.NORMAL, 190, None)],
+            timings)
+
+    def test_restart_keeps_unchanged_states(self):
+        # The cluster manager restarted part way through, so the first record
+        # after the restart is a snapshot
+        records = make_records(SCALE_UP[:3])
+        records.append({"t": 120,
+                        "key": KEY,
+                        "snapshot": True,
+                        "nodes": {"10.0.0.1": constants.NORMAL_ACKNOWLEDGED_CHANGE,
+                                  "10.0.0.2": constants.NORMAL,
+                                  "10.0.0.3": constants.JOINING}})
+        timings = node_timings(records, KEY)
+        self.assertIn(("10.0.0.1", constants.NORMAL_ACKNOWLEDGED_CHANGE,
+                       106, None), timings)
+        self.assertIn(("10.0.0.3", constants.JOINING, 105, None), timings)
+
+    def test_main(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, "scale-timing.log")
+        with open(path, "w") as f:
+            for record in make_records(SCALE_UP):
+                f.write(json.dumps(record) + "\n")
+
+        with patch("sys.stdout") as stdout:
+            main(["--json", "--key=" + KEY, path])
+        output = "".join(call[0][0] for call in stdout.write.call_args_list)
+        self.assertEqual([KEY], json.loads(output).keys())
+        self.assertEqual(4, len(json.loads(output)[KEY][0]))
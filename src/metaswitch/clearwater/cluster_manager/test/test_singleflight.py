@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+from threading import Event, Thread
+from time import sleep
+from metaswitch.clearwater.etcd_shared.singleflight import SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.group = SingleFlight()
+        self.release = Event()
+        self.calls = 0
+        self.results = []
+
+    def slow_read(self):
+        self.calls += 1
+        self.release.wait(5)
+        if isinstance(self.response, Exception):
+            raise self.response
+        return self.response
+
+    def start_reads(self, key_for_thread):
+        threads = []
+        for key in key_for_thread:
+            thread = Thread(target=self.read, args=(key,))
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def read(self, key):
+        try:
+            self.results.append(self.group.do(key, self.slow_read))
+        except Exception as e:
+            self.results.append(e)
+
+    def wait_for_sharing(self, count):
+        for _ in range(500):
+            if self.group.shared_count == count:
+                return
+            sleep(0.01)
+        self.fail("Requests weren't shared")
+
+    def test_concurrent_reads_shared(self):
+        self.response = "value"
+        threads = self.start_reads(["key", "key", "key"])
+        self.wait_for_sharing(2)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, self.calls)
+        self.assertEqual(["value"] * 3, self.results)
+
+    def test_exception_shared(self):
+        self.response = ValueError()
+        threads = self.start_reads(["key", "key"])
+        self.wait_for_sharing(1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, self.calls)
+        self.assertTrue(all(isinstance(r, ValueError) for r in self.results))
+
+    def test_later_reads_not_shared(self):
+        self.response = "value"
+        self.release.set()
+        self.group.do("key", self.slow_read)
+        self.group.do("key", self.slow_read)
+        self.assertEqual(2, self.calls)
+        self.assertEqual(0, self.group.shared_count)
+
+    def test_fresh_read_not_shared(self):
+        # A fresh read doesn't join the read already in flight, and reads
+        # made after it share it instead
+        self.response = "old"
+        stale = self.start_reads(["key"])
+        for _ in range(500):
+            if self.calls == 1:
+                break
+            sleep(0.01)
+
+        fresh_release = Event()
+
+        def fresh_read():
+            self.calls += 1
+            fresh_release.wait(5)
+            return "new"
+
+        fresh = Thread(target=lambda: self.results.append(
+            self.group.do("key", fresh_read, fresh=True)))
+        fresh.start()
+        for _ in range(500):
+            if self.calls == 2:
+                break
+            sleep(0.01)
+        self.assertEqual(0, self.group.shared_count)
+
+        later = self.start_reads(["key"])
+        self.wait_for_sharing(1)
+
+        # The stale read finishing doesn't stop the fresh one being shared
+        self.release.set()
+        stale[0].join()
+        fresh_release.set()
+        fresh.join()
+        later[0].join()
+
+        self.assertEqual(2, self.calls)
+        self.assertEqual(["old", "new", "new"], self.results)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+from mock import patch
+from etcd import EtcdResult, EtcdKeyNotFound
+from metaswitch.clearwater.etcd_shared.startup_snapshot import \
+    StartupSnapshot, parent_directories
+from .synchronizer_helpers import DNS_KEY, KeySynchronizer, make_result, \
+    make_synchronizer
+
+SHARED_KEY = "/clearwater/site1/configuration/shared_config"
+CLUSTER_KEY = "/clearwater/site1/node_type/clustering/memcached"
+
+
+def make_snapshot(values, etcd_index,
+                  directory="/clearwater/site1/configuration"):
+    nodes = [{"key": key, "value": value, "modifiedIndex": index}
+             for key, (value, index) in values.items()]
+    result = EtcdResult("get", {"key": directory,
+                                "dir": True,
+                                "nodes": nodes})
+    result.etcd_index = etcd_index
+    return result
+
+
+class TestStartupSnapshot(unittest.TestCase):
+
+    @patch("metaswitch.clearwater.etcd_shared.startup_snapshot.create_client")
+    def setUp(self, create_client):
+        self.read = create_client.return_value.read
+        self.snapshot = StartupSnapshot("10.0.0.1")
+        self.dns = make_synchronizer(KeySynchronizer)
+        self.shared = make_synchronizer(KeySynchronizer, key=SHARED_KEY)
+
+    def test_parent_directories(self):
+        self.assertEqual(set(["/clearwater/site1/configuration"]),
+                         parent_directories([DNS_KEY, SHARED_KEY]))
+        self.assertEqual(set(["/clearwater/site1/configuration",
+                              "/clearwater/site1/node_type/clustering"]),
+                         parent_directories([DNS_KEY, CLUSTER_KEY]))
+
+    def test_seeds_synchronizers(self):
+        # One read of their directory seeds every synchronizer whose key
+        # exists
+        self.read.return_value = make_snapshot({DNS_KEY: ("dns", 5)}, 20)
+        self.assertEqual(1, self.snapshot.seed([self.dns, self.shared]))
+        self.read.assert_called_once_with("/clearwater/site1/configuration",
+                                          quorum=True)
+
+        # The seeded synchronizer uses its value without reading its key,
+        # then watches from the snapshot's index
+        self.dns._client.read.return_value = make_result("new dns", 25)
+        self.assertEqual("dns", self.dns.update_from_etcd())
+        self.dns._client.read.assert_not_called()
+
+        self.assertEqual("new dns", self.dns.update_from_etcd())
+        self.assertEqual(21, self.dns._client.read.call_args[1]["waitIndex"])
+
+        # The other synchronizer reads its key as usual
+        self.assertIsNone(self.shared._seed)
+
+    def test_nothing_to_seed(self):
+        self.read.side_effect = EtcdKeyNotFound()
+        self.assertEqual(0, self.snapshot.seed([self.dns, self.shared]))
+        self.assertIsNone(self.dns._seed)
+
+    def test_read_fails(self):
+        self.read.side_effect = ValueError()
+        self.assertEqual(0, self.snapshot.seed([self.dns]))
+        self.assertIsNone(self.dns._seed)
+
+    def test_reads_each_directory(self):
+        # Keys in different directories are read a directory at a time,
+        # rather than by reading everything under /clearwater
+        cluster = make_synchronizer(KeySynchronizer, key=CLUSTER_KEY)
+        snapshots = {
+            "/clearwater/site1/configuration":
+                make_snapshot({DNS_KEY: ("dns", 5)}, 20),
+            "/clearwater/site1/node_type/clustering":
+                make_snapshot({CLUSTER_KEY: ("{}", 8)},
+                              21,
+                              "/clearwater/site1/node_type/clustering")}
+        self.read.side_effect = lambda key, **kwargs: snapshots[key]
+
+        self.assertEqual(2, self.snapshot.seed([self.dns, cluster]))
+        self.assertEqual(sorted(snapshots),
+                         sorted(call[0][0] for call in
+                                self.read.call_args_list))
+        self.assertEqual(("{}", 8, 21), cluster._seed)
+
+    def test_one_directory_fails(self):
+        # The synchronizers in a directory that can't be read read their own
+        # keys, and the rest are still seeded
+        cluster = make_synchronizer(KeySynchronizer, key=CLUSTER_KEY)
+
+        def read(key, **kwargs):
+            if key == "/clearwater/site1/configuration":
+                raise ValueError()
+            return make_snapshot({CLUSTER_KEY: ("{}", 8)},
+                                 21,
+                                 "/clearwater/site1/node_type/clustering")
+        self.read.side_effect = read
+
+        self.assertEqual(1, self.snapshot.seed([self.dns, cluster]))
+        self.assertIsNone(self.dns._seed)
+        self.assertIsNotNone(cluster._seed)
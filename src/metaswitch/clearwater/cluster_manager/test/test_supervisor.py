@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+from mock import MagicMock, patch
+from metaswitch.clearwater.etcd_shared.common_etcd_synchronizer import \
+    CommonEtcdSynchronizer
+from metaswitch.clearwater.etcd_shared.supervisor import Supervisor
+
+
+class FlakySynchronizer(CommonEtcdSynchronizer):
+    # Fails the first few times it's run, then finishes normally.
+    def __init__(self, failures, *args, **kwargs):
+        super(FlakySynchronizer, self).__init__(*args, **kwargs)
+        self.failures = failures
+        self.runs = 0
+
+    def key(self):
+        return "/clearwater/site1/configuration/flaky"
+
+    def main(self):
+        self.runs += 1
+        if self.runs <= self.failures:
+            raise ValueError("Flaky plugin failed")
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = Supervisor()
+        self.supervisor.INITIAL_BACKOFF = 0
+
+    @patch("etcd.Client")
+    def test_failed_thread_restarted(self, client):
+        flaky = FlakySynchronizer(2, MagicMock(), "10.0.0.1")
+        healthy = FlakySynchronizer(0, MagicMock(), "10.0.0.1")
+        for syncer in (flaky, healthy):
+            self.supervisor.add(syncer)
+            syncer.start_thread()
+
+        # run() returns once both have finished, having restarted only the
+        # failing one
+        self.supervisor.run()
+        self.assertEqual(3, flaky.runs)
+        self.assertEqual(1, healthy.runs)
+        self.assertEqual(2, self.supervisor.restart_count)
+
+    @patch("metaswitch.clearwater.etcd_shared.supervisor.time")
+    def test_backoff(self, time):
+        self.supervisor.INITIAL_BACKOFF = 1
+        time.return_value = 100
+        syncer = MagicMock()
+        self.supervisor.add(syncer)
+
+        # Each failure soon after a restart doubles the backoff, up to a limit
+        for backoff in [1, 2, 4, 8, 16, 32, 60, 60]:
+            self.supervisor._failed(syncer)
+            self.assertEqual(100 + backoff,
+                             self.supervisor._restart_at.pop(syncer))
+
+        # But a failure after a long healthy run starts again
+        time.return_value = 100 + Supervisor.STABLE_INTERVAL
+        self.supervisor._failed(syncer)
+        self.assertEqual(101 + Supervisor.STABLE_INTERVAL,
+                         self.supervisor._restart_at[syncer])
+
+    @patch("os.kill")
+    def test_gives_up(self, kill):
+        syncer = MagicMock()
+        self.supervisor.add(syncer)
+        for _ in range(Supervisor.MAX_FAILURES):
+            self.supervisor._failed(syncer)
+        kill.assert_not_called()
+
+        self.supervisor._failed(syncer)
+        self.assertEqual(1, kill.call_count)
+
+    def test_terminate(self):
+        syncer = MagicMock()
+        self.supervisor.add(syncer)
+        self.supervisor.thread_failed(syncer)
+        self.supervisor.terminate()
+
+        # We don't restart anything once we've been told to quit
+        self.supervisor.run()
+        syncer.restart.assert_not_called()
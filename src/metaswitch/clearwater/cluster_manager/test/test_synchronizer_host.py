@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+from mock import MagicMock, patch
+from metaswitch.clearwater.etcd_shared.synchronizer_host import \
+    SynchronizerHost
+
+HOST = "metaswitch.clearwater.etcd_shared.synchronizer_host."
+
+
+@patch(HOST + "utils.install_sigterm_handler")
+@patch(HOST + "StartupSnapshot")
+@patch(HOST + "WatchMultiplexer")
+class TestSynchronizerHost(unittest.TestCase):
+
+    def test_threads(self, multiplexer, snapshot, sigterm):
+        host = SynchronizerHost("clearwater", "10.0.0.1")
+        syncers = [MagicMock(), MagicMock()]
+        for syncer in syncers:
+            host.add(syncer)
+            syncer.set_multiplexer.assert_called_once_with(host.multiplexer)
+            syncer.set_supervisor.assert_called_once_with(host._supervisor)
+
+        service = MagicMock()
+        host.add_service(service)
+        host.start()
+
+        # Everything is stopped on SIGTERM
+        sigterm.assert_called_once_with(
+            [host._supervisor] + syncers + [host.multiplexer, service])
+
+        # The plugins share one watch, and have their keys read in one go
+        multiplexer.assert_called_once_with("/clearwater", "10.0.0.1")
+        host.multiplexer.start_thread.assert_called_once_with()
+        snapshot.return_value.seed.assert_called_once_with(syncers)
+        service.start_thread.assert_called_once_with()
+        for syncer in syncers:
+            syncer.start_thread.assert_called_once_with()
+
+    def test_no_plugins(self, multiplexer, snapshot, sigterm):
+        # With nothing to run, we still handle SIGTERM, but don't watch etcd
+        host = SynchronizerHost("clearwater", "10.0.0.1")
+        host.start()
+        self.assertEqual(1, sigterm.call_count)
+        host.multiplexer.start_thread.assert_not_called()
+        snapshot.assert_not_called()
+
+        # and don't wait for anything
+        host.wait()
+
+    @patch(HOST + "SynchronizerEngine")
+    @patch(HOST + "EventLoop")
+    def test_event_loop(self, loop, engine, multiplexer, snapshot, sigterm):
+        host = SynchronizerHost("clearwater", "10.0.0.1", event_loop=True)
+        syncer = MagicMock()
+        host.add(syncer)
+        host.start()
+
+        # The engine runs the plugin, and reads its key in a snapshot once
+        # it's started the multiplexer
+        engine.return_value.add.assert_called_once_with(syncer)
+        engine.return_value.start.assert_called_once_with(
+            snapshot.return_value)
+        syncer.start_thread.assert_not_called()
+        sigterm.assert_called_once_with([engine.return_value])
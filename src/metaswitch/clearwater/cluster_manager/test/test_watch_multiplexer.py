@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import unittest
+import etcd
+from mock import patch
+from threading import Thread
+from time import sleep
+from metaswitch.clearwater.etcd_shared import metrics
+from metaswitch.clearwater.etcd_shared.watch_multiplexer import \
+    WatchMultiplexer
+from .synchronizer_helpers import DNS_KEY, make_result
+
+NODES_DIR = "/clearwater/site1/clustering/memcached_nodes"
+
+
+class TestWatchMultiplexer(unittest.TestCase):
+
+    @patch("etcd.Client")
+    def setUp(self, client):
+        self.mux = WatchMultiplexer("/clearwater", "10.0.0.1")
+        self.mux._client.read.return_value = \
+            make_result(None, 10, key="/clearwater")
+        self.mux._resync()
+
+    def test_handles(self):
+        self.assertTrue(self.mux.handles("/clearwater/site1/configuration/dns"))
+        self.assertTrue(self.mux.handles("clearwater/site1/configuration/dns"))
+        self.assertFalse(self.mux.handles("/clearwater2/site1/configuration/dns"))
+        self.assertFalse(self.mux.handles("/test"))
+
+    def test_change_to_registered_key(self):
+        self.mux.register("/clearwater/site1/configuration/dns")
+        self.mux._dispatch(make_result("new value", 12, key=DNS_KEY))
+
+        result = self.mux.wait_for_change("/clearwater/site1/configuration/dns",
+                                          11, 0.1)
+        self.assertEqual("new value", result.value)
+        self.assertEqual(12, result.modifiedIndex)
+
+    def test_change_to_other_key(self):
+        self.mux.register("/clearwater/site1/configuration/dns")
+        self.mux._dispatch(
+            make_result("new value",
+                        12,
+                        key="/clearwater/site1/configuration/enum"))
+
+        # The change wasn't to our key, so we time out without seeing it
+        self.assertIsNone(
+            self.mux.wait_for_change("/clearwater/site1/configuration/dns",
+                                     11, 0.1))
+        self.assertEqual(13, self.mux._next_index)
+
+    def test_change_under_registered_directory(self):
+        self.mux.register(NODES_DIR, subtree=True)
+        self.mux._dispatch(make_result("normal",
+                                       12,
+                                       key=NODES_DIR + "/10.0.0.2"))
+
+        result = self.mux.wait_for_change(NODES_DIR, 11, 0.1)
+        self.assertEqual(12, result.modifiedIndex)
+
+        # A key that merely starts with the directory's name isn't under it
+        self.mux._dispatch(make_result("normal",
+                                       13,
+                                       key=NODES_DIR + "2/10.0.0.2"))
+        self.assertIsNone(self.mux.wait_for_change(NODES_DIR, 13, 0.1))
+
+    def test_old_change_is_ignored(self):
+        self.mux.register("/clearwater/site1/configuration/dns")
+        self.mux._dispatch(make_result("old value", 12, key=DNS_KEY))
+
+        self.assertIsNone(
+            self.mux.wait_for_change("/clearwater/site1/configuration/dns",
+                                     13, 0.1))
+
+    def test_uncovered_index(self):
+        # The multiplexer started watching from index 11, so it can't say
+        # anything about changes before that
+        self.assertTrue(self.mux.covers(11))
+        self.assertFalse(self.mux.covers(5))
+        self.assertIsNone(
+            self.mux.wait_for_change("/clearwater/site1/configuration/dns",
+                                     5, 10))
+
+    def test_index_cleared(self):
+        # The watch fell behind etcd's event history, so the multiplexer
+        # counts it and resyncs from the current index
+        metrics.registry.clear()
+        reads = []
+
+        def read(key, **kwargs):
+            reads.append(kwargs)
+            if len(reads) == 1:
+                raise etcd.EtcdEventIndexCleared("cleared")
+            self.mux._terminate_flag = True
+            return make_result(None, 2000, key="/clearwater")
+
+        self.mux._client.read.side_effect = read
+        self.mux.main()
+
+        self.assertEqual(1,
+                         metrics.watch_index_cleared.value(key="/clearwater"))
+        self.assertTrue(reads[1]["quorum"])
+        self.assertEqual(2001, self.mux._next_index)
+
+    def test_should_stop(self):
+        # A waiter with no timeout stops waiting when it's woken and told to
+        # stop
+        stop = []
+        self.mux.register("/clearwater/site1/configuration/dns")
+        waiter = Thread(target=lambda: stop.append(
+            self.mux.wait_for_change("/clearwater/site1/configuration/dns",
+                                     11, None, lambda: bool(stop))))
+        waiter.start()
+        sleep(0.1)
+        self.assertTrue(waiter.isAlive())
+
+        stop.append("stop")
+        self.mux.wake()
+        waiter.join(1)
+        self.assertFalse(waiter.isAlive())
+        self.assertEqual(["stop", None], stop)
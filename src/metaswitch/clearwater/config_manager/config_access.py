@@ -18,6 +18,8 @@ import datetime
 import time
 import collections
 from metaswitch.clearwater.config_manager.config_type_plugin_loader import load_plugins_in_dir
+from metaswitch.clearwater.etcd_shared.etcd_backend import create_client
+from metaswitch.clearwater.etcd_shared import config_trace
 from metaswitch.common.logging_config import configure_syslog
 from metaswitch.common.user_access_control import get_user_name
 from metaswitch.common.user_access_control import audit_log
@@ -214,11 +216,31 @@ class ConfigLoader(object):
 
         return download.value, download.modifiedIndex
 
+    def write_trace(self, selected_config, upload):
+        """Writes a trace record for an upload of the selected config, so that
+        the upload can be followed through the deployment. Returns the trace
+        record."""
+        return config_trace.write_trace(self._etcd_client,
+                                        "/".join([self.prefix,
+                                                  selected_config.name]),
+                                        config_trace.new_trace_id(),
+                                        upload)
+
+    def write_queue_trace(self, trace, queue_key):
+        """Writes a trace record for the restart queue that applies an upload,
+        once the upload has succeeded. It expires, so that later restarts
+        aren't credited to the upload."""
+        config_trace.write_trace(self._etcd_client,
+                                 "/".join([self.prefix, queue_key]),
+                                 trace["id"],
+                                 ttl=config_trace.QUEUE_TRACE_TTL)
+
     def write_config_to_etcd(self,
                              local_store,
                              selected_config,
                              prev_revision,
-                             upload):
+                             upload,
+                             trace=None):
         """Upload config contained in the specified file to the etcd database.
         Raises a ConfigUploadFailed exception if unsuccessful.
         """
@@ -243,6 +265,8 @@ class ConfigLoader(object):
             raise ConfigUploadFailed(UNABLE_TO_UPLOAD.format(
                 selected_config.file_download_name))
 
+        config_trace.log_span(trace, "uploaded", self._etcd_client.host, key_path)
+
 
 class LocalStore(object):
     """Class for controlling and making changes to the local config."""
@@ -367,8 +391,7 @@ def main(args, config_filename):
     try:
         log.debug("Getting etcdClient with parameters %s, 4000",
                   args.management_ip)
-        etcd_client = etcd.client.Client(host=args.management_ip,
-                                         port=4000)
+        etcd_client = create_client(args.management_ip, 4000)
         local_store = LocalStore(args.download_dir)
 
         config_location = local_store.config_location(config_filename)
@@ -625,18 +648,29 @@ def upload_config(autoconfirm, config_loader, selected_config, force, local_stor
                                                              selected_config,
                                                              local_store)
 
+    # Clearwater can be run with multiple etcd clusters. The apply_config_key
+    # variable stores the information about which etcd cluster the changes
+    # should be applied to.
+    apply_config_key = subprocess.check_output(
+        "/usr/share/clearwater/clearwater-queue-manager/scripts/get_apply_config_key")
+
+    # Record a trace ID for this upload before writing it, so that every node
+    # can log its progress applying the upload against the same ID. (The
+    # record only applies to this upload's value, so it's harmless if the
+    # upload then fails.)
+    trace = config_loader.write_trace(selected_config, upload_string)
+
     # Upload the configuration to the etcd cluster. This will trigger the
     # queue manager to schedule nodes to be restarted.
     config_loader.write_config_to_etcd(local_store,
                                        selected_config,
                                        remote_revision,
-                                       upload_string)
+                                       upload_string,
+                                       trace)
 
-    # Clearwater can be run with multiple etcd clusters. The apply_config_key
-    # variable stores the information about which etcd cluster the changes
-    # should be applied to.
-    apply_config_key = subprocess.check_output(
-        "/usr/share/clearwater/clearwater-queue-manager/scripts/get_apply_config_key")
+    # Only now that the upload has succeeded, credit the restarts it causes
+    # to it.
+    config_loader.write_queue_trace(trace, apply_config_key)
 
     # If the config changes are being forced through, the queue manager needs
     # to be made aware so it knows to push on in the case of an error when
@@ -649,7 +683,8 @@ def upload_config(autoconfirm, config_loader, selected_config, force, local_stor
     # the config file we've uploaded makes sure we don't cause confusion later.
     local_store.config_cleanup(selected_config.file_download_name)
 
-    print "{} successfully uploaded".format(selected_config.name)
+    print "{} successfully uploaded (config trace ID {})".format(
+        selected_config.name, trace["id"])
 
 
 def ready_for_upload_checks(autoconfirm,
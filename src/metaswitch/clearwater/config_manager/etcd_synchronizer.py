@@ -9,6 +9,7 @@ from hashlib import sha512
 
 from .pdlogs import FILE_CHANGED
 from metaswitch.clearwater.etcd_shared.common_etcd_synchronizer import CommonEtcdSynchronizer
+from metaswitch.clearwater.etcd_shared import config_trace, metrics
 from metaswitch.common import utils
 import logging
 
@@ -33,15 +34,29 @@ class EtcdSynchronizer(CommonEtcdSynchronizer):
             if self._terminate_flag:
                 break
 
-            if value and value != old_value:
-                _log.info("Got new config value from etcd - filename {}, file size {}, SHA512 hash {}".format(
-                    self._plugin.file(),
-                    len(value),
-                    sha512(utils.safely_encode(value)).hexdigest()))
-                _log.debug("Got new config value from etcd:\n{}".format(
-                           utils.safely_encode(value)))
+            self.process(value, old_value)
+
+    def process(self, value, old_value):
+        if value and value != old_value:
+            _log.info("Got new config value from etcd - filename {}, file size {}, SHA512 hash {}".format(
+                self._plugin.file(),
+                len(value),
+                sha512(utils.safely_encode(value)).hexdigest()))
+            _log.debug("Got new config value from etcd:\n{}".format(
+                       utils.safely_encode(value)))
+
+            # If this change is a traced upload, log our progress applying it.
+            # (There's nothing to trace when we first read the key.)
+            trace = None
+            if old_value is not None:
+                trace = config_trace.read_trace(self._client, self.key(), value)
+                config_trace.log_span(trace, "received", self._ip, self.key())
+
+            with metrics.plugin_hook_seconds.time(plugin=self.thread_name(),
+                                                  hook="on_config_changed"):
                 self._plugin.on_config_changed(value, self._alarm)
-                FILE_CHANGED.log(filename=self._plugin.file())
+            FILE_CHANGED.log(filename=self._plugin.file())
+            config_trace.log_span(trace, "applied", self._ip, self.key())
 
     def key(self):
         return "/" + self._key + "/" + self._site + "/configuration/" + self._plugin.key()
@@ -12,6 +12,10 @@
 Usage:
   main.py --local-ip=IP --local-site=SITE --etcd-key=KEY [--foreground]
           [--log-level=LVL] [--log-directory=DIR] [--pidfile=FILE]
+          [--etcd-api-version=VER] [--event-loop=Y/N]
+          [--etcd-proxy=Y/N] [--etcd-proxy-writes=Y/N]
+          [--metrics-port=PORT] [--metrics-file=FILE]
+          [--record-events=FILE]
 
 Options:
   -h --help                   Show this screen.
@@ -22,6 +26,18 @@ Options:
   --log-level=LVL             Level to log at, 0-4 [default: 3]
   --log-directory=DIR         Directory to log to [default: ./]
   --pidfile=FILE              Pidfile to write [default: ./config-manager.pid]
+  --etcd-api-version=VER      Version of the etcd API to use, 2 or 3 [default: 2]
+  --event-loop=Y/N            Whether to run all the plugins from one event loop,
+                              rather than a thread each [default: N]
+  --etcd-proxy=Y/N            Whether to serve cached etcd reads to local
+                              scripts [default: N]
+  --etcd-proxy-writes=Y/N     Whether the etcd proxy should pass writes
+                              through to etcd [default: N]
+  --metrics-port=PORT         Localhost port to serve metrics on, or 0 for none
+                              [default: 0]
+  --metrics-file=FILE         File to write metrics to every few seconds
+  --record-events=FILE        File to record the values of the plugins' keys to,
+                              for replaying offline
 
 """
 
@@ -30,6 +46,14 @@ from docopt import docopt, DocoptExit
 from metaswitch.common import logging_config, utils
 from metaswitch.clearwater.etcd_shared.plugin_loader \
     import load_plugins_in_dir
+from metaswitch.clearwater.etcd_shared import etcd_backend, metrics
+from metaswitch.clearwater.etcd_shared.connection_pool \
+    import shared_pool_manager
+from metaswitch.clearwater.etcd_shared.etcd_proxy import CachingProxy
+from metaswitch.clearwater.etcd_shared.sampling_profiler \
+        import install_sigusr2_handler
+from metaswitch.clearwater.etcd_shared.synchronizer_host \
+    import SynchronizerHost
 from metaswitch.clearwater.config_manager.etcd_synchronizer \
     import EtcdSynchronizer
 from metaswitch.clearwater.config_manager.alarms \
@@ -51,6 +75,30 @@ LOG_LEVELS = {'0': logging.ERROR,
               '3': logging.INFO,
               '4': logging.DEBUG}
 
+def add_synchronizers(host, local_ip, local_site, etcd_key,
+                      etcd_proxy=False, etcd_proxy_writes=False):
+    """Loads the config manager's plugins, and adds a synchronizer for each
+    to the SynchronizerHost."""
+    plugins_dir = "/usr/share/clearwater/clearwater-config-manager/plugins/"
+    plugins = load_plugins_in_dir(plugins_dir, lazy=True)
+    plugins.sort(key=lambda x: x.key())
+
+    # Serve reads of the deployment's subtree to scripts on this node, if
+    # asked to
+    if etcd_proxy:
+        host.add_service(CachingProxy("/" + etcd_key,
+                                      host.multiplexer,
+                                      local_ip,
+                                      allow_writes=etcd_proxy_writes))
+
+    files = [p.file() for p in plugins]
+    alarm = ConfigAlarm(files)
+
+    for plugin in plugins:
+        syncer = EtcdSynchronizer(plugin, local_ip, local_site, alarm, etcd_key)
+        host.add(syncer)
+        _log.info("Loaded plugin %s" % plugin)
+
 def main(args):
     syslog.openlog("config-manager", syslog.LOG_PID)
     pdlogs.STARTUP.log()
@@ -75,6 +123,7 @@ def main(args):
     prctl.prctl(prctl.NAME, "cw-config-mgr")
 
     logging_config.configure_logging(log_level, log_dir, "config-manager", show_thread=True)
+    etcd_backend.set_api_version(arguments['--etcd-api-version'])
 
     # urllib3 logs a WARNING log whenever it recreates a connection, but our
     # etcd usage does this frequently (to allow watch timeouts), so deliberately
@@ -83,6 +132,7 @@ def main(args):
     urllib_logger.setLevel(logging.ERROR)
 
     utils.install_sigusr1_handler("config-manager")
+    install_sigusr2_handler(log_dir, "config-manager")
 
     # Drop a pidfile. We must keep a reference to the file object here, as this keeps
     # the file locked and provides extra protection against two processes running at
@@ -94,39 +144,33 @@ def main(args):
         # We failed to take the lock - another process is already running
         exit(1)
 
-    plugins_dir = "/usr/share/clearwater/clearwater-config-manager/plugins/"
-    plugins = load_plugins_in_dir(plugins_dir)
-    plugins.sort(key=lambda x: x.key())
-    synchronizers = []
-    threads = []
-
-    files = [p.file() for p in plugins]
-    alarm = ConfigAlarm(files)
-
-    # Load the plugins, but don't start them until we've installed the SIGTERM
-    # handler, as that handler will gracefully shut down any running
-    # synchronizers on receiving a SIGTERM
-    for plugin in plugins:
-        syncer = EtcdSynchronizer(plugin, local_ip, local_site, alarm, etcd_key)
-        synchronizers.append(syncer)
-        threads.append(syncer.thread)
-        _log.info("Loaded plugin %s" % plugin)
-
-    utils.install_sigterm_handler(synchronizers)
-
-    # Now start the plugin threads
-    for syncer in synchronizers:
-        syncer.start_thread()
-        _log.info("Started thread for plugin %s" % syncer._plugin)
-
-    while any([thr.isAlive() for thr in threads]):
-        for thr in threads:
-            if thr.isAlive():
-                thr.join(1)
+    host = SynchronizerHost(etcd_key,
+                            local_ip,
+                            event_loop=(arguments['--event-loop'] == "Y"))
+    if arguments['--record-events']:
+        host.record_events(arguments['--record-events'])
+
+    add_synchronizers(host,
+                      local_ip,
+                      local_site,
+                      etcd_key,
+                      etcd_proxy=(arguments['--etcd-proxy'] == "Y"),
+                      etcd_proxy_writes=(arguments['--etcd-proxy-writes'] == "Y"))
+
+    for service in metrics.metrics_services(arguments['--metrics-port'],
+                                            arguments['--metrics-file']):
+        host.add_service(service)
+
+    # Start the plugins (having installed the SIGTERM handler, which
+    # gracefully shuts down any running synchronizers on receiving a
+    # SIGTERM), and wait for them to finish
+    host.start()
+    host.wait()
 
     while not utils.should_quit:
         sleep(1)
 
     _log.info("Clearwater Configuration Manager shutting down")
+    shared_pool_manager().log_stats()
     pdlogs.EXITING.log()
     syslog.closelog()
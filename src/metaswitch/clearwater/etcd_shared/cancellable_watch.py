@@ -0,0 +1,143 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# Support for watches that hold a single connection to etcd open until a change
+# arrives, rather than timing out (and tearing down the connection) every few
+# seconds so that the watching thread gets a chance to check whether it should
+# stop.
+#
+# A thread that wants to be able to stop a blocked watch does so through a
+# WatchCanceller. The watch is made with the canceller armed, which records
+# the connection(s) the watch uses, and any other thread can then cancel the
+# watch, which shuts those sockets down and so wakes the blocked read.
+
+import errno
+import socket
+import urllib3
+from contextlib import contextmanager
+from threading import Lock, local
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# The canceller (if any) armed by the current thread
+_armed = local()
+
+# Enable TCP keepalives on watch connections, so that we notice if etcd goes
+# away while we're waiting on a watch that has no timeout.
+KEEPALIVE_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, "TCP_KEEPIDLE"): # pragma: no cover
+    KEEPALIVE_OPTIONS += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60),
+                          (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10),
+                          (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)]
+
+
+class WatchCanceller(object):
+    def __init__(self):
+        self._lock = Lock()
+        self._connections = []
+        self.cancelled = False
+
+    @contextmanager
+    def armed(self):
+        """Any etcd requests made by this thread in this context can be
+        cancelled by calling cancel() from another thread.
+
+        The caller should check whether it still wants to make the request
+        after arming the canceller, as a cancel() before that has no effect."""
+        with self._lock:
+            self.cancelled = False
+            self._connections = []
+        _armed.canceller = self
+        try:
+            yield
+        finally:
+            _armed.canceller = None
+            with self._lock:
+                self._connections = []
+
+    def register(self, conn):
+        with self._lock:
+            if self.cancelled:
+                raise socket.error(errno.ECONNABORTED, "Watch cancelled")
+            self._connections.append(conn)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for conn in self._connections:
+                shutdown(conn)
+
+
+def shutdown(conn):
+    sock = getattr(conn, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # The socket has already gone.
+            pass
+
+
+def watch_cancelled():
+    """Returns whether the current thread's in-progress watch (if any) has been
+    cancelled."""
+    canceller = getattr(_armed, "canceller", None)
+    return canceller is not None and canceller.cancelled
+
+
+class _CancellableConnectionMixin(object):
+    # The canceller for the request this connection is being used for
+    canceller = None
+
+    def connect(self):
+        super(_CancellableConnectionMixin, self).connect()
+
+        # We may have been cancelled before we had a socket to shut down.
+        canceller = self.canceller
+        if canceller is not None and canceller.cancelled:
+            shutdown(self)
+
+
+class CancellableHTTPConnection(_CancellableConnectionMixin, HTTPConnection):
+    default_socket_options = HTTPConnection.default_socket_options + KEEPALIVE_OPTIONS
+
+
+class CancellableHTTPSConnection(_CancellableConnectionMixin, HTTPSConnection):
+    default_socket_options = HTTPSConnection.default_socket_options + KEEPALIVE_OPTIONS
+
+
+class _CancellablePoolMixin(object):
+    def _make_request(self, conn, method, url, **kwargs):
+        canceller = getattr(_armed, "canceller", None)
+        conn.canceller = canceller
+        if canceller is not None:
+            canceller.register(conn)
+        return super(_CancellablePoolMixin, self)._make_request(conn,
+                                                                method,
+                                                                url,
+                                                                **kwargs)
+
+
+class CancellableHTTPConnectionPool(_CancellablePoolMixin, HTTPConnectionPool):
+    ConnectionCls = CancellableHTTPConnection
+
+
+class CancellableHTTPSConnectionPool(_CancellablePoolMixin, HTTPSConnectionPool):
+    ConnectionCls = CancellableHTTPSConnection
+
+
+def make_cancellable(client):
+    """Switches an etcd.Client over to connections that can be cancelled with
+    a WatchCanceller. Clients that don't use their own urllib3 PoolManager
+    (e.g. UT clients, or clients using the shared pool from connection_pool.py,
+    which can already be cancelled) are left alone."""
+    http = getattr(client, "http", None)
+    if isinstance(http, urllib3.PoolManager):
+        http.pool_classes_by_scheme = {"http": CancellableHTTPConnectionPool,
+                                       "https": CancellableHTTPSConnectionPool}
+        http.clear()
+    return client
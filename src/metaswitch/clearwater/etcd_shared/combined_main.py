@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""Clearwater etcd managers
+
+Runs the cluster, config and queue managers in one process, sharing one watch
+on etcd, one pool of etcd connections and one log. This must be run from an
+environment that has each of the managers' packages installed.
+
+Usage:
+  combined_main.py --mgmt-local-ip=IP --sig-local-ip=IP --local-site=NAME --remote-site=NAME --remote-cassandra-seeds=IPs --uuid=UUID --etcd-key=KEY --etcd-cluster-key=CLUSTER_KEY
+          [--managers=LIST] [--signaling-namespace=NAME] [--foreground]
+          [--log-level=LVL] [--log-directory=DIR] [--pidfile=FILE]
+          [--cluster-manager-enabled=Y/N] [--wait-plugin-complete=RESP]
+          [--etcd-api-version=VER] [--event-loop=Y/N]
+          [--etcd-proxy=Y/N] [--etcd-proxy-writes=Y/N]
+          [--metrics-port=PORT] [--metrics-file=FILE]
+          [--record-events=FILE] [--cluster-layout=LAYOUT]
+          [--scaling-quiet-period=SECS] [--scale-timing-file=FILE]
+
+Options:
+  -h --help                      Show this screen.
+  --mgmt-local-ip=IP             Management IP address
+  --sig-local-ip=IP              Signaling IP address
+  --local-site=NAME              Name of local site
+  --remote-site=NAME             Name of remote site
+  --remote-cassandra-seeds=IPs   Comma separated list of at least one IP address from each remote Cassandra site
+  --uuid=UUID                    UUID uniquely identifying this node
+  --etcd-key=KEY                 Etcd key (top level)
+  --etcd-cluster-key=CLUSTER_KEY Etcd key (used in the data store clusters, and
+                                 as the queue manager's node type)
+  --managers=LIST                Comma separated list of the managers to run
+                                 [default: cluster,config,queue]
+  --signaling-namespace=NAME     Name of the signaling namespace
+  --foreground                   Don't daemonise
+  --log-level=LVL                Level to log at, 0-4 [default: 3]
+  --log-directory=DIR            Directory to log to [default: ./]
+  --pidfile=FILE                 Pidfile to write [default: ./etcd-managers.pid]
+  --cluster-manager-enabled=Y/N  Whether the cluster manager should start any threads [default: Yes]
+  --wait-plugin-complete=RESP    Whether the queue manager should wait for plugin responses
+  --etcd-api-version=VER         Version of the etcd API to use, 2 or 3 [default: 2]
+  --event-loop=Y/N               Whether to run all the plugins from one event loop,
+                                 rather than a thread each [default: N]
+  --etcd-proxy=Y/N               Whether to serve cached etcd reads to local
+                                 scripts [default: N]
+  --etcd-proxy-writes=Y/N        Whether the etcd proxy should pass writes
+                                 through to etcd [default: N]
+  --metrics-port=PORT            Localhost port to serve metrics on, or 0 for none
+                                 [default: 0]
+  --metrics-file=FILE            File to write metrics to every few seconds
+  --record-events=FILE           File to record the values of the plugins' keys to,
+                                 for replaying offline
+  --cluster-layout=LAYOUT        How each cluster's state is stored in etcd - "view"
+                                 (one key) or "per-node" (a key per node). Every
+                                 node must use the same layout [default: view]
+  --scaling-quiet-period=SECS    Start scaling a cluster once no more nodes have asked
+                                 to join or leave it for this long [default: 5]
+  --scale-timing-file=FILE       File to record each node's state changes to, for
+                                 timing scale operations
+
+"""
+
+from docopt import docopt
+
+from metaswitch.common import logging_config, utils
+from metaswitch.clearwater.etcd_shared import etcd_backend, metrics
+from metaswitch.clearwater.etcd_shared.connection_pool import shared_pool_manager
+from metaswitch.clearwater.etcd_shared.sampling_profiler import \
+    install_sigusr2_handler
+from metaswitch.clearwater.etcd_shared.synchronizer_host import SynchronizerHost
+import logging
+import os
+import prctl
+import syslog
+import sys
+from time import sleep
+from uuid import UUID
+
+_log = logging.getLogger("etcd_shared.combined_main")
+
+LOG_LEVELS = {'0': logging.ERROR,
+              '1': logging.WARNING,
+              # INFO-level logging is really useful, and not very spammy because
+              # we're not on the call path, so produce INFO logs even at level 2
+              '2': logging.INFO,
+              '3': logging.INFO,
+              '4': logging.DEBUG}
+
+MANAGERS = ("cluster", "config", "queue")
+
+def main(args):
+    syslog.openlog("etcd-managers", syslog.LOG_PID)
+    arguments = docopt(__doc__, argv=args)
+
+    mgmt_ip = arguments['--mgmt-local-ip']
+    sig_ip = arguments['--sig-local-ip']
+    local_site_name = arguments['--local-site']
+    etcd_key = arguments['--etcd-key']
+    etcd_cluster_key = arguments['--etcd-cluster-key']
+    log_dir = arguments['--log-directory']
+    log_level = LOG_LEVELS.get(arguments['--log-level'], logging.DEBUG)
+    managers = [m.strip() for m in arguments['--managers'].split(',')]
+
+    for manager in managers:
+        if manager not in MANAGERS:
+            print "Unknown manager {} - must be one of {}".format(
+                      manager, ", ".join(MANAGERS))
+            exit(1)
+
+    stdout_err_log = os.path.join(log_dir, "etcd-managers.output.log")
+
+    if not arguments['--foreground']:
+        utils.daemonize(stdout_err_log)
+
+    # Process names are limited to 15 characters, so abbreviate
+    prctl.prctl(prctl.NAME, "cw-etcd-mgrs")
+
+    logging_config.configure_logging(log_level, log_dir, "etcd-managers", show_thread=True)
+    etcd_backend.set_api_version(arguments['--etcd-api-version'])
+
+    # urllib3 logs a WARNING log whenever it recreates a connection, but our
+    # etcd usage does this frequently (to allow watch timeouts), so deliberately
+    # ignore this log
+    urllib_logger = logging.getLogger('urllib3')
+    urllib_logger.setLevel(logging.ERROR)
+
+    utils.install_sigusr1_handler("etcd-managers")
+    install_sigusr2_handler(log_dir, "etcd-managers")
+
+    # Drop a pidfile. We must keep a reference to the file object here, as this keeps
+    # the file locked and provides extra protection against two processes running at
+    # once.
+    pidfile_lock = None
+    try:
+        pidfile_lock = utils.lock_and_write_pid_file(arguments['--pidfile']) # noqa
+    except IOError:
+        # We failed to take the lock - another process is already running
+        exit(1)
+
+    # Every manager's synchronizers share one host, and so one watch on etcd
+    host = SynchronizerHost(etcd_key,
+                            mgmt_ip,
+                            event_loop=(arguments['--event-loop'] == "Y"))
+
+    if arguments['--record-events']:
+        host.record_events(arguments['--record-events'])
+
+    cluster_main = None
+    if "cluster" in managers:
+        # Only import each manager if we're running it, as its package may
+        # not be installed otherwise
+        from metaswitch.clearwater.cluster_manager import main as cluster_main
+        from metaswitch.clearwater.cluster_manager.plugin_base import \
+            PluginParams
+        from metaswitch.clearwater.cluster_manager.synchronization_fsm import \
+            SyncFSM
+        SyncFSM.QUIET_PERIOD = float(arguments['--scaling-quiet-period'])
+        seeds = arguments['--remote-cassandra-seeds']
+        cluster_synchronizers = cluster_main.add_synchronizers(
+            host,
+            PluginParams(ip=sig_ip,
+                         mgmt_ip=mgmt_ip,
+                         local_site=local_site_name,
+                         remote_site=arguments['--remote-site'],
+                         remote_cassandra_seeds=seeds.split(',') if seeds else [],
+                         signaling_namespace=arguments.get('--signaling-namespace'),
+                         uuid=UUID(arguments['--uuid']),
+                         etcd_key=etcd_key,
+                         etcd_cluster_key=etcd_cluster_key),
+            arguments['--cluster-manager-enabled'],
+            arguments['--cluster-layout'],
+            arguments['--scale-timing-file'])
+        cluster_main.install_sigquit_handler(cluster_synchronizers)
+
+    if "config" in managers:
+        from metaswitch.clearwater.config_manager import main as config_main
+        config_main.add_synchronizers(
+            host,
+            mgmt_ip,
+            local_site_name,
+            etcd_key,
+            etcd_proxy=(arguments['--etcd-proxy'] == "Y"),
+            etcd_proxy_writes=(arguments['--etcd-proxy-writes'] == "Y"))
+
+    if "queue" in managers:
+        from metaswitch.clearwater.queue_manager import main as queue_main
+        queue_main.add_synchronizers(host,
+                                     mgmt_ip,
+                                     local_site_name,
+                                     etcd_key,
+                                     etcd_cluster_key,
+                                     arguments['--wait-plugin-complete'])
+
+    for service in metrics.metrics_services(arguments['--metrics-port'],
+                                            arguments['--metrics-file']):
+        host.add_service(service)
+
+    _log.info("Running %s managers with %d plugins" %
+              (", ".join(managers), len(host.synchronizers)))
+
+    # Start the plugins (having installed the SIGTERM handler, which
+    # gracefully shuts down any running synchronizers on receiving a
+    # SIGTERM), and wait for them to finish
+    host.start()
+    host.wait()
+
+    _log.info("No plugins running, waiting for a SIGTERM or SIGQUIT")
+    while not utils.should_quit and not (cluster_main and
+                                         cluster_main.should_quit):
+        sleep(1)
+
+    _log.info("Clearwater etcd managers shutting down")
+    shared_pool_manager().log_stats()
+    syslog.closelog()
+
+if __name__ == '__main__': # pragma: no cover
+    main(sys.argv[1:])
@@ -29,15 +29,22 @@
 # DEALINGS IN THE SOFTWARE.
 
 import etcd
-from threading import Thread
+from threading import Thread, Timer
 from concurrent import futures
-from time import sleep
+from time import sleep, time
 from functools import wraps
 import logging
 import traceback
 import os
 import signal
 from metaswitch.common import utils
+from .cancellable_watch import WatchCanceller, make_cancellable, watch_cancelled
+from .etcd_backend import create_client, set_endpoint
+from .plugin_loader import plugin_name
+from .endpoint_selector import endpoint_selector
+from .retry_policy import RetryPolicy
+from .singleflight import shared_reads
+from . import metrics
 
 _log = logging.getLogger(__name__)
 
@@ -139,6 +146,14 @@ def _patched_wrap_request(payload): # pragma: no cover
                 # don't wrap socket errors either.
             except (HTTPError, MaxRetryError, HTTPException, SocketError) as e:
                 # PATCHED
+                if watch_cancelled():
+                    # We deliberately shut this watch down, so there's no need
+                    # to log an error or look for another server.
+                    _log.debug("Watch cancelled.")
+                    raise etcd.EtcdConnectionFailed(
+                        "Watch cancelled: %r" % e,
+                        cause=e
+                    )
                 if (isinstance(params, dict) and
                     params.get("wait") == "true" and
                     (isinstance(e,
@@ -230,17 +245,59 @@ def api_execute_with_patched_decorator(self, path, method, params=None, timeout=
 etcd.Client.api_execute = api_execute_with_patched_decorator
 
 class CommonEtcdSynchronizer(object):
+    # The longest we wait before retrying after an error. See RetryPolicy for
+    # how long we actually wait.
     PAUSE_BEFORE_RETRY_ON_EXCEPTION = 30
     PAUSE_BEFORE_RETRY_ON_MISSING_KEY = 5
     TIMEOUT_ON_WATCH = 5
 
+    # If set, watches hold their connection open until a change arrives (and
+    # are cancelled when we need to stop watching), rather than timing out
+    # every TIMEOUT_ON_WATCH seconds.
+    LONG_LIVED_WATCHES = True
+
+    # If set, once we've seen a change to our key we watch for the next change
+    # straight away, rather than doing a quorum read of the key first. We
+    # still do a quorum read when we start, after an error, or when our last
+    # value has been thrown away (e.g. after a failed write).
+    CHAINED_WATCHES = True
+
+    # If set, our key is a directory, and our value is built from the keys
+    # under it (see quorum_read()). We watch the whole directory, and read
+    # it again whenever any key under it changes.
+    SUBTREE = False
+
     def __init__(self, plugin, ip, etcd_ip=None):
         self._plugin = plugin
         self._ip = ip
         cxn_ip = etcd_ip or ip
-        self._client = etcd.Client(cxn_ip, 4000)
+        self._client = make_cancellable(create_client(cxn_ip, 4000))
+        self._watch_canceller = WatchCanceller()
+        self._retry = RetryPolicy(cxn_ip, self.PAUSE_BEFORE_RETRY_ON_EXCEPTION)
+        self._endpoints = endpoint_selector(cxn_ip)
         self._index = None
         self._last_value = None
+        self._multiplexer = None
+        self._engine = None
+        self._supervisor = None
+        self._recorder = None
+
+        # The index to watch our key from next, and the value we'd seen when
+        # we last watched it. See CHAINED_WATCHES.
+        self._chain_index = None
+        self._chain_value = None
+
+        # The index of a write we made that we don't need to act on when we
+        # see it come back from etcd.
+        self._echo_index = None
+
+        # Our key's value and index, and the etcd index, from a snapshot
+        # taken when the daemon started. See seed().
+        self._seed = None
+
+        # When to act on our key's value again, even if it hasn't changed. See
+        # recheck_after().
+        self._recheck_at = None
 
         # Set the terminate flag and the abort read flag to false initially
         # The terminate flag controls whether the synchronizer as a whole
@@ -254,67 +311,233 @@ class CommonEtcdSynchronizer(object):
         self.thread.daemon = True
         self.thread.start()
 
+    def restart(self):
+        # Start a new thread running main(), after our last one failed. We
+        # forget the value we last saw, so that we read our key again rather
+        # than trusting state from before the failure.
+        if self._terminate_flag:
+            return
+        self._last_value = None
+        self._chain_index = None
+        self._abort_read = False
+        self.thread = Thread(target=self.main_wrapper, name=self.thread_name())
+        self.start_thread()
+
     def terminate(self):
         self._terminate_flag = True
+        self.cancel_watch()
         self.thread.join()
 
+    def abort_read(self):
+        # Stop any in-progress read, without terminating the synchronizer.
+        self._abort_read = True
+        self.cancel_watch()
+
+    def cancel_watch(self):
+        # Wake up any watch that's in progress, so that it can notice that it
+        # should stop.
+        self._watch_canceller.cancel()
+        if self._multiplexer is not None:
+            self._multiplexer.wake()
+
+    def should_stop_watching(self):
+        return (self._terminate_flag or
+                self._abort_read or
+                not self.is_running() or
+                self.recheck_due())
+
+    def recheck_after(self, delay):
+        # Pass our key's current value to process() again after delay seconds,
+        # even if it hasn't changed by then (e.g. to let the FSM act on a
+        # timeout). This replaces any earlier recheck, and is cancelled if we
+        # see a new value first.
+        self._recheck_at = time() + delay
+        if self._engine is not None:
+            self._engine.submit_later(self, delay, self.recheck)
+        else:
+            # Stop watching when the time comes, so that main() gets our
+            # current value back from update_from_etcd().
+            timer = Timer(delay, self._wake_for_recheck)
+            timer.daemon = True
+            timer.start()
+
+    def recheck_due(self):
+        return self._recheck_at is not None and time() >= self._recheck_at
+
+    def _wake_for_recheck(self):
+        if self.recheck_due():
+            self.cancel_watch()
+
+    def recheck(self):
+        # Run by the engine after recheck_after().
+        if self.recheck_due() and not self._terminate_flag:
+            self._recheck_at = None
+            if self._last_value is not None:
+                self.process(self._last_value, self._last_value)
+
+    def watch_timeout(self):
+        # python-etcd treats a timeout of 0 as no timeout
+        return 0 if self.LONG_LIVED_WATCHES else self.TIMEOUT_ON_WATCH
+
+    def multiplexer_timeout(self):
+        return None if self.LONG_LIVED_WATCHES else self.TIMEOUT_ON_WATCH
+
     def pause(self):
-        sleep(self.PAUSE_BEFORE_RETRY_ON_EXCEPTION)
+        self._retry.pause()
+
+    def set_multiplexer(self, multiplexer):
+        # Use a process-wide WatchMultiplexer to wait for changes to our key,
+        # rather than running our own watch against etcd. This has no effect if
+        # our key isn't under the multiplexer's prefix.
+        if multiplexer.handles(self.key()):
+            multiplexer.register(self.key(), subtree=self.SUBTREE)
+            self._multiplexer = multiplexer
 
     def main_wrapper(self): # pragma: no cover
         # This function should be the entry point when we start an
         # EtcdSynchronizer thread. We use it to catch exceptions in main and
-        # restart the whole process; if we didn't do this the thread would be
-        # dead and we'd never notice.
+        # restart the thread (if we have a Supervisor) or the whole process;
+        # if we didn't do this the thread would be dead and we'd never notice.
         try:
             self.main()
         except Exception:
-            # Log the exception and send a SIGTERM to this process. If the
-            # process needs to do anything before shutting down, it will have a
-            # handler for catching the SIGTERM.
             _log.error(traceback.format_exc())
-            os.kill(os.getpid(), signal.SIGTERM)
+            if self._supervisor is not None:
+                self._supervisor.thread_failed(self)
+            else:
+                # Send a SIGTERM to this process. If the process needs to do
+                # anything before shutting down, it will have a handler for
+                # catching the SIGTERM.
+                os.kill(os.getpid(), signal.SIGTERM)
+        else:
+            if self._supervisor is not None:
+                self._supervisor.thread_exited(self)
+
+    def set_supervisor(self, supervisor):
+        # Report the exit of our thread to a Supervisor (see supervisor.py),
+        # so that it can restart us if we fail.
+        self._supervisor = supervisor
+
+    def set_recorder(self, recorder):
+        # Record each value we see for our key to an EventRecorder (see
+        # event_recorder.py), so that it can be replayed offline.
+        self._recorder = recorder
+
+    def record(self):
+        if self._recorder is not None:
+            self._recorder.record(self.key(), self._last_value, self._index)
+
+    def set_engine(self, engine):
+        # Let a SynchronizerEngine drive this synchronizer (see event_loop.py)
+        # instead of running main() on our own thread. The engine calls
+        # refresh() and handle_update(), which pass each new value of our key
+        # to process().
+        self._engine = engine
 
     def main(self): pass
 
+    # Act on a new value of our key (old_value is the value we had before).
+    # Subclasses that can be driven by a SynchronizerEngine implement this.
+    def process(self, value, old_value): pass
+
+    # Tidy up once we've stopped.
+    def finish(self): pass
+
     def default_value(self): return None
 
     def is_running(self): return True
 
-    def thread_name(self): return self._plugin.__class__.__name__
+    def thread_name(self): return plugin_name(self._plugin)
 
     # Read the state of the cluster from etcd (optionally waiting for a changed
-    # state). Returns None if nothing could be read.
-    def read_from_etcd(self, wait=True, timeout=None):
+    # state). Returns None if nothing could be read. If fresh is set, the read
+    # is made after this call, rather than shared with one already in flight
+    # (see singleflight.py).
+    def read_from_etcd(self, wait=True, timeout=None, fresh=False):
+        if wait and self._seed is not None:
+            # We've already been given our key's initial value.
+            return self.take_seed()
+
         result = None
         wait_index = None
+        chain_index = self.take_chain_index() if wait else None
 
         try:
-            result = self._client.read(self.key(), quorum=True, timeout=timeout)
-            wait_index = result.etcd_index + 1
+            if chain_index is None:
+                result = self.quorum_read(timeout, fresh=fresh)
+                self._retry.succeeded()
+                wait_index = result.etcd_index + 1
+            else:
+                # We've seen every change to our key before chain_index, and
+                # the last of them is the value we already have, so go
+                # straight back to watching.
+                wait_index = chain_index
 
             if wait:
                 # If the cluster view hasn't changed since we last saw it, then
                 # wait for it to change before doing anything else.
-                _log.info("Read value {} from etcd, "
-                          "comparing to last value {}".format(
-                              utils.safely_encode(result.value),
-                              utils.safely_encode(self._last_value)))
+                if result is not None:
+                    _log.info("Read value {} from etcd, "
+                              "comparing to last value {}".format(
+                                  utils.safely_encode(result.value),
+                                  utils.safely_encode(self._last_value)))
 
-                if result.value == self._last_value:
+                if result is None or result.value == self._last_value:
                     _log.info("Watching for changes with {}".format(wait_index))
+                    watch_start = time()
+
+                    while not self.should_stop_watching():
+                        if (self._multiplexer is not None and
+                            self._multiplexer.covers(wait_index)):
+                            # Another thread is already watching our key, so
+                            # just wait for it to tell us about a change.
+                            change = self._multiplexer.wait_for_change(
+                                                       self.key(),
+                                                       wait_index,
+                                                       self.multiplexer_timeout(),
+                                                       self.should_stop_watching)
+                            if change is not None:
+                                result = self.changed(change, timeout)
+                                break
+                            continue
 
-                    while not self._terminate_flag and not self._abort_read and self.is_running():
                         _log.debug("Started a new watch")
                         try:
-                            result = self._client.read(self.key(),
-                                                       timeout=self.TIMEOUT_ON_WATCH,
-                                                       waitIndex=wait_index,
-                                                       wait=True,
-                                                       recursive=False)
+                            with self._watch_canceller.armed():
+                                # Check we still want to watch now that the
+                                # watch can be cancelled.
+                                if self.should_stop_watching():
+                                    break
+                                result = self._client.read(self.key(),
+                                                           timeout=self.watch_timeout(),
+                                                           waitIndex=wait_index,
+                                                           wait=True,
+                                                           recursive=self.SUBTREE)
+                            result = self.changed(result, timeout)
                             break
+                        except etcd.EtcdEventIndexCleared:
+                            # etcd only keeps a limited history of changes,
+                            # and it's moved past wait_index, so we may have
+                            # missed a change. Reread the key straight away
+                            # and watch from the current index, rather than
+                            # falling through to the pause below.
+                            metrics.watch_index_cleared.inc(key=self.key())
+                            _log.warning("Watch on {} fell behind etcd's "
+                                         "event history with index {} "
+                                         "({} times so far) - rereading".
+                                         format(self.key(),
+                                                wait_index,
+                                                metrics.watch_index_cleared.
+                                                value(key=self.key())))
+                            result = self.quorum_read(timeout)
+                            wait_index = result.etcd_index + 1
+                            if result.value != self._last_value:
+                                break
                         except etcd.EtcdException as e:
-                            if "Read timed out" in e.message:
+                            if self.should_stop_watching():
+                                # We cancelled this watch ourselves.
+                                break
+                            elif "Read timed out" in e.message:
                                 # Timeouts after TIMEOUT_ON_WATCH seconds are expected, so
                                 # ignore them - unless we're terminating, we'll
                                 # stay in the while loop and try again
@@ -323,11 +546,25 @@ class CommonEtcdSynchronizer(object):
                                 raise
 
                     _log.debug("Finished watching")
+                    if result is not None:
+                        metrics.watch_wait_seconds.observe(
+                            time() - watch_start, plugin=self.thread_name())
+
+                    if result is None:
+                        # We went straight to watching, and stopped before
+                        # anything changed, so we've nothing new to report.
+                        self.set_chain_index(chain_index)
+                        return (self._last_value, self._index)
 
                     # Return if we're terminating.
                     if self._terminate_flag:
                         return self.tuple_from_result(result)
 
+                if not self._abort_read:
+                    self.set_chain_index(max(wait_index,
+                                             result.modifiedIndex + 1),
+                                         result.value)
+
         except etcd.EtcdKeyError:
             _log.info("Key {} doesn't exist in etcd yet".format(self.key()))
             # Use any value on disk first, but the default value if not found
@@ -342,6 +579,7 @@ class CommonEtcdSynchronizer(object):
                 # The prevExist set to False will fail the write if it finds a
                 # key already in etcd. This stops us overwriting a manually
                 # uploaded file with the default template.
+                self.use_endpoint(for_write=True)
                 self._client.write(self.key(), value, prevExist=False)
                 return (value, None)
             except:  # pragma: no cover
@@ -358,13 +596,91 @@ class CommonEtcdSynchronizer(object):
             _log.error("{} caught {!r} when trying to read with index {}"
                        " - pause before retry".
                        format(self._ip, e, wait_index))
-            # Sleep briefly to avoid hammering a failed server
+            # Back off to avoid hammering a failed server
             self.pause()
             # The main loop (which reads from etcd in a loop) should call this
             # function again after we return, causing the read to be retried.
 
         return self.tuple_from_result(result)
 
+    def use_endpoint(self, for_write=False):
+        # Point our client at the best etcd member for our next request. See
+        # endpoint_selector.py.
+        # Our successes and failures are recorded against that member's
+        # circuit breaker, which the selector checks before choosing it.
+        self._endpoints.discover(self._client)
+        if for_write:
+            endpoint = self._endpoints.write_endpoint()
+        else:
+            endpoint = self._endpoints.read_endpoint()
+        set_endpoint(self._client, endpoint)
+        self._retry.use_endpoint(endpoint)
+        return endpoint
+
+    def quorum_read(self, timeout=None, fresh=False):
+        # Threads reading our key at the same time (e.g. the main loop and a
+        # request to leave the cluster) share one request to etcd, unless
+        # the caller needs a fresh one.
+        self.use_endpoint()
+        return shared_reads.do((self.key(), timeout),
+                               lambda: self._client.read(self.key(),
+                                                         quorum=True,
+                                                         recursive=self.SUBTREE,
+                                                         timeout=timeout),
+                               fresh=fresh)
+
+    def changed(self, result, timeout=None):
+        # Returns our key's value after a watch has seen the given change. If
+        # our key is a directory, the change is to one of the keys under it,
+        # so read them all again.
+        if self.SUBTREE:
+            return self.quorum_read(timeout)
+        return result
+
+    def take_chain_index(self):
+        # Returns the index to watch from if we can skip the quorum read, and
+        # resets it, so that if anything goes wrong we read the key again.
+        chain_index, self._chain_index = self._chain_index, None
+        if (self.CHAINED_WATCHES and
+            self._last_value is not None and
+            self._chain_value == self._last_value):
+            return chain_index
+        return None
+
+    def set_chain_index(self, index, value=None):
+        self._chain_index = index
+        if value is not None:
+            self._chain_value = value
+
+    def seed(self, value, index, etcd_index):
+        # Use this value of our key (read in a snapshot of etcd taken at
+        # etcd_index - see startup_snapshot.py) rather than reading our key
+        # when we start.
+        self._seed = (value, index, etcd_index)
+
+    def take_seed(self):
+        (value, index, etcd_index), self._seed = self._seed, None
+        _log.info("Using value of {} from startup snapshot".format(self.key()))
+
+        # Watch for changes from the snapshot onwards.
+        self.set_chain_index(etcd_index + 1, value)
+        return (value, index)
+
+    def expect_echo(self, result):
+        # Called after a successful write to etcd, if seeing that write come
+        # back from etcd wouldn't give us anything new to do.
+        if result is not None:
+            self._echo_index = result.modifiedIndex
+
+    def is_echo(self):
+        # Returns whether the value we've just read from etcd is a write of
+        # ours passed to expect_echo(). Only the first read after the write
+        # can be its echo - any later read is of someone else's change.
+        echo = (self._echo_index is not None and
+                self._echo_index == self._index)
+        self._echo_index = None
+        return echo
+
     def tuple_from_result(self, result):
         if result is None:
             return (None, None)
@@ -385,8 +701,55 @@ class CommonEtcdSynchronizer(object):
     # or missed reads.
     def update_from_etcd(self):
         self._last_value, self._index = self.read_from_etcd(wait=True)
+        self._recheck_at = None
+        self.record()
         return self._last_value
 
+    # Read our key, and act on its current value. The engine calls this when
+    # it starts, and whenever it may have missed a change to our key.
+    def refresh(self):
+        if (self._seed is not None and
+            self._multiplexer is not None and
+            self._multiplexer.covers(self._seed[2] + 1)):
+            # The multiplexer will tell us about any change since our
+            # startup snapshot.
+            value, index = self.take_seed()
+        else:
+            self._seed = None
+            value, index = self.read_from_etcd(wait=False)
+        self.apply_value(value, index)
+
+    # Act on a change to our key that the engine has seen.
+    def handle_update(self, result):
+        if result is None:
+            return
+        if self._index is not None and result.modifiedIndex <= self._index:
+            # We've already seen this change (or a later one) when reading
+            # our key.
+            return
+        if self.SUBTREE:
+            # The change is to one of the keys under ours.
+            self.refresh()
+            return
+        self.apply_value(result.value, result.modifiedIndex)
+
+    def apply_value(self, value, index):
+        old_value = self._last_value
+        self._last_value, self._index = value, index
+        self._recheck_at = None
+        self.record()
+        if self._terminate_flag:
+            return
+        self.process(value, old_value)
+
+        if (self._last_value is None and
+            self._engine is not None and
+            self.is_running() and
+            not self._terminate_flag):
+            # We failed to read our key, or a write to it failed, so we
+            # don't know its value. Read it again.
+            self._engine.submit(self, self.refresh)
+
     # Use this class instead of the class futures.ThreadPoolExecutor to log any exceptions
     # that occur inside 'background-started' threads
     class ThreadPoolExecutorWithExceptionHandler(futures.ThreadPoolExecutor):
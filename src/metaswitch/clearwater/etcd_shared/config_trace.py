@@ -0,0 +1,250 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""Traces a config upload as it propagates through the deployment.
+
+When `cw-config upload` writes a config key, it first writes a trace record
+for it - a trace ID, the upload time and a hash of the uploaded value - to
+the matching key under /<etcd key>/<site>/trace/, and the same trace ID to
+the trace key of the restart queue the upload will use.
+
+Each node's config manager looks up the trace record when it sees the key
+change, and (if the hash matches the value it has seen) logs a span when it
+receives the value and when the plugin has applied it. Each node's queue
+manager logs a span against the queue's trace when the node joins the
+restart queue, starts restarting and finishes. Spans are logged in one
+format, so that this module's main() can reassemble them, from the logs of
+every node (or this node's logs, if none are given), into a timeline per
+node.
+
+Usage:
+  config_trace.py [--trace=ID] [<log>...]
+
+Options:
+  -h --help                      Show this screen.
+  --trace=ID                     Only show this trace ID
+
+"""
+
+from docopt import docopt
+import glob
+import json
+import logging
+import re
+from collections import defaultdict
+from hashlib import sha512
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+import etcd
+
+_log = logging.getLogger(__name__)
+
+SPAN_RE = re.compile(r"Config trace (?P<id>\w+) span (?P<span>\S+) "
+                     r"node (?P<node>\S+) key (?P<key>\S+) "
+                     r"at (?P<at>[\d.]+)")
+
+# How long a restart queue's trace record lasts. Restarts queued after this
+# (e.g. by other tools) aren't credited to the upload.
+QUEUE_TRACE_TTL = 2 * 60 * 60
+
+DEFAULT_LOGS = ["/var/log/syslog",
+                "/var/log/clearwater-config-manager/*",
+                "/var/log/clearwater-queue-manager/*",
+                "/var/log/clearwater-etcd-managers/*"]
+
+
+def trace_key(key):
+    """The key that the trace record for a config or queue key is stored
+    in - e.g. /clearwater/site1/trace/shared_config for
+    /clearwater/site1/configuration/shared_config."""
+    parent, name = key.rstrip("/").rsplit("/", 1)
+    return parent.rsplit("/", 1)[0] + "/trace/" + name
+
+
+def value_hash(value):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return sha512(value).hexdigest()
+
+
+def new_trace_id():
+    return uuid4().hex[:16]
+
+
+def write_trace(client, key, trace_id, value=None, ttl=None):
+    """Writes (and returns) the trace record for a key. If value is given,
+    the trace only applies when the key has that value, and if ttl is given,
+    the record expires after that many seconds. Tracing is best effort, so
+    failures are logged rather than raised."""
+    record = {"id": trace_id, "time": time()}
+    if value is not None:
+        record["hash"] = value_hash(value)
+    try:
+        if ttl is not None:
+            client.write(trace_key(key), json.dumps(record), ttl=ttl)
+        else:
+            client.write(trace_key(key), json.dumps(record))
+    except etcd.EtcdException as e:
+        _log.warning("Failed to write config trace for {}: {!r}".format(
+                         key, e))
+    return record
+
+
+def read_trace(client, key, value=None):
+    """Returns the trace record for a key, or None if there isn't one (or
+    there's one for a different value)."""
+    try:
+        record = json.loads(client.read(trace_key(key)).value)
+    except (etcd.EtcdException, ValueError, TypeError):
+        return None
+    return _matching(record, value)
+
+
+def _matching(record, value):
+    # The record, if it applies to the value (or there's no value to check).
+    if (record is not None and
+        value is not None and
+        "hash" in record and
+        record["hash"] != value_hash(value)):
+        return None
+    return record
+
+
+class TraceCache(object):
+    """The trace record for a key, kept up to date by a WatchMultiplexer,
+    so that it can be looked up on every change to the key without reading
+    etcd - or, if there's no record, without any etcd request at all."""
+
+    def __init__(self, client, key):
+        self._client = client
+        self._key = key
+        self._lock = Lock()
+        self._subscribed = False
+
+        # The record, whether it needs reading (at first, and whenever the
+        # multiplexer may have missed a change), and a count of changes, so
+        # that a read doesn't overwrite a newer change.
+        self._record = None
+        self._stale = True
+        self._changes = 0
+
+    def subscribe(self, multiplexer):
+        multiplexer.subscribe(trace_key(self._key), self._on_change)
+        self._subscribed = True
+
+    def _on_change(self, result):
+        # Called on the multiplexer's thread, so mustn't block.
+        with self._lock:
+            self._changes += 1
+            if result is None:
+                self._stale = True
+                return
+            self._stale = False
+            self._record = None
+            if result.value is not None:
+                try:
+                    self._record = json.loads(result.value)
+                except ValueError:
+                    pass
+
+    def get(self, value=None):
+        """Returns the trace record, or None if there isn't one (or there's
+        one for a different value, or we aren't watching for it)."""
+        if not self._subscribed:
+            return None
+
+        with self._lock:
+            stale, record, changes = self._stale, self._record, self._changes
+        if stale:
+            try:
+                record = json.loads(self._client.read(trace_key(self._key)).value)
+            except etcd.EtcdKeyNotFound:
+                record = None
+            except (etcd.EtcdException, ValueError, TypeError):
+                # Try again next time.
+                return None
+            with self._lock:
+                if self._changes == changes:
+                    self._record, self._stale = record, False
+        return _matching(record, value)
+
+
+def log_span(record, span, node, key):
+    """Logs a span against a trace record (if there is one)."""
+    if record is None:
+        return
+    now = time()
+    _log.info("Config trace {} span {} node {} key {} at {:.3f} "
+              "({:.3f}s after upload)".format(record["id"],
+                                              span,
+                                              node,
+                                              key.rstrip("/").rsplit("/", 1)[-1],
+                                              now,
+                                              now - record["time"]))
+
+
+def parse_spans(lines):
+    """Returns {trace ID: {node: [(time, span, key)]}} for the spans in the
+    given log lines."""
+    traces = defaultdict(lambda: defaultdict(list))
+    for line in lines:
+        match = SPAN_RE.search(line)
+        if match:
+            traces[match.group("id")][match.group("node")].append(
+                (float(match.group("at")),
+                 match.group("span"),
+                 match.group("key")))
+    return traces
+
+
+def format_timelines(traces):
+    """Returns a timeline per node for each trace, with times relative to
+    the first span of the trace (normally the upload)."""
+    output = []
+    for trace_id, nodes in sorted(traces.items(),
+                                  key=lambda item: min(min(spans) for spans in
+                                                       item[1].values())):
+        start = min(min(spans)[0] for spans in nodes.values())
+        output.append("Trace {}".format(trace_id))
+        for node, spans in sorted(nodes.items(),
+                                  key=lambda item: min(item[1])):
+            output.append("  {}".format(node))
+            for at, span, key in sorted(spans):
+                output.append("    {:>9.3f}s  {:<16} {}".format(at - start,
+                                                                span,
+                                                                key))
+    return "\n".join(output)
+
+
+def main(args=None):
+    arguments = docopt(__doc__, argv=args)
+    trace = arguments["--trace"]
+
+    filenames = arguments["<log>"] or [filename for pattern in DEFAULT_LOGS
+                                       for filename in glob.glob(pattern)]
+    traces = defaultdict(lambda: defaultdict(list))
+    for filename in filenames:
+        with open(filename) as f:
+            for trace_id, nodes in parse_spans(f).items():
+                for node, spans in nodes.items():
+                    traces[trace_id][node].extend(spans)
+
+    if trace:
+        traces = {trace: traces.get(trace, {})}
+    traces = dict((trace_id, nodes) for trace_id, nodes in traces.items()
+                  if nodes)
+
+    if traces:
+        print format_timelines(traces)
+    else:
+        print "No config traces found"
+
+
+if __name__ == '__main__': # pragma: no cover
+    main()
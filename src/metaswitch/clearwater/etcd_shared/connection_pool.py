@@ -0,0 +1,189 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# The connections that a process uses to talk to etcd.
+#
+# Every etcd client in the process shares one LanedPoolManager (see
+# create_client() in etcd_backend.py), rather than each having its own urllib3
+# PoolManager. This keeps connections alive between clients, and bounds how
+# many we hold open.
+#
+# Watches and other requests use separate "lanes" (i.e. separate pools), so a
+# burst of reads never has to wait for a connection held by a long-poll watch.
+# Each lane counts the requests it makes and the connections it opens, so we
+# can see how often connections are reused.
+
+import logging
+import urllib3
+from threading import Lock
+from time import time
+from .cancellable_watch import CancellableHTTPConnectionPool, \
+    CancellableHTTPSConnectionPool
+from .endpoint_selector import record_request
+from . import metrics
+
+_log = logging.getLogger(__name__)
+
+# The number of connections to each etcd server that each lane keeps open.
+#
+# Every synchronizer can hold a watch open, so the watch lane doesn't block
+# when it runs out - it opens an extra connection, which is closed when the
+# watch finishes. Other requests are short, so they wait for a connection.
+WATCH_CONNECTIONS = 20
+REQUEST_CONNECTIONS = 4
+
+# The number of etcd servers to keep connections to
+NUM_POOLS = 10
+
+
+class LaneStats(object):
+    def __init__(self):
+        self._lock = Lock()
+        self.requests = 0
+        self.connections = 0
+
+    def request_made(self):
+        with self._lock:
+            self.requests += 1
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections += 1
+
+    def reused(self):
+        """Returns the number of requests that reused an existing
+        connection."""
+        with self._lock:
+            return max(self.requests - self.connections, 0)
+
+
+class _CountingPoolMixin(object):
+    # Set on the subclasses made for each lane
+    stats = None
+
+    def _new_conn(self):
+        self.stats.connection_opened()
+        return super(_CountingPoolMixin, self)._new_conn()
+
+    def _make_request(self, conn, method, url, **kwargs):
+        self.stats.request_made()
+        return super(_CountingPoolMixin, self)._make_request(conn,
+                                                             method,
+                                                             url,
+                                                             **kwargs)
+
+
+def _pool_manager(stats, maxsize, block):
+    # urllib3 doesn't let us pass our own arguments through to the pools it
+    # creates, so make pool classes that know which lane they're in.
+    pool_classes = {
+        "http": type("CountingHTTPConnectionPool",
+                     (_CountingPoolMixin, CancellableHTTPConnectionPool),
+                     {"stats": stats}),
+        "https": type("CountingHTTPSConnectionPool",
+                      (_CountingPoolMixin, CancellableHTTPSConnectionPool),
+                      {"stats": stats})}
+    manager = urllib3.PoolManager(num_pools=NUM_POOLS,
+                                  maxsize=maxsize,
+                                  block=block)
+    manager.pool_classes_by_scheme = pool_classes
+    return manager
+
+
+class LanedPoolManager(object):
+    """Stands in for a urllib3 PoolManager, sending watches and other requests
+    to etcd through separate pools.
+
+    python-etcd's requests are treated as watches if they have wait=true.
+    Other callers pass watch=True to urlopen()."""
+
+    def __init__(self):
+        self.watch_stats = LaneStats()
+        self.request_stats = LaneStats()
+        self._watches = _pool_manager(self.watch_stats,
+                                      WATCH_CONNECTIONS,
+                                      block=False)
+        self._requests = _pool_manager(self.request_stats,
+                                       REQUEST_CONNECTIONS,
+                                       block=True)
+
+    def _lane(self, watch=False, fields=None):
+        if watch or (isinstance(fields, dict) and
+                     fields.get("wait") in ("true", True)):
+            return self._watches
+        return self._requests
+
+    def _timed(self, lane, url, request):
+        # Record how long each request (other than a watch) takes to get a
+        # response, so that we can tell how each etcd member is doing. See
+        # endpoint_selector.py.
+        if lane is self._watches:
+            return request()
+
+        start = time()
+        try:
+            response = request()
+        except Exception:
+            record_request(url, time() - start, False)
+            metrics.etcd_request_seconds.observe(time() - start)
+            metrics.etcd_request_errors.inc()
+            raise
+        ok = getattr(response, "status", 200) < 500
+        record_request(url, time() - start, ok)
+        metrics.etcd_request_seconds.observe(time() - start)
+        if not ok:
+            metrics.etcd_request_errors.inc()
+        return response
+
+    def request(self, method, url, fields=None, **kwargs):
+        lane = self._lane(fields=fields)
+        return self._timed(lane, url, lambda: lane.request(method,
+                                                           url,
+                                                           fields=fields,
+                                                           **kwargs))
+
+    def request_encode_body(self, method, url, fields=None, **kwargs):
+        lane = self._lane(fields=fields)
+        return self._timed(lane, url, lambda: lane.request_encode_body(
+                                                  method,
+                                                  url,
+                                                  fields=fields,
+                                                  **kwargs))
+
+    def urlopen(self, method, url, watch=False, **kwargs):
+        lane = self._lane(watch=watch)
+        return self._timed(lane, url, lambda: lane.urlopen(method,
+                                                           url,
+                                                           **kwargs))
+
+    def clear(self):
+        self._watches.clear()
+        self._requests.clear()
+
+    def log_stats(self):
+        for name, stats in (("watch", self.watch_stats),
+                            ("request", self.request_stats)):
+            _log.info("etcd {} connections: {} requests, {} connections"
+                      " opened, {} requests reused a connection".
+                      format(name,
+                             stats.requests,
+                             stats.connections,
+                             stats.reused()))
+
+
+_shared = None
+_shared_lock = Lock()
+
+
+def shared_pool_manager():
+    """Returns the LanedPoolManager shared by every etcd client in this
+    process."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = LanedPoolManager()
+        return _shared
@@ -0,0 +1,224 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# Chooses which member of the etcd cluster to send requests to.
+#
+# Each process normally talks to the etcd server on its own node (its "home"
+# endpoint). We keep a smoothed round-trip time and error rate for every etcd
+# member we send requests to (recorded by the shared connection pool - see
+# connection_pool.py), and periodically discover the cluster's members and
+# probe them, so that we know how each is doing.
+#
+# Reads stay on the home endpoint unless it is failing, or much slower than
+# the best other member, in which case they move to that member until the
+# home endpoint recovers. Writes go to the cluster leader when we know it, as
+# every write ends up there anyway.
+
+import logging
+import urllib3
+from threading import Lock
+from time import time
+from urllib3.util import parse_url
+from .retry_policy import circuit_breaker
+
+_log = logging.getLogger(__name__)
+
+
+class EndpointStats(object):
+    # The weight given to each new sample when updating the averages
+    SMOOTHING = 0.3
+
+    # How much each unit of error rate inflates an endpoint's score
+    ERROR_PENALTY = 10
+
+    def __init__(self):
+        self._lock = Lock()
+        self.latency = None
+        self.error_rate = 0.0
+
+    def record(self, latency, ok):
+        with self._lock:
+            if ok:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += self.SMOOTHING * (latency - self.latency)
+            self.error_rate += self.SMOOTHING * ((0.0 if ok else 1.0) -
+                                                 self.error_rate)
+
+    def score(self):
+        """Returns how good the endpoint is (lower is better), or None if we
+        haven't yet had a successful request to it."""
+        with self._lock:
+            if self.latency is None:
+                return None
+            return self.latency * (1 + self.ERROR_PENALTY * self.error_rate)
+
+
+# The stats for each etcd endpoint this process talks to
+_stats = {}
+_stats_lock = Lock()
+
+
+def endpoint_stats(host):
+    with _stats_lock:
+        if host not in _stats:
+            _stats[host] = EndpointStats()
+        return _stats[host]
+
+
+def record_request(url, latency, ok):
+    """Records how long a request to the given URL took, and whether it
+    succeeded."""
+    host = parse_url(url).host
+    if host is not None:
+        endpoint_stats(host).record(latency, ok)
+
+
+class EndpointSelector(object):
+    # How often to rediscover the cluster's members and probe them, in seconds
+    DISCOVERY_INTERVAL = 60
+    PROBE_TIMEOUT = 1
+
+    # An endpoint with an error rate above this isn't used
+    MAX_ERROR_RATE = 0.5
+
+    # Reads move off the home endpoint if its score is more than SLOW_FACTOR
+    # times the best other member's, and it's taking at least SLOW_LATENCY
+    # seconds per request (so that we don't move between members whose
+    # latency is too small to matter).
+    SLOW_FACTOR = 2
+    SLOW_LATENCY = 0.1
+
+    def __init__(self, home, port=4000):
+        self.home = home
+        self._port = port
+        self._lock = Lock()
+        self._members = [home]
+        self._leader = None
+        self._next_discovery = 0
+        self._discovering = False
+        self._read_endpoint = home
+        self._probe_pool = urllib3.PoolManager(maxsize=1)
+
+    def members(self):
+        with self._lock:
+            return list(self._members)
+
+    def leader(self):
+        return self._leader
+
+    def discover(self, client):
+        """Finds the cluster's members and leader using client, and probes
+        each member, if we haven't done so recently. Only one thread does this
+        at a time - others carry on with what we already know."""
+        with self._lock:
+            if self._discovering or time() < self._next_discovery:
+                return
+            self._discovering = True
+            self._next_discovery = time() + self.DISCOVERY_INTERVAL
+
+        members, leader = [], None
+        try:
+            members = [parse_url(url).host for url in client.machines
+                       if isinstance(url, basestring)]
+        except Exception as e:
+            _log.debug("Couldn't discover etcd members: {!r}".format(e))
+
+        try:
+            leader_url = client.leader["clientURLs"][0]
+            if isinstance(leader_url, basestring):
+                leader = parse_url(leader_url).host
+        except Exception as e:
+            _log.debug("Couldn't discover etcd leader: {!r}".format(e))
+
+        with self._lock:
+            if members:
+                if set(members) != set(self._members):
+                    _log.info("etcd members are {}".format(members))
+                self._members = members
+            if leader != self._leader:
+                _log.info("etcd leader is {}".format(leader))
+                self._leader = leader
+            self._discovering = False
+
+        # Our own requests tell us how the endpoint we're using is doing, but
+        # we need to probe the others (including the home endpoint if we've
+        # moved off it, so that we notice when it recovers).
+        for member in set(self.members() + [self.home]):
+            if member != self._read_endpoint:
+                self._probe(member)
+
+    def _probe(self, host):
+        url = "http://{}:{}/version".format(host, self._port)
+        start = time()
+        try:
+            self._probe_pool.request("GET",
+                                     url,
+                                     timeout=self.PROBE_TIMEOUT,
+                                     retries=False)
+            record_request(url, time() - start, True)
+        except Exception:
+            record_request(url, time() - start, False)
+
+    def _usable(self, host):
+        stats = endpoint_stats(host)
+        return (stats.error_rate <= self.MAX_ERROR_RATE and
+                not circuit_breaker(host).is_open())
+
+    def _best_other(self):
+        best, best_score = None, None
+        for member in self.members():
+            score = endpoint_stats(member).score()
+            if (member != self.home and
+                score is not None and
+                self._usable(member) and
+                (best_score is None or score < best_score)):
+                best, best_score = member, score
+        return best, best_score
+
+    def read_endpoint(self):
+        """Returns the member to send reads to."""
+        chosen = self.home
+        best, best_score = self._best_other()
+        if best is not None:
+            home_score = endpoint_stats(self.home).score()
+            if not self._usable(self.home):
+                chosen = best
+            elif (home_score is not None and
+                  home_score >= self.SLOW_LATENCY and
+                  home_score > self.SLOW_FACTOR * best_score):
+                chosen = best
+
+        if chosen != self._read_endpoint:
+            if chosen == self.home:
+                _log.info("etcd at {} has recovered - sending requests to it"
+                          " again".format(chosen))
+            else:
+                _log.warning("etcd at {} is slow or failing - sending requests"
+                             " to {} instead".format(self.home, chosen))
+            self._read_endpoint = chosen
+        return chosen
+
+    def write_endpoint(self):
+        """Returns the member to send writes to."""
+        leader = self._leader
+        if leader is not None and self._usable(leader):
+            return leader
+        return self.read_endpoint()
+
+
+# The selector for each home endpoint in this process
+_selectors = {}
+_selectors_lock = Lock()
+
+
+def endpoint_selector(home):
+    with _selectors_lock:
+        if home not in _selectors:
+            _selectors[home] = EndpointSelector(home)
+        return _selectors[home]
@@ -0,0 +1,115 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# The interface that the synchronizers and scripts use to talk to etcd, and a
+# factory for clients that implement it.
+#
+# The interface is the subset of python-etcd's Client that we use, so
+# python-etcd's v2 client implements it as-is. Other backends (e.g. the v3
+# client in etcd_v3_client.py) return python-etcd EtcdResults and raise
+# python-etcd exceptions, so that callers don't need to know which backend
+# they're using.
+#
+# Note that etcd keeps v2 and v3 data separately, so every node in a
+# deployment must use the same API version.
+
+import abc
+import etcd
+import logging
+import os
+from .etcd_v3_client import EtcdV3Client
+from .etcd_proxy_client import EtcdProxyClient
+from .connection_pool import shared_pool_manager
+
+_log = logging.getLogger(__name__)
+
+V2 = "2"
+V3 = "3"
+API_VERSIONS = (V2, V3)
+
+# The API version used by clients that don't ask for a specific one. Scripts
+# pick this up from the environment; daemons set it from their command line.
+_api_version = os.environ.get("CLEARWATER_ETCD_API_VERSION", V2)
+
+# The socket of the node-local caching proxy (see etcd_proxy.py) that clients
+# should read from if it's running. Only scripts set this - the daemons always
+# talk to etcd directly.
+_proxy_socket = os.environ.get("CLEARWATER_ETCD_PROXY_SOCKET")
+
+
+class EtcdBackend(object):
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def read(self, key, **kwdargs):
+        """Reads a key (or with recursive=True, every key under it). Supports
+        the python-etcd arguments wait, waitIndex, recursive, quorum and
+        timeout. Returns an EtcdResult, whose etcd_index is the index of the
+        store when the read was made."""
+
+    @abc.abstractmethod
+    def write(self, key, value, **kwdargs):
+        """Writes a key. Supports the python-etcd arguments prevIndex and
+        prevExist. Returns an EtcdResult for the new value."""
+
+    @abc.abstractmethod
+    def delete(self, key, **kwdargs):
+        """Deletes a key. Supports the python-etcd argument prevIndex."""
+
+    @abc.abstractmethod
+    def get(self, key):
+        """Reads a key."""
+
+# python-etcd's client is the v2 backend.
+EtcdBackend.register(etcd.Client)
+EtcdBackend.register(EtcdV3Client)
+EtcdBackend.register(EtcdProxyClient)
+
+
+def set_api_version(version):
+    global _api_version
+    if version not in API_VERSIONS:
+        raise ValueError("Unsupported etcd API version {}".format(version))
+    _log.info("Using etcd API version {}".format(version))
+    _api_version = version
+
+
+def get_api_version():
+    return _api_version
+
+
+def create_client(host, port=4000, api_version=None):
+    """Creates a client for the etcd server at host:port, using the given API
+    version (or the process-wide one if not specified).
+
+    Every client uses the process's shared connection pool - see
+    connection_pool.py. If the process has been told about a caching proxy,
+    the client reads from that where possible."""
+    version = api_version or _api_version
+    if version == V3:
+        client = EtcdV3Client(host, port)
+    else:
+        client = etcd.Client(host, port)
+        client.http = shared_pool_manager()
+
+    if _proxy_socket and os.path.exists(_proxy_socket):
+        return EtcdProxyClient(_proxy_socket, client)
+    return client
+
+
+def set_endpoint(client, host, port=4000):
+    """Sends a client's future requests to the etcd server at host (e.g. one
+    chosen by an EndpointSelector)."""
+    if hasattr(client, "set_endpoint"):
+        client.set_endpoint(host)
+    else:
+        # python-etcd's client sends every request to its _base_uri.
+        client._base_uri = "{}://{}:{}".format(getattr(client,
+                                                       "_protocol",
+                                                       "http"),
+                                               host,
+                                               port)
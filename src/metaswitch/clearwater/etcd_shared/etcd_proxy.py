@@ -0,0 +1,333 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# A node-local, read-only cache of an etcd subtree, served over a unix socket.
+#
+# Monitoring and CLI tools (check_cluster_state, check_config_sync,
+# check_queue_state, cw-config) are run often, and each run would otherwise
+# open its own connection to etcd and read keys that haven't changed. The
+# CachingProxy keeps a copy of everything under the deployment's etcd key,
+# kept up to date by a WatchMultiplexer, and answers their reads from it.
+#
+# Clients (see etcd_proxy_client.py) send one JSON request per connection and
+# get one JSON response back. Reads of keys outside the subtree, quorum reads,
+# watches and writes (unless the proxy is allowed to pass through writes to
+# keys in the subtree) are refused with an "unavailable" error, and the client
+# sends them to etcd instead. The same happens if the proxy isn't running.
+#
+# Reads from the cache are as fresh as a (non-quorum) read of the local etcd
+# server - a change is seen as soon as the proxy's watch sees it.
+
+import etcd
+import grp
+import json
+import logging
+import os
+import SocketServer
+import traceback
+from threading import Thread, Condition, Lock
+from .etcd_backend import create_client
+from .retry_policy import RetryPolicy
+
+_log = logging.getLogger(__name__)
+
+# Where the proxy listens, and where clients look for it
+DEFAULT_SOCKET = "/var/run/clearwater-etcd-proxy.sock"
+
+UNAVAILABLE = "unavailable"
+
+# The proxy may pass writes through to etcd, so its socket is only usable by
+# root and (if it exists) this group.
+SOCKET_MODE = 0660
+SOCKET_GROUP = "clearwater"
+
+# The arguments that are passed through with writes and deletes. Requests
+# with any others (e.g. recursive deletes) are refused, and the client sends
+# them to etcd itself.
+_WRITE_ARGS = frozenset(["prevIndex", "prevValue", "prevExist", "ttl"])
+_DELETE_ARGS = frozenset(["prevIndex", "prevValue"])
+
+_DELETE_ACTIONS = ("delete", "expire", "compareAndDelete")
+
+
+def node_from_result(result):
+    """Returns the etcd JSON representation of an EtcdResult's node."""
+    node = {"key": result.key,
+            "modifiedIndex": result.modifiedIndex,
+            "createdIndex": result.createdIndex}
+    if result.dir:
+        node["dir"] = True
+    else:
+        node["value"] = result.value
+    return node
+
+
+class SubtreeCache(object):
+    """The keys under an etcd prefix, and their values."""
+
+    def __init__(self, prefix):
+        self._prefix = prefix
+        self._lock = Lock()
+
+        # The node for each key (not including directories), and the etcd
+        # index that they're up to date with, or None if we're (re)loading
+        # the cache. Changes seen while loading are held in _buffered.
+        self._nodes = {}
+        self._index = None
+        self._buffered = []
+
+    def covers(self, key):
+        return key == self._prefix or key.startswith(self._prefix + "/")
+
+    def is_loaded(self):
+        with self._lock:
+            return self._index is not None
+
+    def begin_load(self):
+        with self._lock:
+            self._index = None
+            self._buffered = []
+
+    def finish_load(self, leaves, index):
+        """Replaces the cache's contents with the given leaf EtcdResults,
+        read when etcd's index was index."""
+        with self._lock:
+            self._nodes = {leaf.key: node_from_result(leaf)
+                           for leaf in leaves
+                           if not leaf.dir and self.covers(leaf.key)}
+            self._index = index
+            buffered, self._buffered = self._buffered, []
+            for result in buffered:
+                self._apply(result)
+        _log.info("Cached {} keys under {} at index {}".format(
+                      len(self._nodes), self._prefix, index))
+
+    def apply(self, result):
+        """Updates the cache with a change seen by a watch."""
+        with self._lock:
+            if self._index is None:
+                self._buffered.append(result)
+            else:
+                self._apply(result)
+
+    def _apply(self, result):
+        if result.modifiedIndex <= self._index:
+            # We loaded the cache after this change.
+            return
+        self._index = result.modifiedIndex
+
+        if result.action in _DELETE_ACTIONS:
+            self._nodes.pop(result.key, None)
+            for key in [k for k in self._nodes
+                        if k.startswith(result.key + "/")]:
+                del self._nodes[key]
+        elif not result.dir:
+            self._nodes[result.key] = node_from_result(result)
+
+    def lookup(self, key, recursive=False):
+        """Returns the node for key, as etcd would (a directory node's
+        children are included, and their children too if recursive), and the
+        index that the cache is up to date with. Raises KeyError if the key
+        doesn't exist."""
+        with self._lock:
+            if key in self._nodes:
+                return dict(self._nodes[key]), self._index
+
+            root = {"key": key, "dir": True, "nodes": []}
+            dirs = {key: root}
+            for leaf_key in sorted(self._nodes):
+                if not leaf_key.startswith(key + "/"):
+                    continue
+
+                parts = leaf_key[len(key) + 1:].split("/")
+                if not recursive:
+                    # Just list our children, without their contents.
+                    parts = parts[:1]
+
+                parent = root
+                path = key
+                for part in parts[:-1]:
+                    path = path + "/" + part
+                    if path not in dirs:
+                        dirs[path] = {"key": path, "dir": True, "nodes": []}
+                        parent["nodes"].append(dirs[path])
+                    parent = dirs[path]
+
+                path = path + "/" + parts[-1]
+                if path == leaf_key:
+                    parent["nodes"].append(dict(self._nodes[leaf_key]))
+                elif path not in dirs:
+                    dirs[path] = {"key": path, "dir": True}
+                    parent["nodes"].append(dirs[path])
+
+            if len(dirs) == 1 and key != self._prefix:
+                raise KeyError(key)
+            return root, self._index
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self.server.proxy.handle(request)
+        except Exception as e:
+            _log.debug("Bad request to etcd proxy: {!r}".format(e))
+            response = {"error": UNAVAILABLE}
+        self.wfile.write(json.dumps(response) + "\n")
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class CachingProxy(object):
+    PAUSE_BEFORE_RETRY_ON_EXCEPTION = 30
+
+    def __init__(self, prefix, multiplexer, etcd_ip,
+                 socket_path=DEFAULT_SOCKET, allow_writes=False):
+        self._prefix = multiplexer.normalise(prefix)
+        self._multiplexer = multiplexer
+        self._client = create_client(etcd_ip, 4000)
+        self._retry = RetryPolicy(etcd_ip, self.PAUSE_BEFORE_RETRY_ON_EXCEPTION)
+        self._socket_path = socket_path
+        self._allow_writes = allow_writes
+        self.cache = SubtreeCache(self._prefix)
+
+        self._condition = Condition()
+        self._reload_needed = True
+        self._terminate_flag = False
+        self._server = None
+
+        # Subscribe now, so we see every change after the multiplexer starts.
+        multiplexer.subscribe_subtree(self._on_change)
+        self.thread = Thread(target=self.load_cache, name="EtcdProxy")
+
+    def start_thread(self):
+        if os.path.exists(self._socket_path):
+            # Left over from a previous run.
+            os.unlink(self._socket_path)
+        self._server = _Server(self._socket_path, _Handler)
+        self._server.proxy = self
+        self._restrict_socket()
+        server_thread = Thread(target=self._server.serve_forever,
+                               name="EtcdProxyServer")
+        server_thread.daemon = True
+        server_thread.start()
+
+        self.thread.daemon = True
+        self.thread.start()
+        _log.info("Serving etcd reads under {} on {}".format(
+                      self._prefix, self._socket_path))
+
+    def _restrict_socket(self):
+        os.chmod(self._socket_path, SOCKET_MODE)
+        try:
+            os.chown(self._socket_path, -1, grp.getgrnam(SOCKET_GROUP).gr_gid)
+        except KeyError:
+            # No such group, so only root can use the proxy.
+            pass
+        except OSError as e:
+            _log.warning("Failed to give group {} access to {}: {!r}".format(
+                             SOCKET_GROUP, self._socket_path, e))
+
+    def terminate(self):
+        with self._condition:
+            self._terminate_flag = True
+            self._condition.notify_all()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            try:
+                os.unlink(self._socket_path)
+            except OSError: # pragma: no cover
+                pass
+        if self.thread.isAlive():
+            self.thread.join()
+
+    def _on_change(self, result):
+        # Called on the multiplexer's thread, so mustn't block.
+        if result is None:
+            # The multiplexer may have missed changes.
+            with self._condition:
+                self._reload_needed = True
+                self.cache.begin_load()
+                self._condition.notify_all()
+        else:
+            self.cache.apply(result)
+
+    def load_cache(self):
+        # Wait until the multiplexer is watching, so that every change after
+        # the read we're about to make is passed to us.
+        self._multiplexer.wait_until_watching()
+
+        while True:
+            with self._condition:
+                while not self._reload_needed and not self._terminate_flag:
+                    self._condition.wait()
+                if self._terminate_flag:
+                    return
+                self._reload_needed = False
+                self.cache.begin_load()
+
+            try:
+                try:
+                    result = self._client.read(self._prefix,
+                                               recursive=True,
+                                               quorum=True)
+                    self.cache.finish_load(list(result.leaves),
+                                           result.etcd_index)
+                except etcd.EtcdKeyNotFound as e:
+                    # The subtree doesn't exist yet.
+                    self.cache.finish_load([], e.payload["index"])
+                self._retry.succeeded()
+            except Exception as e:
+                _log.error("Failed to read {} for the etcd proxy cache: {!r}"
+                           " - pause before retry".format(self._prefix, e))
+                with self._condition:
+                    self._reload_needed = True
+                self._retry.pause()
+
+    def handle(self, request):
+        """Returns the response to a client's request - see
+        etcd_proxy_client.py."""
+        method = request.get("method")
+        key = self._multiplexer.normalise(request.get("key", ""))
+
+        if method == "read":
+            if not self.cache.covers(key) or not self.cache.is_loaded():
+                return {"error": UNAVAILABLE}
+            try:
+                node, index = self.cache.lookup(key,
+                                                request.get("recursive", False))
+                return {"action": "get", "node": node, "index": index}
+            except KeyError:
+                return {"error": "EtcdKeyNotFound",
+                        "message": "Key not found : {}".format(key)}
+
+        if (method in ("write", "delete") and
+            self._allow_writes and
+            self.cache.covers(key)):
+            args = request.get("args", {})
+            allowed = _WRITE_ARGS if method == "write" else _DELETE_ARGS
+            if not isinstance(args, dict) or not set(args) <= allowed:
+                _log.warning("Not passing {} of {} with arguments {} through "
+                             "to etcd".format(method, key, args))
+                return {"error": UNAVAILABLE}
+            try:
+                if method == "write":
+                    result = self._client.write(key, request["value"], **args)
+                else:
+                    result = self._client.delete(key, **args)
+                return {"action": result.action,
+                        "node": node_from_result(result),
+                        "index": result.etcd_index}
+            except etcd.EtcdException as e:
+                return {"error": e.__class__.__name__, "message": str(e)}
+            except Exception:
+                _log.error(traceback.format_exc())
+
+        return {"error": UNAVAILABLE}
@@ -0,0 +1,103 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# A client that reads from the node-local etcd proxy (see etcd_proxy.py) where
+# it can, and from etcd otherwise.
+#
+# This presents the same interface as the other etcd clients (see
+# etcd_backend.py). Anything the proxy can't answer - because it isn't
+# running, doesn't cache the key, or is asked for a quorum read or a watch -
+# goes to the etcd client that this wraps.
+
+import etcd
+import json
+import logging
+import socket
+
+_log = logging.getLogger(__name__)
+
+
+class EtcdProxyClient(object):
+    # How long to wait for the proxy, in seconds
+    TIMEOUT = 5
+
+    def __init__(self, socket_path, client):
+        self._socket_path = socket_path
+        self._client = client
+
+    def __getattr__(self, name):
+        # Anything else (e.g. host and port) is the wrapped client's.
+        return getattr(self._client, name)
+
+    # Public interface - see EtcdBackend.
+
+    def get(self, key):
+        return self.read(key)
+
+    def read(self, key, **kwdargs):
+        if kwdargs.get("wait") or kwdargs.get("quorum"):
+            return self._client.read(key, **kwdargs)
+
+        response = self._request({"method": "read",
+                                  "key": key,
+                                  "recursive": bool(kwdargs.get("recursive"))})
+        if response is None:
+            return self._client.read(key, **kwdargs)
+        return response
+
+    def write(self, key, value, **kwdargs):
+        response = self._request({"method": "write",
+                                  "key": key,
+                                  "value": value,
+                                  "args": kwdargs})
+        if response is None:
+            return self._client.write(key, value, **kwdargs)
+        return response
+
+    def delete(self, key, **kwdargs):
+        response = self._request({"method": "delete",
+                                  "key": key,
+                                  "args": kwdargs})
+        if response is None:
+            return self._client.delete(key, **kwdargs)
+        return response
+
+    # Internals
+
+    def _request(self, request):
+        # Returns the EtcdResult for the request (or raises the etcd exception
+        # it failed with), or None if the proxy can't handle it.
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.TIMEOUT)
+            try:
+                sock.connect(self._socket_path)
+                sock.sendall(json.dumps(request) + "\n")
+                data = ""
+                while not data.endswith("\n"):
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+            finally:
+                sock.close()
+            response = json.loads(data)
+        except (socket.error, ValueError) as e:
+            _log.debug("etcd proxy unavailable: {!r}".format(e))
+            return None
+
+        error = response.get("error")
+        if error is not None:
+            exception = getattr(etcd, error, None)
+            if isinstance(exception, type) and issubclass(exception,
+                                                          etcd.EtcdException):
+                raise exception(response.get("message"))
+            return None
+
+        result = etcd.EtcdResult(response["action"], response["node"])
+        result.etcd_index = response["index"]
+        return result
@@ -0,0 +1,371 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# A client for etcd's v3 API, using the JSON gateway to the gRPC API that
+# etcd 3.1 serves on its client port.
+#
+# This presents the same interface as python-etcd's v2 client (see
+# etcd_backend.py), mapping v2 concepts onto v3 ones:
+#
+#  - v2 indexes are v3 revisions. A key's modifiedIndex is its mod_revision,
+#    and a result's etcd_index is the store revision when the request was
+#    handled.
+#  - v2 directories are key prefixes - a recursive read or watch of "/a"
+#    covers every key starting "/a/".
+#  - v2 compare-and-swap writes (prevIndex / prevExist) are v3 transactions.
+#
+# It also supports streaming watches (watch_stream()), which deliver every
+# change from a given revision over a single long-lived connection, rather
+# than needing a new request for each change.
+
+import base64
+import httplib
+import json
+import logging
+import socket
+import urllib3
+from contextlib import contextmanager
+import etcd
+from .cancellable_watch import watch_cancelled
+from .connection_pool import shared_pool_manager
+
+_log = logging.getLogger(__name__)
+
+
+def _encode(s):
+    if isinstance(s, unicode):
+        s = s.encode("utf-8")
+    return base64.b64encode(s)
+
+
+def _decode(s):
+    # python-etcd gives us unicode keys and values, so we do the same.
+    return base64.b64decode(s).decode("utf-8")
+
+
+def _prefix_end(prefix):
+    # The end of the range of keys starting with prefix - i.e. prefix with its
+    # last byte incremented (ignoring any trailing 0xff bytes).
+    if isinstance(prefix, unicode):
+        prefix = prefix.encode("utf-8")
+    end = bytearray(prefix)
+    while end:
+        if end[-1] < 0xff:
+            end[-1] += 1
+            return bytes(end)
+        end.pop()
+
+    # Every byte was 0xff, so the range runs to the end of the keyspace.
+    return b"\0"
+
+
+def _sanitize_key(key):
+    # As for python-etcd, keys are always absolute.
+    if not key.startswith("/"):
+        key = "/" + key
+    return key
+
+
+def _dir_prefix(key):
+    return key if key.endswith("/") else key + "/"
+
+
+class EtcdV3Client(object):
+    API_PREFIX = "/v3alpha"
+
+    # Default timeout on requests that aren't watches, in seconds
+    READ_TIMEOUT = 60
+
+    # Size of the reads we make from a watch stream. A smaller read may return
+    # as soon as a chunk of the stream arrives, so this just limits how much
+    # we read at once.
+    STREAM_READ_SIZE = 4096
+
+    def __init__(self, host, port=4000, protocol="http"):
+        self.port = port
+        self.protocol = protocol
+        self.set_endpoint(host)
+        self.http = shared_pool_manager()
+
+    def set_endpoint(self, host):
+        """Sends future requests to the etcd server at host."""
+        self.host = host
+        self._base_uri = "{}://{}:{}{}".format(self.protocol,
+                                               host,
+                                               self.port,
+                                               self.API_PREFIX)
+
+    # Public interface - see EtcdBackend.
+
+    def get(self, key):
+        return self.read(key)
+
+    def read(self, key, wait=False, waitIndex=None, recursive=False,
+             quorum=False, timeout=None, **kwdargs):
+        key = _sanitize_key(key)
+
+        if wait:
+            # A v2 watch returns the first change at or after waitIndex. Do the
+            # same by taking the first change from a watch stream.
+            stream = self.watch_stream(key,
+                                       start_index=waitIndex,
+                                       recursive=recursive,
+                                       timeout=timeout)
+            try:
+                return next(stream)
+            finally:
+                stream.close()
+
+        request = {"serializable": not quorum}
+        if recursive:
+            request["key"] = _encode(_dir_prefix(key))
+            request["range_end"] = _encode(_prefix_end(_dir_prefix(key)))
+        else:
+            request["key"] = _encode(key)
+
+        response = self._post("/kv/range", request, timeout=timeout)
+        revision = self._revision(response)
+        kvs = response.get("kvs", [])
+
+        if recursive and kvs:
+            nodes = [self._node(kv) for kv in kvs]
+            result = etcd.EtcdResult("get", {"key": key,
+                                             "dir": True,
+                                             "nodes": nodes})
+        elif recursive:
+            # Nothing under this key as a directory - try it as a single key.
+            return self.read(key, quorum=quorum, timeout=timeout)
+        elif kvs:
+            result = etcd.EtcdResult("get", self._node(kvs[0]))
+        else:
+            raise etcd.EtcdKeyNotFound("Key not found : {}".format(key),
+                                       payload={"index": revision})
+
+        result.etcd_index = revision
+        return result
+
+    def write(self, key, value, prevIndex=None, prevExist=None, **kwdargs):
+        key = _sanitize_key(key)
+        put = {"key": _encode(key), "value": _encode(value)}
+
+        if prevIndex is None and prevExist is None:
+            response = self._post("/kv/put", put)
+        else:
+            compare = {"key": _encode(key), "result": "EQUAL"}
+            if prevIndex is not None:
+                compare["target"] = "MOD"
+                compare["mod_revision"] = str(prevIndex)
+            else:
+                # A key that doesn't exist has a create_revision of 0.
+                compare["target"] = "CREATE"
+                compare["create_revision"] = "0"
+                if prevExist:
+                    compare["result"] = "GREATER"
+
+            response = self._post("/kv/txn",
+                                  {"compare": [compare],
+                                   "success": [{"request_put": put}]})
+
+            # The gateway leaves out fields with default values, so
+            # "succeeded" is missing if the transaction failed.
+            if not response.get("succeeded", False):
+                if prevIndex is not None:
+                    raise etcd.EtcdCompareFailed(
+                        "Compare failed : [{} != current index] on {}".
+                        format(prevIndex, key))
+                elif prevExist:
+                    raise etcd.EtcdKeyNotFound(
+                        "Key not found : {}".format(key),
+                        payload={"index": self._revision(response)})
+                else:
+                    raise etcd.EtcdAlreadyExist(
+                        "Key already exists : {}".format(key))
+
+        revision = self._revision(response)
+        result = etcd.EtcdResult("set", {"key": key,
+                                         "value": value,
+                                         "modifiedIndex": revision})
+        result.etcd_index = revision
+        return result
+
+    def delete(self, key, prevIndex=None, **kwdargs):
+        key = _sanitize_key(key)
+        delete = {"key": _encode(key)}
+
+        if prevIndex is None:
+            response = self._post("/kv/deleterange", delete)
+            deleted = int(response.get("deleted", 0))
+        else:
+            response = self._post("/kv/txn",
+                                  {"compare": [{"key": _encode(key),
+                                                "result": "EQUAL",
+                                                "target": "MOD",
+                                                "mod_revision": str(prevIndex)}],
+                                   "success": [{"request_delete_range": delete}]})
+            if not response.get("succeeded", False):
+                raise etcd.EtcdCompareFailed(
+                    "Compare failed : [{} != current index] on {}".
+                    format(prevIndex, key))
+            deleted = 1
+
+        revision = self._revision(response)
+        if deleted == 0:
+            raise etcd.EtcdKeyNotFound("Key not found : {}".format(key),
+                                       payload={"index": revision})
+
+        result = etcd.EtcdResult("delete", {"key": key,
+                                            "modifiedIndex": revision})
+        result.etcd_index = revision
+        return result
+
+    def watch_stream(self, key, start_index=None, recursive=False, timeout=0):
+        """Generates an EtcdResult for each change to the key (or, with
+        recursive=True, to any key under it) from start_index onwards, or from
+        now if start_index isn't given.
+
+        The timeout applies to the wait for each change. As for python-etcd, a
+        timeout of 0 means wait indefinitely. Raises EtcdEventIndexCleared if
+        etcd no longer holds the history from start_index."""
+        key = _sanitize_key(key)
+        request = {}
+        if recursive:
+            request["key"] = _encode(_dir_prefix(key))
+            request["range_end"] = _encode(_prefix_end(_dir_prefix(key)))
+        else:
+            request["key"] = _encode(key)
+        if start_index is not None:
+            request["start_revision"] = str(start_index)
+
+        response = self._post("/watch",
+                              {"create_request": request},
+                              timeout=timeout,
+                              stream=True)
+        try:
+            for message in self._messages(response):
+                if "error" in message:
+                    raise etcd.EtcdException(
+                        "Watch on {} failed: {}".format(key, message["error"]))
+
+                result = message.get("result", {})
+                if int(result.get("compact_revision", 0)) > 0:
+                    raise etcd.EtcdEventIndexCleared(
+                        "The event in requested index is outdated and cleared",
+                        payload={"index": int(result["compact_revision"])})
+                if result.get("canceled", False):
+                    raise etcd.EtcdConnectionFailed(
+                        "Watch on {} cancelled by etcd".format(key))
+
+                revision = self._revision(result)
+                for event in result.get("events", []):
+                    yield self._event_result(event, revision)
+        finally:
+            # Don't return a connection to the pool in the middle of a stream.
+            response.close()
+
+    # Internals
+
+    @staticmethod
+    def _revision(response):
+        return int(response.get("header", {}).get("revision", 0))
+
+    @staticmethod
+    def _node(kv):
+        # Values are left out of the JSON if they're empty.
+        return {"key": _decode(kv["key"]),
+                "value": _decode(kv.get("value", "")),
+                "modifiedIndex": int(kv.get("mod_revision", 0)),
+                "createdIndex": int(kv.get("create_revision", 0))}
+
+    def _event_result(self, event, revision):
+        # As above, the type is left out for PUT events (the default).
+        node = self._node(event["kv"])
+        if event.get("type", "PUT") == "DELETE":
+            action = "delete"
+            node["value"] = None
+        else:
+            action = "set"
+        result = etcd.EtcdResult(action, node)
+        result.etcd_index = revision
+        return result
+
+    def _timeout(self, timeout):
+        # Treat timeouts as python-etcd does - None means the default, and 0
+        # means no timeout.
+        if timeout is None:
+            return self.READ_TIMEOUT
+        elif timeout == 0:
+            return None
+        return timeout
+
+    @contextmanager
+    def _translated_errors(self):
+        # Turn errors from urllib3 into the python-etcd exceptions that
+        # callers expect.
+        try:
+            yield
+        except urllib3.exceptions.ReadTimeoutError:
+            raise etcd.EtcdWatchTimedOut("Read timed out")
+        except (urllib3.exceptions.HTTPError,
+                httplib.HTTPException,
+                socket.error) as e:
+            if watch_cancelled():
+                raise etcd.EtcdConnectionFailed("Watch cancelled")
+            raise etcd.EtcdConnectionFailed(
+                "Connection to etcd failed due to {!r}".format(e))
+
+    def _post(self, path, body, timeout=None, stream=False):
+        with self._translated_errors():
+            response = self.http.urlopen(
+                "POST",
+                self._base_uri + path,
+                body=json.dumps(body),
+                headers={"Content-Type": "application/json"},
+                timeout=self._timeout(timeout),
+                retries=False,
+                preload_content=not stream,
+                watch=stream)
+
+            if response.status != 200:
+                data = response.data
+                response.release_conn()
+                try:
+                    error = json.loads(data).get("error", data)
+                except ValueError:
+                    error = data
+                raise etcd.EtcdException(
+                    "etcd returned {} for {}: {}".format(response.status,
+                                                         path,
+                                                         error))
+
+            if stream:
+                return response
+            return json.loads(response.data)
+
+    def _messages(self, response):
+        # The gateway streams a JSON object per watch response. They may be
+        # split across (or share) reads, so decode them incrementally.
+        decoder = json.JSONDecoder()
+        buffered = ""
+        with self._translated_errors():
+            for chunk in response.stream(self.STREAM_READ_SIZE):
+                buffered += chunk
+                while True:
+                    buffered = buffered.lstrip()
+                    if not buffered:
+                        break
+                    try:
+                        message, end = decoder.raw_decode(buffered)
+                    except ValueError:
+                        # Wait for the rest of this object.
+                        break
+                    buffered = buffered[end:]
+                    yield message
+
+        # etcd never ends a watch stream itself, so we must have been cut off.
+        if watch_cancelled():
+            raise etcd.EtcdConnectionFailed("Watch cancelled")
+        raise etcd.EtcdConnectionFailed("Watch stream closed by etcd")
@@ -0,0 +1,274 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# An optional alternative to running a thread per synchronizer.
+#
+# An EventLoop runs callbacks and timers on a single thread, and runs anything
+# that might block (etcd reads and writes, FSM steps and the plugin hooks they
+# call) on a small, fixed pool of worker threads.
+#
+# A SynchronizerEngine uses an EventLoop to drive every synchronizer in a
+# daemon. Changes to the synchronizers' keys come from the WatchMultiplexer,
+# so no synchronizer watches etcd itself. Each synchronizer's steps run one at
+# a time, in order, and if several changes to its key arrive while it's busy
+# it only acts on the latest. Timers (QueueTimer, TooLongAlarm) are scheduled
+# on the installed EventLoop rather than each having their own thread.
+#
+# The number of threads is therefore the same however many plugins a daemon
+# has.
+
+import heapq
+import logging
+import traceback
+import os
+import signal
+from collections import deque
+from concurrent import futures
+from threading import Thread, Condition, Lock
+from time import time
+
+_log = logging.getLogger(__name__)
+
+# The EventLoop that timers should be scheduled on, if any
+_installed = None
+
+
+def installed_loop():
+    return _installed
+
+
+class TimerHandle(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+
+class EventLoop(object):
+    # The number of threads to run blocking work on
+    WORKER_THREADS = 4
+
+    def __init__(self, workers=None):
+        self._condition = Condition()
+        self._ready = deque()
+        self._timers = []
+        self._terminate_flag = False
+        self._workers = futures.ThreadPoolExecutor(workers or
+                                                   self.WORKER_THREADS)
+        self.thread = Thread(target=self.main_wrapper, name="EventLoop")
+
+    def install(self):
+        """Makes this the loop that timers are scheduled on."""
+        global _installed
+        _installed = self
+
+    def start_thread(self):
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops the loop thread, without waiting for it. Work already running
+        on the worker threads carries on."""
+        with self._condition:
+            self._terminate_flag = True
+            self._condition.notify()
+
+    def terminate(self):
+        global _installed
+        self.stop()
+        if self.thread.isAlive():
+            self.thread.join()
+        self._workers.shutdown(wait=False)
+        if _installed is self:
+            _installed = None
+
+    def call_soon(self, callback, *args):
+        """Runs callback on the loop thread. Can be called from any thread."""
+        with self._condition:
+            self._ready.append((callback, args))
+            self._condition.notify()
+
+    def call_later(self, delay, callback, *args):
+        """Runs callback on the loop thread after delay seconds. Returns a
+        handle that can be used to cancel it."""
+        handle = TimerHandle(time() + delay, callback, args)
+        with self._condition:
+            heapq.heappush(self._timers, handle)
+            self._condition.notify()
+        return handle
+
+    def run_in_worker(self, f, callback=None):
+        """Runs f on a worker thread. If given, callback is then called on the
+        loop thread with f's result (or None if f raised an exception)."""
+        def run():
+            result = None
+            try:
+                result = f()
+            except Exception:
+                _log.error(traceback.format_exc())
+            if callback is not None:
+                self.call_soon(callback, result)
+        self._workers.submit(run)
+
+    def main_wrapper(self): # pragma: no cover
+        # As for the synchronizers, restart the process if the loop fails, as
+        # nothing would happen without it.
+        try:
+            self.main()
+        except Exception:
+            _log.error(traceback.format_exc())
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def main(self):
+        while True:
+            with self._condition:
+                while not self._terminate_flag and not self._ready:
+                    # Discard cancelled timers, and move any that are due on
+                    # to the ready queue.
+                    now = time()
+                    while self._timers and (self._timers[0].cancelled or
+                                            self._timers[0].when <= now):
+                        handle = heapq.heappop(self._timers)
+                        if not handle.cancelled:
+                            self._ready.append((handle.callback, handle.args))
+
+                    if self._ready:
+                        break
+                    elif self._timers:
+                        self._condition.wait(self._timers[0].when - now)
+                    else:
+                        self._condition.wait()
+
+                if self._terminate_flag:
+                    return
+                callback, args = self._ready.popleft()
+
+            try:
+                callback(*args)
+            except Exception:
+                # One failed callback shouldn't stop everything else.
+                _log.error(traceback.format_exc())
+
+
+class SynchronizerEngine(object):
+    """Drives synchronizers from an EventLoop, instead of each running its
+    own thread. See CommonEtcdSynchronizer.handle_update() and process()."""
+
+    def __init__(self, loop, multiplexer):
+        self._loop = loop
+        self._multiplexer = multiplexer
+        self._syncers = []
+
+        # The steps waiting to run for each synchronizer, and which
+        # synchronizers have a step running. Only used on the loop thread.
+        self._queued = {}
+        self._busy = set()
+
+        # The latest change to each synchronizer's key that it hasn't yet
+        # seen
+        self._pending_lock = Lock()
+        self._pending_change = {}
+
+    def add(self, syncer):
+        self._syncers.append(syncer)
+        self._queued[syncer] = deque()
+        syncer.set_engine(self)
+        self._multiplexer.subscribe(syncer.key(),
+                                    lambda result: self._loop.call_soon(
+                                        self._on_change, syncer, result),
+                                    subtree=syncer.SUBTREE)
+
+    def start(self, snapshot=None):
+        self._loop.start_thread()
+        self._multiplexer.start_thread()
+
+        # Read every key to start with (in one go, if given a
+        # StartupSnapshot). Any later change is delivered by the multiplexer,
+        # which starts watching before we read.
+        self._multiplexer.wait_until_watching()
+        if snapshot is not None:
+            snapshot.seed(self._syncers)
+        for syncer in self._syncers:
+            self.submit(syncer, syncer.refresh)
+
+    def terminate(self):
+        for syncer in self._syncers:
+            syncer._terminate_flag = True
+            syncer.cancel_watch()
+        self._multiplexer.terminate()
+        self._loop.terminate()
+
+        # Now that the loop has stopped, tidy up any synchronizers that were
+        # still running.
+        for syncer in self._queued:
+            syncer.finish()
+
+    def submit(self, syncer, step):
+        """Runs step on a worker thread, after any other steps for the same
+        synchronizer. Can be called from any thread."""
+        self._loop.call_soon(self._enqueue, syncer, step)
+
+    def submit_later(self, syncer, delay, step):
+        """As submit(), but only queues step after delay seconds."""
+        self._loop.call_later(delay, self._enqueue, syncer, step)
+
+    def _on_change(self, syncer, result):
+        if result is None:
+            # The multiplexer may have missed changes, so read the key again.
+            self._enqueue(syncer, syncer.refresh)
+            return
+
+        # Only act on the latest change, and only queue one step to act on it
+        # - if that step is already queued it'll pick up this change.
+        with self._pending_lock:
+            already_queued = syncer in self._pending_change
+            self._pending_change[syncer] = result
+        if not already_queued:
+            self._enqueue(syncer, lambda: syncer.handle_update(
+                                              self._take_change(syncer)))
+
+    def _take_change(self, syncer):
+        with self._pending_lock:
+            return self._pending_change.pop(syncer, None)
+
+    def _enqueue(self, syncer, step):
+        if syncer not in self._queued:
+            # This synchronizer has stopped.
+            return
+        self._queued[syncer].append(step)
+        self._run_next(syncer)
+
+    def _run_next(self, syncer):
+        if syncer in self._busy or not self._queued[syncer]:
+            return
+        step = self._queued[syncer].popleft()
+        self._busy.add(syncer)
+        self._loop.run_in_worker(step,
+                                 lambda _: self._step_done(syncer))
+
+    def _step_done(self, syncer):
+        self._busy.discard(syncer)
+        if not syncer.is_running() or syncer._terminate_flag:
+            _log.info("Synchronizer for {} has stopped".format(syncer.key()))
+            del self._queued[syncer]
+            self._take_change(syncer)
+            self._loop.run_in_worker(syncer.finish)
+
+            if not self._queued:
+                # Let the daemon's main thread see that we've finished, as it
+                # would see each synchronizer's thread finish.
+                _log.info("No synchronizers running")
+                self._loop.stop()
+            return
+        self._run_next(syncer)
@@ -0,0 +1,77 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# Records the values that synchronizers see for their keys, so that a
+# production workload can be replayed offline (see test/event_replay.py).
+#
+# Each value is written as a line of JSON giving the time since recording
+# started, the key, the value and its etcd index. Values are only recorded
+# when they change, and the file is gzipped if its name ends in .gz, so a
+# trace of a long scale-up stays small.
+
+import gzip
+import json
+import logging
+from threading import Lock
+from time import time
+
+_log = logging.getLogger(__name__)
+
+
+def open_trace(path, mode="r"):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "b")
+    return open(path, mode)
+
+
+def load_events(path, key=None):
+    """Returns the events recorded in a trace file (only those for the given
+    key, if there is one), in the order they were recorded."""
+    with open_trace(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    if key is not None:
+        events = [event for event in events if event["key"] == key]
+    return events
+
+
+class EventRecorder(object):
+    def __init__(self, path):
+        self._path = path
+        self._lock = Lock()
+        self._file = None
+        self._start = time()
+
+        # The last index and value recorded for each key
+        self._last = {}
+
+    def start_thread(self):
+        # There's no thread - we write on the synchronizers' threads - but
+        # this lets a SynchronizerHost open and close the file.
+        with self._lock:
+            try:
+                self._file = open_trace(self._path, "a")
+                _log.info("Recording etcd events to {}".format(self._path))
+            except IOError as e:
+                _log.warning("Failed to open {} to record etcd events: {!r}".
+                             format(self._path, e))
+
+    def terminate(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def record(self, key, value, index):
+        with self._lock:
+            if self._file is None or self._last.get(key) == (index, value):
+                return
+            self._last[key] = (index, value)
+            self._file.write(json.dumps({"t": round(time() - self._start, 3),
+                                         "key": key,
+                                         "index": index,
+                                         "value": value}) + "\n")
+            self._file.flush()
@@ -0,0 +1,345 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# Counters, gauges and histograms describing what the manager daemons spend their time
+# on, in the Prometheus text format.
+#
+# The metrics are recorded in a process-wide registry, and can be served over
+# HTTP on a localhost port (MetricsServer), or written to a file every few
+# seconds (MetricsFile) for a node exporter's textfile collector to pick up.
+# Both can be added to a SynchronizerHost as services.
+#
+# The metrics the managers record are defined at the bottom of this file.
+
+import BaseHTTPServer
+import logging
+import os
+from contextlib import contextmanager
+from threading import Condition, Lock, Thread
+from time import time
+
+_log = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the histogram buckets. These span etcd requests
+# on a quiet system up to plugins that restart services.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value))
+                          for name, value in pairs) + "}"
+
+
+class _Metric(object):
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("{} takes labels {}, not {}".format(
+                                 self.name, self.labels, sorted(labels)))
+        return tuple(labels[name] for name in self.labels)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name + _format_labels(self.labels, key), value)
+                    for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labels, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # For each set of labels, we keep the number of observations in
+            # (and below) each bucket, the total number, and their sum.
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            entry = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the body of a with statement takes (whether or
+        not it raises)."""
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(time() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry[1] if entry else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (buckets, count, total) in sorted(self._values.items()):
+                for bound, bucket in zip(self.buckets, buckets):
+                    samples.append((self.name + "_bucket" +
+                                    _format_labels(self.labels,
+                                                   key,
+                                                   [("le", bound)]),
+                                    bucket))
+                samples.append((self.name + "_bucket" +
+                                _format_labels(self.labels,
+                                               key,
+                                               [("le", "+Inf")]),
+                                count))
+                samples.append((self.name + "_sum" +
+                                _format_labels(self.labels, key),
+                                total))
+                samples.append((self.name + "_count" +
+                                _format_labels(self.labels, key),
+                                count))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}
+
+    def _register(self, cls, name, help, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, help, labels, **kwargs)
+                self._metrics[name] = metric
+            elif type(metric) is not cls or metric.labels != tuple(labels):
+                raise ValueError("Metric {} is already registered".format(name))
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets=buckets)
+
+    def clear(self):
+        with self._lock:
+            for metric in self._metrics.values():
+                metric.clear()
+
+    def render(self):
+        """Returns every metric, in the Prometheus text format."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.TYPE))
+            for name, value in metric.samples():
+                lines.append("{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _log.debug("Metrics request: " + format % args)
+
+
+class MetricsServer(object):
+    """Serves the metrics over HTTP on a localhost port."""
+
+    def __init__(self, port):
+        self._port = port
+        self._server = None
+        self.thread = None
+
+    def start_thread(self):
+        self._server = BaseHTTPServer.HTTPServer(("127.0.0.1", self._port),
+                                                 _Handler)
+        self.thread = Thread(target=self._server.serve_forever,
+                             name="MetricsServer")
+        self.thread.daemon = True
+        self.thread.start()
+        _log.info("Serving metrics on port {}".format(self._port))
+
+    def terminate(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class MetricsFile(object):
+    """Writes the metrics to a file every INTERVAL seconds."""
+    INTERVAL = 15
+
+    def __init__(self, path):
+        self._path = path
+        self._condition = Condition()
+        self._terminate_flag = False
+        self.thread = Thread(target=self.main, name="MetricsFile")
+
+    def start_thread(self):
+        self.thread.daemon = True
+        self.thread.start()
+        _log.info("Writing metrics to {}".format(self._path))
+
+    def terminate(self):
+        with self._condition:
+            self._terminate_flag = True
+            self._condition.notify_all()
+        if self.thread.isAlive():
+            self.thread.join()
+
+    def write(self):
+        # Write to a temporary file and rename it, so that readers never see
+        # half a file.
+        tmp_path = self._path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(registry.render())
+            os.rename(tmp_path, self._path)
+        except (IOError, OSError) as e:
+            _log.warning("Failed to write metrics to {}: {!r}".format(
+                             self._path, e))
+
+    def main(self):
+        while True:
+            self.write()
+            with self._condition:
+                if not self._terminate_flag:
+                    self._condition.wait(self.INTERVAL)
+                if self._terminate_flag:
+                    return
+
+
+def metrics_services(port=None, path=None):
+    """Returns the services that publish the metrics on the given port and
+    to the given file (either of which can be left out, and a port of 0
+    means none)."""
+    services = []
+    if port and int(port):
+        services.append(MetricsServer(int(port)))
+    if path:
+        services.append(MetricsFile(path))
+    return services
+
+
+# The metrics recorded by the managers.
+
+etcd_request_seconds = registry.histogram(
+    "clearwater_etcd_request_seconds",
+    "Time taken by etcd requests other than watches")
+etcd_request_errors = registry.counter(
+    "clearwater_etcd_request_errors_total",
+    "etcd requests that failed or got a server error")
+watch_index_cleared = registry.counter(
+    "clearwater_etcd_watch_index_cleared_total",
+    "Watches that fell behind etcd's event history, so that the key (or "
+    "subtree) being watched had to be read again",
+    ["key"])
+watch_wait_seconds = registry.histogram(
+    "clearwater_etcd_watch_wait_seconds",
+    "Time spent watching a plugin's key before it changed",
+    ["plugin"])
+cas_conflicts = registry.counter(
+    "clearwater_etcd_cas_conflicts_total",
+    "Writes to etcd that lost a race with another node's write",
+    ["plugin"])
+cluster_write_contention = registry.counter(
+    "clearwater_cluster_write_contention_total",
+    "Writes of a cluster's state that lost a race with another node's write, "
+    "by what happened next - retried, reevaluated (the cluster had moved on, "
+    "so the FSM runs again) or abandoned (too many retries)",
+    ["key", "outcome"])
+fsm_transitions = registry.counter(
+    "clearwater_fsm_transitions_total",
+    "Changes to this node's state made by a cluster or queue FSM",
+    ["fsm", "plugin", "from_state", "to_state"])
+fsm_step_seconds = registry.histogram(
+    "clearwater_fsm_step_seconds",
+    "Time taken by a cluster or queue FSM to act on a new value of its key",
+    ["fsm", "plugin"])
+plugin_hook_seconds = registry.histogram(
+    "clearwater_plugin_hook_seconds",
+    "Time taken by calls into plugins",
+    ["plugin", "hook"])
+plugin_hook_running_seconds = registry.gauge(
+    "clearwater_plugin_hook_running_seconds",
+    "How long the plugin hook currently running in the background has been "
+    "running for (0 if there isn't one)",
+    ["plugin", "hook"])
+plugin_hook_errors = registry.counter(
+    "clearwater_plugin_hook_errors_total",
+    "Calls into plugins that raised an exception",
+    ["plugin", "hook"])
+command_seconds = registry.histogram(
+    "clearwater_command_seconds",
+    "Time taken by commands run by plugins",
+    ["command"])
+command_failures = registry.counter(
+    "clearwater_command_failures_total",
+    "Commands run by plugins that exited with a non-zero code",
+    ["command"])
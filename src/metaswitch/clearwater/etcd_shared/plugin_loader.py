@@ -6,19 +6,42 @@
 # Metaswitch Networks in a separate written agreement.
 
 
+import errno
 import logging
 import imp
+import json
 import os
+from concurrent import futures
+from threading import Lock
+from time import time
 
 _log = logging.getLogger("etcd_shared.plugin_loader")
 
-def load_plugins_in_dir(dir, params=None):
+# Plugin methods that take no arguments and whose results are stored in the
+# plugin manifest, so that they can be answered without importing the plugin
+MANIFEST_METHODS = ("key", "file", "files", "local_alarm", "global_alarm")
+
+# Where plugin manifests are cached. The plugin directories belong to the
+# packages that install them, so the manifests are kept here instead, one per
+# plugin directory
+MANIFEST_DIR = "/var/cache/clearwater-etcd/plugin_manifests"
+
+# How many plugin modules to import and construct at once
+LOAD_THREADS = 4
+
+def load_plugins_in_dir(dir, params=None, lazy=False):
     """Loads plugins by:
         - looking for all .py files in the given directory
         - calling their load_as_plugin() function
         - returning a list containing the return values of all load_as_plugin()
         calls
+
+    If lazy is set, plugins that haven't changed since they were last loaded
+    aren't imported until they're first used - see LazyPlugin.
         """
+    if lazy:
+        return _load_plugins_lazily(dir, params)
+
     plugins = []
     if os.path.isdir(dir):
         files = os.listdir(dir)
@@ -26,15 +49,178 @@ def load_plugins_in_dir(dir, params=None):
             _log.info("Inspecting {}".format(filename))
             module_name, suffix = os.path.splitext(filename)
             if suffix == ".py":
-                file, pathname, description = imp.find_module(module_name, [dir])
-                if file:
-                    mod = imp.load_module(module_name, file, pathname, description)
-                    if hasattr(mod, "load_as_plugin"):
-                        plugin = mod.load_as_plugin(params)
-                        _log.info("Loading {}".format(filename))
-                        if plugin is not None:
-                            _log.info("Loaded {} successfully".format(filename))
-                            plugins.append(plugin)
-                        else: # pragma : no cover
-                            _log.info("{} did not load (load_as_plugin returned None)".format(filename))
+                plugin = _load_plugin(dir, filename, params)
+                if plugin is not None:
+                    plugins.append(plugin)
     return plugins
+
+def _load_plugin(dir, filename, params):
+    # Imports a plugin module and calls its load_as_plugin() function.
+    # Returns the plugin, or None if the module isn't a plugin or doesn't
+    # want to be loaded.
+    module_name, _ = os.path.splitext(filename)
+    file, pathname, description = imp.find_module(module_name, [dir])
+    if file:
+        mod = imp.load_module(module_name, file, pathname, description)
+        if hasattr(mod, "load_as_plugin"):
+            plugin = mod.load_as_plugin(params)
+            _log.info("Loading {}".format(filename))
+            if plugin is not None:
+                _log.info("Loaded {} successfully".format(filename))
+                return plugin
+            else: # pragma : no cover
+                _log.info("{} did not load (load_as_plugin returned None)".format(filename))
+    return None
+
+def manifest_file(dir):
+    """The file that the manifest of the plugins in dir is cached in."""
+    name = os.path.abspath(dir).strip("/").replace("/", "-")
+    return os.path.join(MANIFEST_DIR, name + ".json")
+
+def plugin_name(plugin):
+    """The name of a plugin's class, without loading it if it's lazy."""
+    if isinstance(plugin, LazyPlugin):
+        return plugin.class_name
+    return plugin.__class__.__name__
+
+
+class LazyPlugin(object):
+    """Stands in for a plugin that hasn't been imported yet.
+
+    The results of the plugin's MANIFEST_METHODS are read from the manifest.
+    Anything else imports the plugin's module and calls its load_as_plugin()
+    function (once), and is passed on to the plugin that returns."""
+
+    def __init__(self, dir, filename, params, entry):
+        self._dir = dir
+        self._filename = filename
+        self._params = params
+        self._entry = entry
+        self._plugin = None
+        self._lock = Lock()
+        self.class_name = entry["class"]
+
+    def __getattr__(self, name):
+        if name in self._entry["methods"]:
+            value = self._entry["methods"][name]
+            return lambda: value
+        return getattr(self.load(), name)
+
+    def __str__(self):
+        return "<{} from {}>".format(self.class_name, self._filename)
+
+    def load(self):
+        with self._lock:
+            if self._plugin is None:
+                start = time()
+                self._plugin = _load_plugin(self._dir,
+                                            self._filename,
+                                            self._params)
+                if self._plugin is None:
+                    # The plugin no longer wants to be loaded, but we've
+                    # already started it. Throw away the manifest so that we
+                    # pick up the change when we restart.
+                    _remove_manifest(self._dir)
+                    raise RuntimeError("Plugin {} in the plugin manifest "
+                                       "didn't load".format(self._filename))
+                _log.info("Imported {} on first use in {:.3f}s".format(
+                              self._filename, time() - start))
+            return self._plugin
+
+def _manifest_entry(plugin):
+    # Returns the manifest entry for a loaded plugin, or None if its details
+    # can't be stored.
+    methods = {}
+    for name in MANIFEST_METHODS:
+        method = getattr(plugin, name, None)
+        if callable(method):
+            methods[name] = method()
+    entry = {"class": plugin.__class__.__name__, "methods": methods}
+    try:
+        json.dumps(entry)
+    except (TypeError, ValueError):
+        return None
+    return entry
+
+def _read_manifest(dir, params):
+    try:
+        with open(manifest_file(dir)) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+    # The plugins' details depend on their parameters, so the manifest is
+    # only any use if it was written with the same ones.
+    if manifest.get("params") != repr(params):
+        return {}
+    return manifest.get("plugins", {})
+
+def _write_manifest(dir, params, plugins):
+    try:
+        os.makedirs(MANIFEST_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            _log.warning("Failed to create {}: {!r}".format(MANIFEST_DIR, e))
+            return
+
+    try:
+        with open(manifest_file(dir), "w") as f:
+            json.dump({"params": repr(params), "plugins": plugins}, f)
+    except IOError as e:
+        _log.warning("Failed to write plugin manifest: {!r}".format(e))
+
+def _remove_manifest(dir):
+    try:
+        os.unlink(manifest_file(dir))
+    except OSError:
+        pass
+
+def _load_plugins_lazily(dir, params):
+    if not os.path.isdir(dir):
+        return []
+
+    start = time()
+    manifest = _read_manifest(dir, params)
+    new_manifest = {}
+    plugins = {}
+    to_load = []
+    for filename in os.listdir(dir):
+        module_name, suffix = os.path.splitext(filename)
+        if suffix != ".py":
+            continue
+
+        mtime = os.path.getmtime(os.path.join(dir, filename))
+        cached = manifest.get(filename)
+        if (cached is not None and
+            cached["mtime"] == mtime and
+            cached["entry"] is not None):
+            new_manifest[filename] = cached
+            plugins[filename] = LazyPlugin(dir, filename, params, cached["entry"])
+        else:
+            # The plugin is new or has changed (or we couldn't store its
+            # details last time, or it didn't want to be loaded), so load it
+            # now, and store its details for next time.
+            to_load.append((filename, mtime))
+
+    if to_load:
+        executor = futures.ThreadPoolExecutor(LOAD_THREADS)
+        try:
+            loaded = executor.map(
+                lambda item: _load_plugin(dir, item[0], params),
+                to_load)
+            for (filename, mtime), plugin in zip(to_load, loaded):
+                if plugin is not None:
+                    plugins[filename] = plugin
+                    new_manifest[filename] = {"mtime": mtime,
+                                              "entry": _manifest_entry(plugin)}
+        finally:
+            executor.shutdown(wait=False)
+
+    if new_manifest != manifest:
+        _write_manifest(dir, params, new_manifest)
+
+    _log.info("Found {} plugins in {:.3f}s ({} modules imported, the rest "
+              "deferred until first use)".format(len(plugins),
+                                                 time() - start,
+                                                 len(to_load)))
+    return [plugins[filename] for filename in sorted(plugins)]
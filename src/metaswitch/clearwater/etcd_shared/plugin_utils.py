@@ -11,6 +11,7 @@ import os
 from os.path import dirname
 import subprocess
 import logging
+from . import metrics
 
 _log = logging.getLogger("etcd_shared.plugin_utils")
 
@@ -24,17 +25,23 @@ def run_command(command_args, namespace=None, log_error=True):
     call without shell, to avoid shell injection. Ensure the command is passed 
     in as an array instead of a string.
     """
+    # Label the command's metrics with just the program it runs, as the
+    # arguments vary too much
+    command = os.path.basename(command_args[0])
+
     if namespace:
         command_args[0:0] = ['ip', 'netns', 'exec', namespace]
 
     # Pass the close_fds argument to avoid the pidfile lock being held by
     # child processes
-    p = subprocess.Popen(command_args,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         close_fds=True)
-    stdout, stderr = p.communicate()
+    with metrics.command_seconds.time(command=command):
+        p = subprocess.Popen(command_args,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             close_fds=True)
+        stdout, stderr = p.communicate()
     if p.returncode != 0:
+        metrics.command_failures.inc(command=command)
         # it failed, log the return code and output
         if log_error:
             _log.error("Command {} failed with return code {}, "
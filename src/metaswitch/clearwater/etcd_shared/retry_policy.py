@@ -0,0 +1,151 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# Decides how long to wait before retrying a failed etcd request.
+#
+# A RetryPolicy backs off exponentially from a short first delay, with "full
+# jitter" (each delay is picked at random between 0 and the backoff limit), so
+# that a thread retries quickly after a short blip, and the threads on
+# different nodes don't all retry at the same moment after a long one.
+#
+# Every RetryPolicy talking to the same etcd endpoint shares a CircuitBreaker.
+# Once requests to an endpoint have failed several times in a row, the breaker
+# opens, and every thread in the process waits for it to close rather than
+# working through its own backoff. After OPEN_INTERVAL, one thread is let
+# through to try the endpoint - if that succeeds the breaker closes, and if it
+# fails the breaker stays open for another interval.
+#
+# A RetryPolicy created without an endpoint has no breaker. This is for
+# retrying requests that etcd handled fine but that lost a race with another
+# writer - backing off spreads the writers out, but there's nothing wrong with
+# the endpoint.
+#
+# A caller that moves its requests between etcd members (see
+# endpoint_selector.py) tells its RetryPolicy which member it's using, so that
+# each result is recorded against the breaker of the member that handled it.
+
+import logging
+from random import uniform
+from threading import Lock
+from time import sleep, time
+
+_log = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+    # The number of consecutive failures that opens the breaker
+    FAILURE_THRESHOLD = 3
+
+    # How long the breaker stays open before letting a request through, in
+    # seconds
+    OPEN_INTERVAL = 5
+
+    def __init__(self, endpoint):
+        self._endpoint = endpoint
+        self._lock = Lock()
+        self._failures = 0
+        self._open_until = None
+
+    def is_open(self):
+        with self._lock:
+            return self._open_until is not None
+
+    def record_success(self):
+        with self._lock:
+            if self._open_until is not None:
+                _log.info("Requests to etcd at {} are succeeding again".
+                          format(self._endpoint))
+            self._failures = 0
+            self._open_until = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if (self._open_until is None and
+                self._failures >= self.FAILURE_THRESHOLD):
+                _log.warning("{} consecutive requests to etcd at {} have"
+                             " failed - holding off further requests".
+                             format(self._failures, self._endpoint))
+                self._open_until = time() + self.OPEN_INTERVAL
+
+    def wait_time(self):
+        """Returns how long the caller should wait before trying the endpoint.
+        If the breaker is due to let a request through, this caller is it, and
+        everyone else is held off for another interval."""
+        with self._lock:
+            if self._open_until is None:
+                return 0
+
+            now = time()
+            if now >= self._open_until:
+                self._open_until = now + self.OPEN_INTERVAL
+                return 0
+
+            return self._open_until - now
+
+
+# The circuit breaker for each etcd endpoint this process talks to
+_breakers = {}
+_breakers_lock = Lock()
+
+
+def circuit_breaker(endpoint):
+    with _breakers_lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(endpoint)
+        return _breakers[endpoint]
+
+
+class RetryPolicy(object):
+    # The limit on the first retry delay, in seconds. Each consecutive failure
+    # doubles the limit, up to the max_delay the policy was created with.
+    FIRST_RETRY_DELAY = 0.2
+    BACKOFF_MULTIPLIER = 2
+
+    def __init__(self, endpoint, max_delay):
+        self._breaker = circuit_breaker(endpoint) if endpoint else None
+        self._max_delay = max_delay
+        self._attempt = 0
+
+    @property
+    def attempts(self):
+        """The number of consecutive failures recorded so far."""
+        return self._attempt
+
+    def use_endpoint(self, endpoint):
+        """Records future results against the breaker for endpoint, the
+        etcd member the caller is now sending its requests to."""
+        if self._breaker is not None:
+            self._breaker = circuit_breaker(endpoint)
+
+    def succeeded(self):
+        self._attempt = 0
+        if self._breaker is not None:
+            self._breaker.record_success()
+
+    def failed(self):
+        self._attempt += 1
+        if self._breaker is not None:
+            self._breaker.record_failure()
+
+    def next_delay(self):
+        """Returns how long to wait before the next retry, given the failures
+        recorded so far."""
+        limit = min(self._max_delay,
+                    self.FIRST_RETRY_DELAY *
+                    self.BACKOFF_MULTIPLIER ** max(self._attempt - 1, 0))
+        delay = uniform(0, limit)
+        if self._breaker is not None:
+            delay = max(delay, self._breaker.wait_time())
+        return min(delay, self._max_delay)
+
+    def pause(self):
+        """Records a failure, and waits before the caller retries."""
+        self.failed()
+        delay = self.next_delay()
+        _log.debug("Retrying in {:.2f}s".format(delay))
+        sleep(delay)
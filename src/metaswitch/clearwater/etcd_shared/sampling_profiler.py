@@ -0,0 +1,144 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# A sampling profiler covering every thread in a manager daemon, turned on and
+# off by sending the daemon SIGUSR2.
+#
+# While it's on, a thread samples every other thread's stack INTERVAL times a
+# second. When it's turned off (or has run for MAX_DURATION seconds, in case
+# it's forgotten), it writes the number of times it saw each stack to
+# <log directory>/<name>-profile-<time>.folded, one line per stack in the
+# collapsed format that flamegraph.pl and speedscope read. Each stack starts
+# with the name of the thread it was on, so the plugin responsible for a busy
+# or stuck thread is easy to spot.
+#
+# When the profiler is off, it costs nothing - there's no thread and no trace
+# function.
+
+import logging
+import os
+import signal
+import sys
+import threading
+from collections import defaultdict
+from threading import Condition, Thread
+from time import strftime, time
+
+_log = logging.getLogger(__name__)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+def collapse(thread_name, frame):
+    """Returns a thread's stack in the collapsed format - the thread's name
+    and then each function from the outermost in, separated by
+    semicolons."""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.append(thread_name)
+    names.reverse()
+
+    # Semicolons separate frames, and the count follows the last space.
+    return ";".join(name.replace(";", ":").replace(" ", "_")
+                    for name in names)
+
+
+class SamplingProfiler(object):
+    # Samples per second. Each sample walks every thread's stack, which takes
+    # well under a millisecond for a manager daemon, so this keeps the
+    # overhead to a few percent of one CPU.
+    INTERVAL = 0.01
+
+    # Stop profiling after this many seconds, in case no-one turns it off.
+    MAX_DURATION = 600
+
+    def __init__(self, log_dir, name):
+        self._log_dir = log_dir
+        self._name = name
+        self._condition = Condition()
+        self._stop_flag = False
+        self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.isAlive()
+
+    def toggle(self):
+        if self.is_running():
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        if self.is_running():
+            return
+        self._stop_flag = False
+        self._thread = Thread(target=self._run, name="SamplingProfiler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        # Doesn't wait for the profile to be written, as this is called from
+        # a signal handler.
+        with self._condition:
+            self._stop_flag = True
+            self._condition.notify_all()
+
+    def sample(self, stacks):
+        """Adds the current stack of every thread but this one to stacks."""
+        names = dict((thread.ident, thread.name)
+                     for thread in threading.enumerate())
+        me = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident != me:
+                stacks[collapse(names.get(ident, str(ident)), frame)] += 1
+
+    def _run(self):
+        stacks = defaultdict(int)
+        start = time()
+        _log.info("Started sampling profiler")
+
+        with self._condition:
+            while True:
+                self.sample(stacks)
+                if self._stop_flag or time() - start >= self.MAX_DURATION:
+                    break
+                self._condition.wait(self.INTERVAL)
+
+        self._write(stacks, time() - start)
+
+    def _write(self, stacks, duration):
+        path = os.path.join(self._log_dir,
+                            "{}-profile-{}.folded".format(
+                                self._name, strftime("%Y%m%dT%H%M%S")))
+        try:
+            with open(path, "w") as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write("{} {}\n".format(stack, count))
+            _log.info("Wrote {:.0f}s profile to {}".format(duration, path))
+        except IOError as e:
+            _log.warning("Failed to write profile to {}: {!r}".format(path, e))
+
+
+def install_sigusr2_handler(log_dir, name):
+    """Installs a SIGUSR2 handler that turns the sampling profiler on and
+    off."""
+    profiler = SamplingProfiler(log_dir, name)
+
+    def sigusr2_handler(sig, stack):
+        _log.info("Handling SIGUSR2 - turning sampling profiler {}".format(
+                      "off" if profiler.is_running() else "on"))
+        profiler.toggle()
+
+    signal.signal(signal.SIGUSR2, sigusr2_handler)
+    return profiler
@@ -0,0 +1,81 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# Coalesces identical requests to etcd that are made at the same time.
+#
+# Several threads can read the same key at once - e.g. a synchronizer's main
+# loop, a request to leave the cluster, and the retry after a contended write.
+# Rather than each making its own quorum read, the first thread makes the
+# request and the others wait for it and share its result (or exception).
+#
+# A request is only shared with threads that ask while it's in flight, so
+# every result is no older than the moment the request was made. A thread that
+# needs a result newer than something it has just seen (e.g. rereading after
+# losing a race with another writer) asks for a fresh request. It doesn't join
+# one already in flight, which may have been made before that change, and any
+# thread asking after it shares its request instead.
+
+import logging
+from threading import Event, Lock
+
+_log = logging.getLogger(__name__)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+
+        # The number of requests that shared another thread's result
+        self.shared_count = 0
+
+    def do(self, key, f, fresh=False):
+        """Returns f(), unless another thread is already running a request
+        with the same key, in which case waits for and returns its
+        result. If fresh is set, always runs f() rather than sharing a
+        request that may have started before the caller asked."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None or fresh:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+            else:
+                self.shared_count += 1
+                leader = False
+
+        if not leader:
+            _log.debug("Sharing in-flight request for {}".format(key))
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+
+        try:
+            call.result = f()
+        except Exception as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                # A fresh request may have taken over the key from this one.
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+
+# The requests shared by every synchronizer in this process
+shared_reads = SingleFlight()
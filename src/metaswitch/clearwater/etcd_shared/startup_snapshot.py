@@ -0,0 +1,80 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# Reads the initial value of every synchronizer's key at once.
+#
+# When a daemon starts, each of its synchronizers would otherwise make its own
+# quorum read of its key. Instead, the daemon reads each directory that holds
+# their keys once, and hands each synchronizer its key's value and the index
+# it was read at. Each synchronizer then starts watching from that index (see
+# CommonEtcdSynchronizer.seed()).
+#
+# The directories are read one at a time, rather than in one recursive read of
+# a directory above them all. Keys for different sites or node types only have
+# /clearwater (or /) in common, and reading that would fetch the whole of
+# etcd.
+#
+# Synchronizers whose keys don't exist yet are left alone, and create their
+# keys as usual. If reading a directory fails, the synchronizers with keys in
+# it read their own keys.
+
+import etcd
+import logging
+from .etcd_backend import create_client
+
+_log = logging.getLogger(__name__)
+
+
+def parent_directories(keys):
+    """Returns the set of directories that directly contain the keys."""
+    return set("/" + "/".join(key.strip("/").split("/")[:-1]) for key in keys)
+
+
+class StartupSnapshot(object):
+    def __init__(self, etcd_ip):
+        self._client = create_client(etcd_ip, 4000)
+
+    def seed(self, synchronizers):
+        """Reads the synchronizers' keys, and seeds each synchronizer with
+        its key's value. Returns the number of synchronizers seeded."""
+        if not synchronizers:
+            return 0
+
+        directories = parent_directories([syncer.key()
+                                          for syncer in synchronizers])
+        seeded = 0
+        for directory in sorted(directories):
+            seeded += self._seed_directory(directory, synchronizers)
+
+        _log.info("Read {} of {} plugins' keys from {} directories".format(
+                      seeded, len(synchronizers), len(directories)))
+        return seeded
+
+    def _seed_directory(self, directory, synchronizers):
+        # Reads the keys directly under directory, and seeds the
+        # synchronizers whose keys are among them.
+        try:
+            result = self._client.read(directory, quorum=True)
+        except etcd.EtcdKeyNotFound:
+            _log.info("No keys under {} yet".format(directory))
+            return 0
+        except Exception as e:
+            _log.warning("Failed to read {} at startup ({!r}) - each plugin"
+                         " will read its own key".format(directory, e))
+            return 0
+
+        leaves = {leaf.key: leaf for leaf in result.leaves if not leaf.dir}
+        seeded = 0
+        for syncer in synchronizers:
+            leaf = leaves.get("/" + syncer.key().strip("/"))
+            if leaf is not None:
+                syncer.seed(leaf.value, leaf.modifiedIndex, result.etcd_index)
+                seeded += 1
+
+        _log.debug("Read {} plugins' keys from {} at index {}".format(
+                       seeded, directory, result.etcd_index))
+        return seeded
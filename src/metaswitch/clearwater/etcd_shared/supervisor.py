@@ -0,0 +1,157 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# Restarts synchronizer threads that fail.
+#
+# Without a supervisor, an unexpected exception in any synchronizer's thread
+# sends SIGTERM to the whole daemon (see CommonEtcdSynchronizer.main_wrapper),
+# and monit restarts it - reloading every plugin and rereading every key. With
+# one, only the failed synchronizer is restarted, after a backoff that doubles
+# each time it fails again soon after a restart. The other synchronizers keep
+# running.
+#
+# A synchronizer that keeps failing, however long we back off, is a sign that
+# something is wrong with the daemon as a whole, so after MAX_FAILURES quick
+# failures in a row we fall back to terminating the process.
+#
+# Synchronizer threads report their exit to the supervisor, and the daemon's
+# main thread waits on those reports in run().
+
+import logging
+import os
+import signal
+import Queue
+from time import time
+from threading import Lock
+
+_log = logging.getLogger(__name__)
+
+_FAILED = "failed"
+_EXITED = "exited"
+_WAKE = "wake"
+
+
+class Supervisor(object):
+    # Seconds to wait before restarting a synchronizer that has failed once,
+    # and the most we'll wait however often it fails
+    INITIAL_BACKOFF = 1
+    MAX_BACKOFF = 60
+
+    # A synchronizer that runs this long (in seconds) before failing is
+    # restarted after INITIAL_BACKOFF again
+    STABLE_INTERVAL = 300
+
+    # How many failures in a row (each within STABLE_INTERVAL of the last
+    # restart) we'll put up with before terminating the process
+    MAX_FAILURES = 10
+
+    # How long the main thread waits for an event at a time. Signals are only
+    # handled in between waits.
+    WAKE_INTERVAL = 1
+
+    def __init__(self):
+        self._events = Queue.Queue()
+        self._lock = Lock()
+        self._terminate_flag = False
+
+        # The synchronizers whose threads are running or waiting to restart,
+        # and for each, when it was last started, how many times in a row it
+        # has failed, and when (if it has failed) it's due to be restarted.
+        self._started = {}
+        self._failures = {}
+        self._restart_at = {}
+        self.restart_count = 0
+
+    def add(self, syncer):
+        with self._lock:
+            syncer.set_supervisor(self)
+            self._started[syncer] = time()
+            self._failures[syncer] = 0
+
+    # Called on the synchronizer's thread as it exits.
+
+    def thread_failed(self, syncer):
+        self._events.put((_FAILED, syncer))
+
+    def thread_exited(self, syncer):
+        self._events.put((_EXITED, syncer))
+
+    def terminate(self):
+        self._terminate_flag = True
+        self._events.put((_WAKE, None))
+
+    def is_running(self):
+        with self._lock:
+            return bool(self._started) and not self._terminate_flag
+
+    def run(self):
+        """Waits for synchronizer threads to exit, and restarts any that
+        failed. Returns once every synchronizer has exited normally, or
+        we're terminating."""
+        while self.is_running():
+            try:
+                event, syncer = self._events.get(timeout=self._next_timeout())
+            except Queue.Empty:
+                event = None
+
+            if self._terminate_flag:
+                break
+            if event == _FAILED:
+                self._failed(syncer)
+            elif event == _EXITED:
+                self._exited(syncer)
+
+            self._restart_due()
+
+    def _next_timeout(self):
+        with self._lock:
+            timeout = self.WAKE_INTERVAL
+            if self._restart_at:
+                timeout = min(timeout,
+                              max(0, min(self._restart_at.values()) - time()))
+            return timeout
+
+    def _failed(self, syncer):
+        with self._lock:
+            if time() - self._started[syncer] >= self.STABLE_INTERVAL:
+                self._failures[syncer] = 0
+            self._failures[syncer] += 1
+            failures = self._failures[syncer]
+
+            if failures > self.MAX_FAILURES:
+                _log.error("Plugin thread {} has failed {} times in a row - "
+                           "restarting the process".format(
+                               syncer.thread_name(), failures))
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+
+            backoff = min(self.INITIAL_BACKOFF * 2 ** (failures - 1),
+                          self.MAX_BACKOFF)
+            _log.warning("Plugin thread {} failed - restarting it in {}s".
+                         format(syncer.thread_name(), backoff))
+            self._restart_at[syncer] = time() + backoff
+
+    def _exited(self, syncer):
+        with self._lock:
+            _log.info("Plugin thread {} has finished".format(
+                          syncer.thread_name()))
+            del self._started[syncer]
+            del self._failures[syncer]
+            self._restart_at.pop(syncer, None)
+
+    def _restart_due(self):
+        with self._lock:
+            now = time()
+            due = [syncer for syncer, restart_at in self._restart_at.items()
+                   if restart_at <= now]
+            for syncer in due:
+                del self._restart_at[syncer]
+                self._started[syncer] = now
+                self.restart_count += 1
+                _log.info("Restarting plugin thread {}".format(
+                              syncer.thread_name()))
+                syncer.restart()
@@ -0,0 +1,111 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+# Runs a daemon's synchronizers.
+#
+# The synchronizers all share one WatchMultiplexer on the deployment's etcd
+# key, and are either run on a thread each (under a Supervisor that restarts
+# any that fail) or all driven from one event loop (see event_loop.py). Their
+# keys are read in one StartupSnapshot when they start.
+#
+# Each manager daemon's main() adds its synchronizers to a host. The combined
+# entry point (see combined_main.py) adds the cluster, config and queue
+# managers' synchronizers to the same host, so that they share one watch and
+# one set of etcd connections.
+
+import logging
+from metaswitch.common import utils
+from .event_loop import EventLoop, SynchronizerEngine
+from .event_recorder import EventRecorder
+from .startup_snapshot import StartupSnapshot
+from .supervisor import Supervisor
+from .watch_multiplexer import WatchMultiplexer
+
+_log = logging.getLogger(__name__)
+
+
+class SynchronizerHost(object):
+    def __init__(self, etcd_key, etcd_ip, event_loop=False):
+        self._etcd_ip = etcd_ip
+        self.multiplexer = WatchMultiplexer("/" + etcd_key, etcd_ip)
+        self.synchronizers = []
+        self._supervisor = Supervisor()
+
+        # Anything else that needs starting and stopping with the
+        # synchronizers (e.g. an etcd proxy)
+        self._services = []
+
+        self._recorder = None
+        self._loop = None
+        self._engine = None
+        if event_loop:
+            self._loop = EventLoop()
+            self._loop.install()
+            self._engine = SynchronizerEngine(self._loop, self.multiplexer)
+
+    def add(self, syncer):
+        syncer.set_multiplexer(self.multiplexer)
+        syncer.set_recorder(self._recorder)
+        self.synchronizers.append(syncer)
+        if self._engine is not None:
+            self._engine.add(syncer)
+        else:
+            self._supervisor.add(syncer)
+
+    def record_events(self, path):
+        """Records every value the synchronizers see to the given file (see
+        event_recorder.py). Must be called before adding synchronizers."""
+        self._recorder = EventRecorder(path)
+        self.add_service(self._recorder)
+
+    def add_service(self, service):
+        """Adds an object with start_thread() and terminate() methods, which
+        is started before the synchronizers and stopped with them."""
+        self._services.append(service)
+
+    def start(self):
+        """Installs a SIGTERM handler that stops everything, and starts the
+        services and synchronizers."""
+        if self._engine is not None:
+            utils.install_sigterm_handler([self._engine] + self._services)
+        else:
+            utils.install_sigterm_handler([self._supervisor] +
+                                          self.synchronizers +
+                                          [self.multiplexer] +
+                                          self._services)
+
+        if not self.synchronizers and not self._services:
+            _log.info("No plugins to run")
+            return
+
+        for service in self._services:
+            service.start_thread()
+
+        if self._engine is not None:
+            # The engine starts the multiplexer and event loop, and reads
+            # every plugin's key in one snapshot
+            self._engine.start(StartupSnapshot(self._etcd_ip))
+            _log.info("Started event loop for %d plugins" %
+                      len(self.synchronizers))
+        else:
+            # Start the multiplexer that the plugin threads rely on, then read
+            # every plugin's key in one go, rather than one at a time
+            self.multiplexer.start_thread()
+            StartupSnapshot(self._etcd_ip).seed(self.synchronizers)
+
+            for syncer in self.synchronizers:
+                syncer.start_thread()
+                _log.info("Started thread for plugin %s" % syncer._plugin)
+
+    def wait(self):
+        """Waits until every synchronizer has finished, restarting any plugin
+        thread that fails."""
+        self._supervisor.run()
+
+        if self._loop is not None and self.synchronizers:
+            while self._loop.thread.isAlive():
+                self._loop.thread.join(1)
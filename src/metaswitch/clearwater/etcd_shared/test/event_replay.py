@@ -0,0 +1,128 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""Replays the values of a key recorded by an EventRecorder (see
+etcd_shared/event_recorder.py) to a synchronizer, without etcd.
+
+Each recorded value is passed to the synchronizer's apply_value(), just as a
+SynchronizerEngine would, so it drives the same process() code - SyncFSM and
+ClusterInfo for the cluster manager, QueueFSM for the queue manager, and the
+plugin's on_config_changed() for the config manager. The synchronizer talks
+to a ReplayClient instead of etcd, which accepts its writes and serves its
+reads.
+
+By default the values are replayed back to back, so that a replay is
+deterministic and its timings show only the time spent processing. Pass a
+speed to keep the recorded gaps between values (scaled by 1/speed).
+
+For example, to replay a recorded scale-up to a cluster manager plugin:
+
+    SyncFSM.DELAY = 0
+    syncer = EtcdSynchronizer(plugin, "10.0.0.1")
+    events = load_events("scale_up.jsonl.gz", syncer.key())
+    print replay(syncer, events).summary()
+"""
+
+from time import sleep, time
+import etcd
+from etcd import EtcdResult
+from metaswitch.clearwater.etcd_shared.event_recorder import load_events # noqa
+
+
+class ReplayClient(object):
+    """Stands in for an etcd client, holding one key's replayed value."""
+
+    def __init__(self, events):
+        self.value = None
+        self.index = 0
+        self.writes = []
+        self._events = events
+        self._position = 0
+
+        # Enough for an EndpointSelector to find that there's nothing to
+        # choose between.
+        self.machines = []
+        self.leader = {"clientURLs": []}
+
+    def set_endpoint(self, host):
+        pass
+
+    def replayed(self, position):
+        event = self._events[position]
+        self.value = event["value"]
+        self.index = max(self.index, event["index"])
+        self._position = position + 1
+
+    def _result(self, key, value, index):
+        result = EtcdResult(None, {})
+        result.key = key
+        result.value = value
+        result.modifiedIndex = index
+        result.etcd_index = self.index
+        return result
+
+    def read(self, key, **kwargs):
+        # Only our key has a value - any other (e.g. a config trace key)
+        # doesn't exist.
+        if self.value is None or key != self._events[0]["key"]:
+            raise etcd.EtcdKeyNotFound()
+        return self._result(key, self.value, self.index)
+
+    def write(self, key, value, prevIndex=None, prevExist=None, **kwargs):
+        self.writes.append((self._position, value))
+
+        # If the synchronizer's write is recorded as coming back later in the
+        # trace, give it the recorded index, so that the synchronizer
+        # recognises it (e.g. to suppress its echo) as it did in production.
+        for event in self._events[self._position:]:
+            if event["value"] == value:
+                return self._result(key, value, event["index"])
+        self.index += 1
+        return self._result(key, value, self.index)
+
+
+class ReplayResult(object):
+    def __init__(self, events, durations, writes):
+        self.events = events
+        self.durations = durations
+        self.writes = writes
+
+    def summary(self):
+        if not self.durations:
+            return "No events replayed"
+        slowest = max(range(len(self.durations)),
+                      key=lambda i: self.durations[i])
+        return ("Replayed {} events in {:.3f}s ({} writes); slowest was "
+                "event {} (index {}) at {:.3f}s".format(
+                    len(self.durations),
+                    sum(self.durations),
+                    len(self.writes),
+                    slowest,
+                    self.events[slowest]["index"],
+                    self.durations[slowest]))
+
+
+def replay(syncer, events, speed=None):
+    """Feeds each event to the synchronizer in turn. Returns a ReplayResult
+    giving the time taken to process each event, and the writes the
+    synchronizer made."""
+    client = ReplayClient(events)
+    syncer._client = client
+    durations = []
+
+    last_t = None
+    for position, event in enumerate(events):
+        if speed and last_t is not None:
+            sleep(max(0, event["t"] - last_t) / speed)
+        last_t = event["t"]
+
+        client.replayed(position)
+        start = time()
+        syncer.apply_value(event["value"], event["index"])
+        durations.append(time() - start)
+
+    return ReplayResult(events, durations, client.writes)
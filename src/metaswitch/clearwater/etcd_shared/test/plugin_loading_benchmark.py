@@ -0,0 +1,147 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+"""Times how long the managers take to find their plugins at startup.
+
+Generates a directory of plugin modules, and times load_plugins_in_dir() over
+it in three ways:
+
+  - eager: every module imported (lazy=False)
+  - cold: lazy=True with no plugin manifest, as on the first start after an
+    install or upgrade
+  - warm: lazy=True with an up to date manifest, as on every other start
+
+Each is run several times, and the fastest and median times reported, so
+that the numbers can be compared across changes.
+
+Real plugins pull in libraries when they're imported, so --import-cost makes
+each generated module sleep for that long when it's imported.
+
+Usage:
+  plugin_loading_benchmark.py [--plugins=N] [--runs=N] [--import-cost=SECS]
+
+Options:
+  -h --help                      Show this screen.
+  --plugins=N                    Number of plugin modules to generate [default: 50]
+  --runs=N                       Number of times to time each mode [default: 5]
+  --import-cost=SECS             Seconds each module takes to import [default: 0]
+
+"""
+
+from docopt import docopt
+import os
+import shutil
+import tempfile
+from time import time
+
+from mock import patch
+
+from metaswitch.clearwater.etcd_shared import plugin_loader
+from metaswitch.clearwater.etcd_shared.plugin_loader import \
+    load_plugins_in_dir, manifest_file
+
+PLUGIN_TEMPLATE = """\
+import time
+time.sleep({import_cost})
+
+
+class BenchmarkPlugin{index}(object):
+    def key(self):
+        return "/benchmark/{index}"
+
+    def file(self):
+        return "/etc/clearwater/benchmark_{index}"
+
+    def files(self):
+        return [self.file()]
+
+    def local_alarm(self):
+        return None
+
+    def global_alarm(self):
+        return None
+
+
+def load_as_plugin(params):
+    return BenchmarkPlugin{index}()
+"""
+
+MODES = ("eager", "cold", "warm")
+
+
+def make_plugins(dir, count, import_cost=0):
+    """Writes count plugin modules to dir."""
+    for index in range(count):
+        with open(os.path.join(dir, "benchmark_{}.py".format(index)), "w") as f:
+            f.write(PLUGIN_TEMPLATE.format(index=index,
+                                           import_cost=import_cost))
+
+
+def time_load(dir, mode):
+    """Times one load of the plugins in dir in the given mode, and returns
+    the time taken and the number of plugins found."""
+    if mode in ("eager", "cold"):
+        try:
+            os.unlink(manifest_file(dir))
+        except OSError:
+            pass
+    elif not os.path.exists(manifest_file(dir)):
+        load_plugins_in_dir(dir, lazy=True)
+
+    start = time()
+    plugins = load_plugins_in_dir(dir, lazy=(mode != "eager"))
+    return time() - start, len(plugins)
+
+
+def run(count=50, runs=5, import_cost=0):
+    """Returns {mode: [time of each run]} for count generated plugins."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dir = os.path.join(tmp_dir, "plugins")
+        os.mkdir(dir)
+        make_plugins(dir, count, import_cost)
+
+        # Keep the manifest out of the real manifest cache
+        times = dict((mode, []) for mode in MODES)
+        with patch.object(plugin_loader,
+                          "MANIFEST_DIR",
+                          os.path.join(tmp_dir, "manifests")):
+            for _ in range(runs):
+                for mode in MODES:
+                    taken, found = time_load(dir, mode)
+                    if found != count:
+                        raise AssertionError(
+                            "Found {} of {} plugins".format(found, count))
+                    times[mode].append(taken)
+        return times
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def summary(times):
+    lines = ["{:<6} {:>10} {:>10}".format("mode", "fastest", "median")]
+    for mode in MODES:
+        ordered = sorted(times[mode])
+        lines.append("{:<6} {:>9.1f}ms {:>9.1f}ms".format(
+            mode,
+            ordered[0] * 1000,
+            ordered[len(ordered) // 2] * 1000))
+    return "\n".join(lines)
+
+
+def main(args=None):
+    arguments = docopt(__doc__, argv=args)
+    count = int(arguments["--plugins"])
+    runs = int(arguments["--runs"])
+
+    times = run(count, runs, float(arguments["--import-cost"]))
+    print "{} plugins, {} runs".format(count, runs)
+    print summary(times)
+
+
+if __name__ == '__main__': # pragma: no cover
+    main()
@@ -0,0 +1,286 @@
+# Copyright (C) Metaswitch Networks 2017
+# If license terms are provided to you in a COPYING file in the root directory
+# of the source code repository by which you are accessing this code, then
+# the license outlined in that COPYING file applies to your use.
+# Otherwise no rights are granted except for those provided to you by
+# Metaswitch Networks in a separate written agreement.
+
+import etcd
+from threading import Thread, Condition
+from time import time
+import logging
+import traceback
+import os
+import signal
+from . import metrics
+from .cancellable_watch import WatchCanceller, make_cancellable
+from .etcd_backend import create_client
+from .retry_policy import RetryPolicy
+from .etcd_v3_client import EtcdV3Client
+
+_log = logging.getLogger(__name__)
+
+
+class WatchMultiplexer(object):
+    """Maintains a single recursive watch on a common etcd prefix, and hands
+    the changes it sees to the synchronizers watching individual keys under
+    that prefix.
+
+    Without this, every synchronizer in a process runs its own long-poll watch
+    against etcd, so a daemon with a dozen plugins holds a dozen watches on the
+    same subtree."""
+    PAUSE_BEFORE_RETRY_ON_EXCEPTION = 30
+    TIMEOUT_ON_WATCH = 5
+
+    # As for CommonEtcdSynchronizer - hold the watch open until a change
+    # arrives, rather than timing out every TIMEOUT_ON_WATCH seconds.
+    LONG_LIVED_WATCHES = True
+
+    def __init__(self, prefix, etcd_ip):
+        self._prefix = self.normalise(prefix)
+        self._client = make_cancellable(create_client(etcd_ip, 4000))
+        self._watch_canceller = WatchCanceller()
+        self._retry = RetryPolicy(etcd_ip, self.PAUSE_BEFORE_RETRY_ON_EXCEPTION)
+        self._condition = Condition()
+
+        # The most recent change seen to each registered key
+        self._latest = {}
+
+        # The registered keys that are directories, where a change to any key
+        # under the directory counts as a change to the directory.
+        self._subtree_keys = set()
+
+        # Functions to call with each change to a key. See subscribe().
+        self._subscribers = {}
+
+        # Functions to call with every change under the prefix. See
+        # subscribe_subtree().
+        self._subtree_subscribers = []
+
+        # The etcd index that the watch started from, and the index to use
+        # for the next watch. Every change to the subtree with an index in
+        # between has been seen (and cached if it was for a registered key).
+        self._start_index = None
+        self._next_index = None
+
+        self._terminate_flag = False
+        self.thread = Thread(target=self.main_wrapper, name="WatchMultiplexer")
+
+    @staticmethod
+    def normalise(key):
+        return "/" + key.strip("/")
+
+    def handles(self, key):
+        return self.normalise(key).startswith(self._prefix + "/")
+
+    def register(self, key, subtree=False):
+        with self._condition:
+            self._latest.setdefault(self.normalise(key), None)
+            if subtree:
+                self._subtree_keys.add(self.normalise(key))
+
+    def subscribe(self, key, callback, subtree=False):
+        """Calls callback with the EtcdResult for each change to the key
+        (from the multiplexer's thread, so it mustn't block). If the
+        multiplexer restarts its watch and may have missed changes, callback
+        is called with None instead.
+
+        If subtree is set, the key is a directory, and callback is called
+        with each change to a key under it."""
+        self.register(key, subtree)
+        with self._condition:
+            self._subscribers[self.normalise(key)] = callback
+
+    def subscribe_subtree(self, callback):
+        """As subscribe(), but callback is called for every change under the
+        prefix, whether or not the key is registered."""
+        with self._condition:
+            self._subtree_subscribers.append(callback)
+
+    def wait_until_watching(self):
+        """Waits until the multiplexer has started watching, so that any
+        change from now on will be seen."""
+        with self._condition:
+            while self._start_index is None and not self._terminate_flag:
+                self._condition.wait()
+
+    def start_thread(self):
+        self.thread.daemon = True
+        self.thread.start()
+
+    def terminate(self):
+        with self._condition:
+            self._terminate_flag = True
+            self._condition.notify_all()
+        self._watch_canceller.cancel()
+        if self.thread.isAlive():
+            self.thread.join()
+
+    def main_wrapper(self): # pragma: no cover
+        # As for the synchronizers, an unexpected exception here means that
+        # no synchronizer would see any further changes, so restart the whole
+        # process rather than carry on silently.
+        try:
+            self.main()
+        except Exception:
+            _log.error(traceback.format_exc())
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def main(self):
+        while not self._terminate_flag:
+            try:
+                if self._next_index is None:
+                    self._resync()
+
+                with self._watch_canceller.armed():
+                    if self._terminate_flag:
+                        break
+
+                    if isinstance(self._client, EtcdV3Client):
+                        # v3 watches stream every change to us over one
+                        # connection, so keep reading from the same watch
+                        # until it fails or is cancelled.
+                        for result in self._client.watch_stream(
+                                             self._prefix,
+                                             start_index=self._next_index,
+                                             recursive=True,
+                                             timeout=self.watch_timeout()):
+                            self._dispatch(result)
+                    else:
+                        result = self._client.read(self._prefix,
+                                                   recursive=True,
+                                                   wait=True,
+                                                   waitIndex=self._next_index,
+                                                   timeout=self.watch_timeout())
+                        self._dispatch(result)
+            except etcd.EtcdEventIndexCleared:
+                # We've fallen too far behind etcd's event history, so we
+                # can't vouch for any index we've not yet seen. Start again
+                # from the current index - any synchronizer waiting on an
+                # older index will reread its key.
+                metrics.watch_index_cleared.inc(key=self._prefix)
+                _log.warning("Watch on {} fell behind etcd's event history"
+                             " ({} times so far)".
+                             format(self._prefix,
+                                    metrics.watch_index_cleared.value(
+                                        key=self._prefix)))
+                with self._condition:
+                    self._next_index = None
+                    self._condition.notify_all()
+            except etcd.EtcdException as e:
+                if self._terminate_flag:
+                    # We cancelled the watch ourselves.
+                    pass
+                elif "Read timed out" in e.message:
+                    # Timeouts are expected if we're not using long-lived
+                    # watches.
+                    pass
+                else:
+                    self._handle_exception(e)
+            except Exception as e:
+                self._handle_exception(e)
+
+    def watch_timeout(self):
+        # python-etcd treats a timeout of 0 as no timeout
+        return 0 if self.LONG_LIVED_WATCHES else self.TIMEOUT_ON_WATCH
+
+    def _handle_exception(self, e):
+        _log.error("Watch on {} caught {!r} with index {}"
+                   " - pause before retry".
+                   format(self._prefix, e, self._next_index))
+        self._retry.pause()
+
+    def _resync(self):
+        # Find out the current etcd index, so that we know where to start
+        # watching from.
+        try:
+            result = self._client.read(self._prefix, quorum=True)
+            index = result.etcd_index
+        except etcd.EtcdKeyNotFound as e:
+            # The subtree doesn't exist yet. etcd still tells us its index.
+            index = e.payload["index"]
+        self._retry.succeeded()
+
+        with self._condition:
+            restarted = self._start_index is not None
+            self._start_index = index + 1
+            self._next_index = index + 1
+            self._condition.notify_all()
+
+            if restarted:
+                # We may have missed changes since our last watch.
+                for callback in (self._subscribers.values() +
+                                 self._subtree_subscribers):
+                    callback(None)
+        _log.info("Watching {} from index {}".format(self._prefix,
+                                                     self._next_index))
+
+    def _dispatch(self, result):
+        self._retry.succeeded()
+        key = self.normalise(result.key)
+        with self._condition:
+            for registered in self._registered_keys(key):
+                _log.debug("Saw change to {} at index {}".format(
+                               key, result.modifiedIndex))
+                self._latest[registered] = result
+                if registered in self._subscribers:
+                    self._subscribers[registered](result)
+            for callback in self._subtree_subscribers:
+                callback(result)
+            self._next_index = result.modifiedIndex + 1
+            self._condition.notify_all()
+
+    def _registered_keys(self, key):
+        # The registered keys that a change to key counts as a change to.
+        keys = [directory for directory in self._subtree_keys
+                if key.startswith(directory + "/")]
+        if key in self._latest:
+            keys.append(key)
+        return keys
+
+    def covers(self, wait_index):
+        """Returns whether every change to the subtree from wait_index onwards
+        has been (or will be) seen by this multiplexer."""
+        with self._condition:
+            return (self._start_index is not None and
+                    wait_index >= self._start_index)
+
+    def wake(self):
+        """Wakes up all threads waiting for changes, so that they can check
+        whether they should stop waiting."""
+        with self._condition:
+            self._condition.notify_all()
+
+    def wait_for_change(self, key, wait_index, timeout, should_stop=None):
+        """Waits for a change to the given key with an index of at least
+        wait_index. Returns the EtcdResult for the most recent such change, or
+        None if there wasn't one within the timeout (or the multiplexer can no
+        longer vouch for changes from wait_index).
+
+        If should_stop is supplied, it's checked each time the caller is woken
+        (see wake()), and the wait ends if it returns True. In that case, the
+        timeout can be None to wait indefinitely."""
+        key = self.normalise(key)
+        deadline = None if timeout is None else time() + timeout
+
+        with self._condition:
+            while not self._terminate_flag:
+                if should_stop is not None and should_stop():
+                    return None
+
+                if self._start_index is None or wait_index < self._start_index:
+                    return None
+
+                latest = self._latest.get(key)
+                if latest is not None and latest.modifiedIndex >= wait_index:
+                    return latest
+
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        return None
+                    self._condition.wait(remaining)
+
+        return None
@@ -11,6 +11,7 @@ import json
 from time import sleep
 from concurrent import futures
 from metaswitch.clearwater.etcd_shared.common_etcd_synchronizer import CommonEtcdSynchronizer
+from metaswitch.clearwater.etcd_shared import config_trace, metrics
 from queue_fsm import QueueFSM
 import logging
 from etcd import EtcdAlreadyExist
@@ -33,9 +34,17 @@ class EtcdSynchronizer(CommonEtcdSynchronizer):
         self._site = site
         self._key = key
 
+        # The trace of the config upload that's using the queue, if any
+        self._trace = config_trace.TraceCache(self._client, self.key())
+
     def key(self):
         return "/" + self._key + "/" + self._site + "/configuration/" + self._plugin.key()
 
+    def set_multiplexer(self, multiplexer):
+        super(EtcdSynchronizer, self).set_multiplexer(multiplexer)
+        if self._multiplexer is not None:
+            self._trace.subscribe(multiplexer)
+
     def is_running(self):
         return self._fsm.is_running()
 
@@ -66,27 +75,40 @@ class EtcdSynchronizer(CommonEtcdSynchronizer):
                 break
 
             if fsm_timer_future.done():
-                self._abort_read = True
+                # Stop the etcd read - it may be blocked on a watch
+                self.abort_read()
                 self._stop_timer_thread = False
                 self.fsm_loop()
             elif etcd_future.done():
                 self._stop_timer_thread = True
                 etcd_result = etcd_future.result()
-
-                if etcd_result is not None:
-                    _log.info("Got new queue config %s from etcd" % etcd_result)
-                    self.fsm_loop(etcd_result)
-                else: #pragma: no cover
-                    _log.warning("read_from_etcd returned None, " +
-                                 "indicating a failure to get data from etcd")
+                self.process(etcd_result, None)
 
             executor.shutdown()
 
+        self.finish()
+
+    def process(self, etcd_result, old_value):
+        if etcd_result is not None and self.is_echo():
+            _log.debug("Ignoring our own write of queue config %s" % etcd_result)
+        elif etcd_result is not None:
+            _log.info("Got new queue config %s from etcd" % etcd_result)
+            self.fsm_loop(etcd_result)
+        else: #pragma: no cover
+            _log.warning("read_from_etcd returned None, " +
+                         "indicating a failure to get data from etcd")
+
+    def finish(self):
         _log.info("Quitting FSM")
         self._fsm.quit()
 
     def fsm_timer_expired(self):
-        self._stop_timer_thread = True;
+        if self._engine is not None:
+            # Run the FSM after any change to the queue that the engine is
+            # already handling.
+            self._engine.submit(self, self.fsm_loop)
+        else:
+            self._stop_timer_thread = True;
 
     def wait_for_fsm(self):
         while not self._stop_timer_thread and not self._terminate_flag:
@@ -106,29 +128,61 @@ class EtcdSynchronizer(CommonEtcdSynchronizer):
         except Exception: # pragma: no cover
             queue_config = json.loads(self.default_value())
 
-        self._fsm.fsm_update(queue_config)
+        fsm_state = self.fsm_state(queue_config)
+        with metrics.fsm_step_seconds.time(fsm="queue",
+                                           plugin=self.thread_name()):
+            self._fsm.fsm_update(queue_config)
         etcd_updated_value = json.dumps(queue_config)
 
-        # If we have a new state, try and write it to etcd.
+        new_fsm_state = self.fsm_state(queue_config)
+        if new_fsm_state[0] != fsm_state[0]:
+            metrics.fsm_transitions.inc(fsm="queue",
+                                        plugin=self.thread_name(),
+                                        from_state=fsm_state[0],
+                                        to_state=new_fsm_state[0])
+
+            # Log the change against the trace of the config upload that's
+            # using the queue, if there is one.
+            config_trace.log_span(self._trace.get(),
+                                  new_fsm_state[0],
+                                  self._id,
+                                  self.key())
+
+        # If we have a new state, try and write it to etcd. If the FSM would
+        # be in the same state after the write, there's no need to run it
+        # again when we see the write come back.
         if etcd_updated_value != self._last_value:
             _log.debug("Writing updated queue config to etcd")
-            self.write_to_etcd(etcd_updated_value)
+            self.write_to_etcd(etcd_updated_value,
+                               ignore_echo=(new_fsm_state == fsm_state))
+
+    def fsm_state(self, queue_config):
+        # The parts of the queue config that decide what the FSM does.
+        config = QueueConfig(self._id, queue_config)
+        return (config.calculate_local_state(),
+                config.calculate_global_state(),
+                config.node_at_the_front_of_the_queue())
 
     # Write the new cluster view to etcd. We may be expecting to create the key
     # for the first time.
-    def write_to_etcd(self, queue_config, with_index=None):
+    def write_to_etcd(self, queue_config, with_index=None, ignore_echo=False):
         index = with_index or self._index
         _log.info("Writing state {} into etcd with index {}"
                    .format(queue_config, self._index))
         rc = WriteToEtcdStatus.SUCCESS
 
         try:
+            self.use_endpoint(for_write=True)
             if index:
-                self._client.write(self.key(), queue_config, prevIndex=index)
+                result = self._client.write(self.key(), queue_config, prevIndex=index)
             else: # pragma: no cover
-                self._client.write(self.key(), queue_config, prevExist=False)
+                result = self._client.write(self.key(), queue_config, prevExist=False)
+            self._retry.succeeded()
+            if ignore_echo:
+                self.expect_echo(result)
         except (EtcdAlreadyExist, ValueError): # pragma: no cover
             _log.debug("Contention on etcd write")
+            metrics.cas_conflicts.inc(plugin=self.thread_name())
             # Our etcd write failed because someone got there before us. We
             # don't need to retry in this case as we'll just pick up the
             # changes in the next etcd read
@@ -144,7 +198,7 @@ class EtcdSynchronizer(CommonEtcdSynchronizer):
             # Setting last_cluster_view to None means that the next successful
             # read from etcd will trigger the state machine, which will mean
             # that any necessary work/state changes get retried.
-            # Sleep briefly to avoid hammering a failed server
+            # Back off to avoid hammering a failed server
             self._last_value, self._last_index, self._fsm._last_local_state = None, None, None
             self.pause()
             rc = WriteToEtcdStatus.ERROR
@@ -12,7 +12,9 @@
 Usage:
   main.py --local-ip=IP --local-site=SITE --etcd-key=KEY --node-type=TYPE
           [--foreground] [--log-level=LVL] [--log-directory=DIR] [--pidfile=FILE]
-          [--wait-plugin-complete=RESP]
+          [--wait-plugin-complete=RESP] [--etcd-api-version=VER]
+          [--event-loop=Y/N] [--metrics-port=PORT] [--metrics-file=FILE]
+          [--record-events=FILE]
 
 Options:
   -h --help                      Show this screen.
@@ -25,6 +27,14 @@ Options:
   --log-directory=DIR            Directory to log to [default: ./]
   --pidfile=FILE                 Pidfile to write [default: ./config-manager.pid]
   --wait-plugin-complete=RESP    Whether to wait for plugin responses
+  --etcd-api-version=VER         Version of the etcd API to use, 2 or 3 [default: 2]
+  --event-loop=Y/N               Whether to run all the plugins from one event loop,
+                                 rather than a thread each [default: N]
+  --metrics-port=PORT            Localhost port to serve metrics on, or 0 for none
+                                 [default: 0]
+  --metrics-file=FILE            File to write metrics to every few seconds
+  --record-events=FILE           File to record the values of the plugins' keys to,
+                                 for replaying offline
 
 """
 
@@ -32,6 +42,11 @@ from docopt import docopt, DocoptExit
 
 from metaswitch.common import logging_config, utils
 from metaswitch.clearwater.etcd_shared.plugin_loader import load_plugins_in_dir
+from metaswitch.clearwater.etcd_shared import etcd_backend, metrics
+from metaswitch.clearwater.etcd_shared.connection_pool import shared_pool_manager
+from metaswitch.clearwater.etcd_shared.sampling_profiler import \
+    install_sigusr2_handler
+from metaswitch.clearwater.etcd_shared.synchronizer_host import SynchronizerHost
 from metaswitch.clearwater.queue_manager.plugin_base import PluginParams
 from metaswitch.clearwater.queue_manager.etcd_synchronizer \
     import EtcdSynchronizer
@@ -52,6 +67,21 @@ LOG_LEVELS = {'0': logging.ERROR,
               '3': logging.INFO,
               '4': logging.DEBUG}
 
+def add_synchronizers(host, local_ip, local_site, etcd_key, node_type,
+                      wait_plugin_complete):
+    """Loads the queue manager's plugins, and adds a synchronizer for each
+    to the SynchronizerHost."""
+    plugins_dir = "/usr/share/clearwater/clearwater-queue-manager/plugins/"
+    plugins = load_plugins_in_dir(plugins_dir,
+                                  PluginParams(wait_plugin_complete=wait_plugin_complete),
+                                  lazy=True)
+    plugins.sort(key=lambda x: x.key())
+
+    for plugin in plugins:
+        syncer = EtcdSynchronizer(plugin, local_ip, local_site, etcd_key, node_type)
+        host.add(syncer)
+        _log.info("Loaded plugin %s" % plugin)
+
 def main(args):
     syslog.openlog("queue-manager", syslog.LOG_PID)
     pdlogs.STARTUP.log()
@@ -78,6 +108,7 @@ def main(args):
     prctl.prctl(prctl.NAME, "cw-queue-mgr")
 
     logging_config.configure_logging(log_level, log_dir, "queue-manager", show_thread=True)
+    etcd_backend.set_api_version(arguments['--etcd-api-version'])
 
     # urllib3 logs a WARNING log whenever it recreates a connection, but our
     # etcd usage does this frequently (to allow watch timeouts), so deliberately
@@ -86,6 +117,7 @@ def main(args):
     urllib_logger.setLevel(logging.ERROR)
 
     utils.install_sigusr1_handler("queue-manager")
+    install_sigusr2_handler(log_dir, "queue-manager")
 
     # Drop a pidfile. We must keep a reference to the file object here, as this keeps
     # the file locked and provides extra protection against two processes running at
@@ -97,37 +129,33 @@ def main(args):
         # We failed to take the lock - another process is already running
         exit(1)
 
-    plugins_dir = "/usr/share/clearwater/clearwater-queue-manager/plugins/"
-    plugins = load_plugins_in_dir(plugins_dir,
-                                  PluginParams(wait_plugin_complete=wait_plugin_complete))
-    plugins.sort(key=lambda x: x.key())
-    synchronizers = []
-    threads = []
-
-    # Load the plugins, but don't start them until we've installed the SIGTERM
-    # handler, as that handler will gracefully shut down any running
-    # synchronizers on receiving a SIGTERM
-    for plugin in plugins:
-        syncer = EtcdSynchronizer(plugin, local_ip, local_site, etcd_key, node_type)
-        synchronizers.append(syncer)
-        threads.append(syncer.thread)
-        _log.info("Loaded plugin %s" % plugin)
-
-    utils.install_sigterm_handler(synchronizers)
-
-    # Now start the plugin threads
-    for syncer in synchronizers:
-        syncer.start_thread()
-        _log.info("Started thread for plugin %s" % syncer._plugin)
-
-    while any([thr.isAlive() for thr in threads]):
-        for thr in threads:
-            if thr.isAlive():
-                thr.join(1)
+    host = SynchronizerHost(etcd_key,
+                            local_ip,
+                            event_loop=(arguments['--event-loop'] == "Y"))
+    if arguments['--record-events']:
+        host.record_events(arguments['--record-events'])
+
+    add_synchronizers(host,
+                      local_ip,
+                      local_site,
+                      etcd_key,
+                      node_type,
+                      wait_plugin_complete)
+
+    for service in metrics.metrics_services(arguments['--metrics-port'],
+                                            arguments['--metrics-file']):
+        host.add_service(service)
+
+    # Start the plugins (having installed the SIGTERM handler, which
+    # gracefully shuts down any running synchronizers on receiving a
+    # SIGTERM), and wait for them to finish
+    host.start()
+    host.wait()
 
     while not utils.should_quit:
         sleep(1)
 
     _log.info("Clearwater Queue Manager shutting down")
+    shared_pool_manager().log_stats()
     pdlogs.EXITING.log()
     syslog.closelog()
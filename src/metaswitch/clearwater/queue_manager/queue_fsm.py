@@ -9,6 +9,8 @@ import constants
 from queue_config import QueueConfig
 from alarms import QueueAlarm
 from timers import QueueTimer
+from metaswitch.clearwater.etcd_shared import metrics
+from metaswitch.clearwater.etcd_shared.plugin_loader import plugin_name
 import logging
 
 _log = logging.getLogger("queue_manager.queue_fsm")
@@ -37,7 +39,7 @@ class QueueFSM(object):
                                                          self.move_to_processing],
                            constants.LS_PROCESSING: [self._local_alarm.minor,
                                                      self._set_timer_with_id,
-                                                     self._plugin.at_front_of_queue],
+                                                     self._at_front_of_queue],
                            constants.LS_WAITING_ON_OTHER_NODE: [self._local_alarm.clear,
                                                                 self._set_timer_with_current_node_id],
                            constants.LS_WAITING_ON_OTHER_NODE_ERROR: [self._local_alarm.critical,
@@ -58,6 +60,11 @@ class QueueFSM(object):
     def is_running(self):
         return self._running
 
+    def _at_front_of_queue(self):
+        with metrics.plugin_hook_seconds.time(plugin=plugin_name(self._plugin),
+                                              hook="at_front_of_queue"):
+            self._plugin.at_front_of_queue()
+
     def move_to_processing(self):
         self._queue_config.move_to_processing()
 
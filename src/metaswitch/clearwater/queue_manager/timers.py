@@ -9,6 +9,7 @@
 
 import logging
 from threading import Thread, Condition
+from metaswitch.clearwater.etcd_shared.event_loop import installed_loop
 
 _log = logging.getLogger("queue_manager.timers")
 
@@ -16,6 +17,7 @@ class QueueTimer(object):
     def __init__(self, f):
         self._condition = Condition()
         self._timer_thread = None
+        self._timer_handle = None
         self.timer_popped = False
         self._timer_running = False
         self._delay = 1
@@ -33,16 +35,38 @@ class QueueTimer(object):
                 if self._function_call:
                     self._function_call()
 
+    def timer_popped_on_loop(self):
+        if self._timer_running:
+            self.timer_popped = True
+            self._timer_running = False
+            self._timer_handle = None
+            if self._function_call:
+                self._function_call()
+
     def set(self, tid, delay):
         self.clear()
         self.timer_id = tid
         self.timer_popped = False
         self._timer_running = True
         self._delay = delay
+
+        loop = installed_loop()
+        if loop is not None:
+            # Schedule the timer on the event loop rather than starting a
+            # thread for it.
+            self._timer_handle = loop.call_later(delay,
+                                                 self.timer_popped_on_loop)
+            return
+
         self._timer_thread = Thread(target=self.set_timer, name="Timer thread " + self.timer_id)
         self._timer_thread.start()
 
     def clear(self):
+        if self._timer_handle is not None:
+            self._timer_running = False
+            self._timer_handle.cancel()
+            self._timer_handle = None
+            self.timer_id = "NO_ID"
         if self._timer_thread is not None:
             self._timer_running = False
             with self._condition: